@@ -3,14 +3,32 @@ from unittest import result
 from urllib import response
 from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, status, Response, Form
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from opentelemetry.trace import SpanKind, Status, StatusCode
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 import helpers
 import os
+import json
+import asyncio
+import time
+import hashlib
 from uuid import uuid4
+from contextlib import asynccontextmanager
+import pdf_processor
 from pdf_processor import handleProcessDocuments
+from embedding_backends import EmbeddingModelMismatchError
 import config
 import database
+import jobs
+import metrics
+import pagination
+import logs
+import turn_writer
+import conversation_memory
+import tracing
 from user_models import GoogleAuthResponse, UserResponse, UserCreate, Token
 import auth
 from pydantic import BaseModel
@@ -25,12 +43,122 @@ class ChatParameter(BaseModel):
     chat_id: str | None = None
     document_ids: list[str] | None = None
     chat_history: list[ChatMessage] = []
+
+logger = logs.get_logger(__name__)
+
+TIME_TO_FIRST_TOKEN = metrics.histogram(
+    "chat_time_to_first_token_seconds",
+    "Time from the start of a streamed chat completion to its first token"
+)
+CHAT_STAGE = metrics.histogram(
+    "chat_stage_seconds", "Seconds spent in each stage of answering a chat message", labelnames=("stage",)
+)
+RETRIEVAL_SECONDS = CHAT_STAGE.labels(stage="retrieval")
+HISTORY_SECONDS = CHAT_STAGE.labels(stage="history")
+GENERATION_SECONDS = CHAT_STAGE.labels(stage="generation")
+PERSIST_SECONDS = CHAT_STAGE.labels(stage="persist")
+REQUESTS_IN_FLIGHT = metrics.gauge("http_requests_in_flight", "HTTP requests being handled")
+REQUEST_SECONDS = metrics.histogram(
+    "http_request_duration_seconds", "Seconds to handle an HTTP request, including a streamed body",
+    labelnames=("method", "route", "status"),
+)
+
+
+class MetricsMiddleware:
+    """Track in-flight requests and request durations by route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            # The router records the matched route; label by its template, not the raw path
+            route = scope.get("route")
+            REQUEST_SECONDS.labels(
+                method=scope["method"], route=getattr(route, "path", "unmatched"), status=status_code
+            ).observe(time.perf_counter() - started)
+
+
+class TracingMiddleware:
+    """Open a server span per request, continuing the caller's trace if it sent one."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        method = scope["method"]
+        with tracing.span(
+            method, kind=SpanKind.SERVER, context=tracing.incoming_context(scope["headers"]),
+            **{"http.request.method": method, "url.path": scope["path"]}
+        ) as span:
+            try:
+                await self.app(scope, receive, send_with_status)
+            finally:
+                route = scope.get("route")
+                if route is not None:
+                    span.update_name(f"{method} {route.path}")
+                    span.set_attribute("http.route", route.path)
+                span.set_attribute("http.response.status_code", status_code)
+                if status_code >= 500:
+                    span.set_status(Status(StatusCode.ERROR))
+
+
+async def timed(histogram, span_name, awaitable):
+    with histogram.time(), tracing.span(span_name):
+        return await awaitable
     
 # Create database tables
 database.create_tables()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Build the shared clients once, before the first request needs them
+    await run_in_threadpool(pdf_processor.get_processor)
+    jobs.start_workers(asyncio.get_running_loop())
+    await turn_writer.start()
+    yield
+    # Don't hold the loop until a running ingestion finishes; unfinished jobs
+    # are requeued by resume_jobs on the next start
+    jobs.shutdown_workers(wait=False)
+    # Queued chat turns are written before the engine goes away
+    await conversation_memory.stop()
+    await turn_writer.stop()
+    await pdf_processor.close_processor()
+    await database.async_engine.dispose()
+    tracing.flush()
+
+def get_processor() -> handleProcessDocuments:
+    return pdf_processor.get_processor()
+
 # Create FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Configure CORS middleware
 app.add_middleware(
@@ -39,35 +167,29 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[pagination.NEXT_CURSOR_HEADER],
 )
-
-def save_to_database(db, user_id, group_id, content, sender, message_id, document_ids):
-    """Save a message to the database."""
-    message = database.Message(
-        id=message_id if message_id else None,
-        user_id=user_id,
-        group_id=group_id,
-        role=sender,
-        content=content,
-        document_ids=",".join(document_ids) if document_ids else None
-    )
-    db.add(message)
-    db.commit()
-    return message
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
 
 @app.get("/")
 def health_check():
     return {"status": "ok"}
 
 
+@app.get("/metrics")
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.post('/auth/google')
 async def google_auth(
     response: Response,
     user_data: GoogleAuthResponse,
-    db: Session = Depends(database.get_db)
+    db: AsyncSession = Depends(database.get_db)
 ):
     # Check if user exists
-    db_user = auth.get_user_by_google_id(db, user_data.id)
+    db_user = await auth.get_user_by_google_id(db, user_data.id)
     
     if not db_user:
         # Create new user
@@ -77,9 +199,9 @@ async def google_auth(
             name=user_data.name,
             picture=user_data.picture
         )
-        result = auth.create_user(db, user_create)
+        result = await auth.create_user(db, user_create)
     else:
-        result = auth.get_token(db, db_user.id)
+        result = await auth.get_token(db, db_user.id)
         
     # Set auth cookies - use secure=False for local development, but should be True in production
     auth.set_auth_cookies(response, result["access_token"], refresh_token=result["refresh_token"], secure=False)
@@ -98,7 +220,7 @@ async def google_auth(
 @app.get('/auth/refresh-token')
 async def refresh_token(
     response: Response,
-    db: Session = Depends(database.get_db),
+    db: AsyncSession = Depends(database.get_db),
     refresh_token: str = Depends(auth.oauth2_scheme)
 ):
     decoded_token = auth.decode_refresh_token(refresh_token)
@@ -109,7 +231,7 @@ async def refresh_token(
             headers={"WWW-Authenticate": "Bearer"},
         )
     user_id = decoded_token.get("sub")
-    result = auth.get_token(db, int(user_id))
+    result = await auth.get_token(db, int(user_id))
     
     # Set auth cookies - use secure=False for local development, but should be True in production
     auth.set_auth_cookies(response, result["access_token"], refresh_token=result["refresh_token"], secure=False)
@@ -129,7 +251,7 @@ async def refresh_token(
 async def upload_pdf(
     document: UploadFile = File(...), 
     chat_id: str = Form(None),
-    db: Session = Depends(database.get_db),
+    db: AsyncSession = Depends(database.get_db),
     current_user = Depends(auth.get_current_user)
 ):
     user_id = current_user["user_id"]
@@ -142,111 +264,126 @@ async def upload_pdf(
     user_dir = f"{config.TEMP_DIR}/{user_id}"
     os.makedirs(user_dir, exist_ok=True)
     
-    pdf_path = f"{user_dir}/{document.filename}"
-    with open(pdf_path, "wb") as f:
-        content = await document.read()
-        f.write(content)
+    pdf_path = f"{user_dir}/{file_id}_{document.filename}"
+    # Stream the upload to disk in fixed-size pieces, hashing as we go so
+    # identical PDFs can share one set of vectors
+    digest = hashlib.sha256()
+    file_size = 0
+    with tracing.span("upload.save_temp") as span, open(pdf_path, "wb") as f:
+        while chunk := await document.read(config.UPLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+            file_size += len(chunk)
+            await run_in_threadpool(f.write, chunk)
+        span.set_attribute("file_size", file_size)
+    content_hash = digest.hexdigest()
 
-    prepare_save_pdf = handleProcessDocuments()
-    texts = prepare_save_pdf.extract_text(file_path=pdf_path)
-    
     # Convert empty string to None and check if chat_id is provided
     if chat_id == "":
         chat_id = None
-    generate_summary = chat_id is None
 
-    document_summary = prepare_save_pdf.save_text_to_chroma(
-        texts=texts, file_id=file_id,
-        file_name=document.filename,
-        current_user_id=user_id, generate_summary=generate_summary
-        )
-    
-    
-    group_id = chat_id if chat_id else new_chat_id
-    save_to_database(
-        db=db,
-        user_id=user_id,
-        group_id=group_id,
-        content=document_summary.get('summary', ''),
-        sender="assistant",
-        message_id=None,
-        document_ids=[file_id]
-    )
-    
-    # Create a new chat for this document if chat_id is not provided
-    if not chat_id:
-        db_chat = database.Chat(
-            id=new_chat_id,
+    # Extraction and embedding run on the ingestion worker pool; the summary
+    # for a new chat is written by the summary pool afterwards
+    with tracing.span("upload.create_job"):
+        job = await jobs.create_job(
+            db=db,
             user_id=user_id,
-            title=document_summary.get('title', 'New Chat')
+            chat_id=chat_id if chat_id else new_chat_id,
+            document_id=file_id,
+            filename=document.filename,
+            content_type=document.content_type,
+            file_path=pdf_path,
+            file_size=file_size,
+            content_hash=content_hash,
+            generate_summary=chat_id is None
         )
-        db.add(db_chat)
-        chat_id = new_chat_id
-    
-    # Store document info in the database
-    db_document = database.Document(
-        chat_id=group_id,
-        user_id=user_id,
-        id=file_id,
-        filename=document.filename,
-        content_type=document.content_type,
-        file_path=pdf_path,
-        file_size=document.size,
-        title=document.filename.replace(".pdf", "")
-    )
-    
-    db.add(db_document)
-    db.commit()
-    db.refresh(db_document)
-    
-    prepare_save_pdf.delete_pdf_file(pdf_path)
+    tracing.set_attributes(job_id=job.id, document_id=file_id)
+    jobs.submit_job(job.id)
+
     return {
-        "chat_id": db_document.chat_id,
+        "job_id": job.id,
+        "chat_id": job.chat_id,
         "document": {
-            "id": db_document.id,
-            "filename": db_document.filename,
-            "title": db_document.title,
-            "created_at": db_document.created_at
+            "id": file_id,
+            "filename": document.filename,
+            "title": document.filename.replace(".pdf", ""),
+            "created_at": job.created_at
         }
     }
 
+
+@app.get('/jobs/{job_id}')
+async def get_job_status(
+    job_id: str,
+    db: AsyncSession = Depends(database.get_db),
+    current_user = Depends(auth.get_current_user)
+):
+    user_id = current_user["user_id"]
+    job = (await db.execute(select(database.IngestionJob).where(
+        database.IngestionJob.id == job_id,
+        database.IngestionJob.user_id == user_id
+    ))).scalars().first()
+
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    return {
+        "id": job.id,
+        "status": job.status,
+        "stage": job.stage,
+        "progress": job.progress,
+        "error": job.error,
+        "summary_status": job.summary_status,
+        "chat_id": job.chat_id,
+        "document_id": job.document_id,
+        "created_at": job.created_at,
+        "updated_at": job.updated_at
+    }
+
 @app.post('/chat')
 async def query_chroma(
     chat_query: ChatParameter, 
-    db: Session = Depends(database.get_db),
-    current_user = Depends(auth.get_current_user)
+    db: AsyncSession = Depends(database.get_db),
+    current_user = Depends(auth.get_current_user),
+    prepare_save_pdf: handleProcessDocuments = Depends(get_processor)
 ):
     user_id = current_user["user_id"]
     
     group_id = chat_query.chat_id
-    prepare_save_pdf = handleProcessDocuments()
     
-    results = prepare_save_pdf.query_chroma(chat_query.query, chat_query.document_ids)
-    print(results)
-    response = prepare_save_pdf.generate_tailored_response(
-        query=chat_query.query,
-        context=results
-    )
+    vector_ids, document_names = await database.resolve_vector_ids(db, user_id, chat_query.document_ids)
+    try:
+        # Retrieval runs on the vector pool while the history is read
+        results, history = await asyncio.gather(
+            timed(RETRIEVAL_SECONDS, "chat.retrieval", prepare_save_pdf.aquery_chroma(chat_query.query, vector_ids, document_names)),
+            timed(HISTORY_SECONDS, "chat.history", conversation_memory.load_history(
+                db, group_id, user_id, prepare_save_pdf.count_tokens, chat_query.chat_history
+            ))
+        )
+    except EmbeddingModelMismatchError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    logger.debug("Retrieved context", extra={"chat_id": group_id, "context_chars": len(results)})
+    with GENERATION_SECONDS.time():
+        response = await prepare_save_pdf.agenerate_tailored_response(
+            query=chat_query.query,
+            context=results,
+            pdf_ids=vector_ids,
+            history=history
+        )
     message_id = helpers.generate_unique_id()
     
-    save_to_database(
-        db=db, 
-        user_id=user_id, 
-        group_id=group_id, 
-        content=chat_query.query, 
-        sender="user", 
-        message_id=None, 
-        document_ids=chat_query.document_ids
-    )
-    
-    save_to_database(
-        db=db, 
-        user_id=user_id, 
-        group_id=group_id, 
-        content=response, 
-        sender="assistant", 
-        message_id=message_id, 
-        document_ids=chat_query.document_ids
+    # The question and answer are committed together (or queued, with write-behind)
+    with PERSIST_SECONDS.time(), tracing.span("chat.persist"):
+        await turn_writer.save_turn(
+            db=db, 
+            user_id=user_id, 
+            group_id=group_id, 
+            query=chat_query.query, 
+            response=response, 
+            message_id=message_id, 
+            document_ids=chat_query.document_ids
+        )
+    conversation_memory.schedule_refresh(
+        group_id, user_id, prepare_save_pdf.get_llm(), prepare_save_pdf.count_tokens
     )
 
     return {
@@ -258,22 +395,100 @@ async def query_chroma(
 
 
 
+@app.post('/chat/stream')
+async def stream_chat(
+    chat_query: ChatParameter,
+    db: AsyncSession = Depends(database.get_db),
+    current_user = Depends(auth.get_current_user),
+    prepare_save_pdf: handleProcessDocuments = Depends(get_processor)
+):
+    user_id = current_user["user_id"]
+
+    group_id = chat_query.chat_id
+
+    vector_ids, document_names = await database.resolve_vector_ids(db, user_id, chat_query.document_ids)
+    try:
+        results, history = await asyncio.gather(
+            timed(RETRIEVAL_SECONDS, "chat.retrieval", prepare_save_pdf.aquery_chroma(chat_query.query, vector_ids, document_names)),
+            timed(HISTORY_SECONDS, "chat.history", conversation_memory.load_history(
+                db, group_id, user_id, prepare_save_pdf.count_tokens, chat_query.chat_history
+            ))
+        )
+    except EmbeddingModelMismatchError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    message_id = helpers.generate_unique_id()
+
+    async def event_stream():
+        started = time.perf_counter()
+        tokens = []
+        async for token in prepare_save_pdf.astream_tailored_response(
+            query=chat_query.query,
+            context=results,
+            pdf_ids=vector_ids,
+            history=history
+        ):
+            if not tokens:
+                TIME_TO_FIRST_TOKEN.observe(time.perf_counter() - started)
+            tokens.append(token)
+            yield f"data: {json.dumps({'token': token})}\n\n"
+        # Includes the time the client took to read the tokens
+        GENERATION_SECONDS.observe(time.perf_counter() - started)
+
+        response = "".join(tokens)
+
+        # The request-scoped session is closed before the body is streamed
+        with PERSIST_SECONDS.time(), tracing.span("chat.persist"):
+            async with database.AsyncSessionLocal() as db:
+                await turn_writer.save_turn(
+                    db=db,
+                    user_id=user_id,
+                    group_id=group_id,
+                    query=chat_query.query,
+                    response=response,
+                    message_id=message_id,
+                    document_ids=chat_query.document_ids
+                )
+        conversation_memory.schedule_refresh(
+            group_id, user_id, prepare_save_pdf.get_llm(), prepare_save_pdf.count_tokens
+        )
+
+        done = {
+            "id": message_id,
+            "content": response,
+            "sender": 'assistant',
+            "timestamp": "now",
+        }
+        yield f"event: done\ndata: {json.dumps(done)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @app.get('/user/documents')
 async def get_user_documents(
-    db: Session = Depends(database.get_db),
+    response: Response,
+    page: pagination.PageParams = Depends(pagination.page_params),
+    db: AsyncSession = Depends(database.get_db),
     current_user = Depends(auth.get_current_user)
 ):
     user_id = current_user["user_id"]
     
     # Check if user exists
-    user = db.query(database.User).filter(database.User.id == user_id).first()
+    user = (await db.execute(
+        select(database.User).where(database.User.id == user_id)
+    )).scalars().first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Now we can query documents directly with user_id instead of going through chats
-    documents = db.query(database.Document).filter(
-        database.Document.user_id == user_id
-    ).order_by(database.Document.created_at.desc()).all()
+    documents = (await db.execute(pagination.keyset(
+        select(database.Document).where(database.Document.user_id == user_id),
+        database.Document, page
+    ))).scalars().all()
+    documents, _ = pagination.page_rows(documents, page, response)
     
     return [
             {
@@ -287,18 +502,23 @@ async def get_user_documents(
 @app.get('/chat/{chat_id}/documents')
 async def get_chat_documents(
     chat_id: str,
-    db: Session = Depends(database.get_db),
+    response: Response,
+    page: pagination.PageParams = Depends(pagination.page_params),
+    db: AsyncSession = Depends(database.get_db),
     current_user = Depends(auth.get_current_user)
 ):
     user_id = current_user["user_id"]
     
     # Get documents from database for this chat
-    documents = db.query(database.Document).filter(
-        database.Document.chat_id == chat_id,
-        database.Document.user_id == user_id
-    ).all()    
+    documents = (await db.execute(pagination.keyset(
+        select(database.Document).where(
+            database.Document.chat_id == chat_id,
+            database.Document.user_id == user_id
+        ),
+        database.Document, page
+    ))).scalars().all()
+    documents, _ = pagination.page_rows(documents, page, response)
     
-    print(documents)
     return [
         {
             "id": doc.id,
@@ -311,16 +531,16 @@ async def get_chat_documents(
 @app.get('/get_document/{document_id}')
 async def get_document(
     document_id: str,
-    db: Session = Depends(database.get_db),
+    db: AsyncSession = Depends(database.get_db),
     current_user = Depends(auth.get_current_user)
 ):
     user_id = current_user["user_id"]
     
     # Get document from database
-    document = db.query(database.Document).filter(
+    document = (await db.execute(select(database.Document).where(
         database.Document.id == document_id,
         database.Document.user_id == user_id
-    ).first()
+    ))).scalars().first()
     
     if not document:
         raise HTTPException(
@@ -336,26 +556,73 @@ async def get_document(
     }
 
 
+@app.get('/documents/{document_id}/pages/{page}')
+async def get_document_page(
+    document_id: str,
+    page: int,
+    db: AsyncSession = Depends(database.get_db),
+    current_user = Depends(auth.get_current_user),
+    prepare_save_pdf: handleProcessDocuments = Depends(get_processor)
+):
+    """Text of one page of a document, e.g. the page a chat answer cites."""
+    user_id = current_user["user_id"]
+    
+    document = (await db.execute(select(database.Document).where(
+        database.Document.id == document_id,
+        database.Document.user_id == user_id
+    ))).scalars().first()
+    
+    if not document:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Document not found or you don't have permission to access it"
+        )
+    
+    # Deduplicated uploads share the text stored under the original's vectors
+    text = await run_in_threadpool(
+        prepare_save_pdf.text_store.page_text, document.vector_id or document.id, page
+    )
+    if text is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Page text not available"
+        )
+    
+    return {
+        "document_id": document.id,
+        "page": page,
+        "text": text
+    }
+
+
 @app.get('/chat/{chat_history_id}')
 async def get_chat_history_detail(
     chat_history_id: str,
-    db: Session = Depends(database.get_db),
+    response: Response,
+    page: pagination.PageParams = Depends(pagination.page_params),
+    db: AsyncSession = Depends(database.get_db),
     current_user = Depends(auth.get_current_user)
 ):
     user_id = current_user["user_id"]
-    chat = db.query(database.Chat).filter(
+    chat = (await db.execute(select(database.Chat).where(
         database.Chat.id == chat_history_id,
         database.Chat.user_id == user_id
-    ).first()
+    ))).scalars().first()
     
     if not chat:
         raise HTTPException(status_code=404, detail="Chat history not found")
     
-    # Get messages for this chat history
-    messages = db.query(database.Message).filter(
-        database.Message.group_id == chat_history_id,
-        database.Message.user_id == user_id
-    ).order_by(database.Message.created_at.asc()).all()
+    await turn_writer.wait_for_chat(chat_history_id)
+    # Pages run from the newest messages back; each page is returned oldest first
+    messages = (await db.execute(database.with_document_ids(pagination.keyset(
+        select(database.Message).where(
+            database.Message.group_id == chat_history_id,
+            database.Message.user_id == user_id
+        ),
+        database.Message, page
+    )))).scalars().all()
+    messages, _ = pagination.page_rows(messages, page, response)
+    messages.reverse()
     
     return {
         "messages": [
@@ -364,27 +631,34 @@ async def get_chat_history_detail(
                 "content": msg.content,
                 "sender": msg.role,
                 "created_at": msg.created_at,
-                "document_ids": msg.document_ids.split(",") if msg.document_ids else []
+                "document_ids": database.message_document_ids(msg)
             } for msg in messages
         ],
     }
 
 @app.get('/documents')
 async def get_all_documents(
-    db: Session = Depends(database.get_db),
+    response: Response,
+    page: pagination.PageParams = Depends(pagination.page_params),
+    db: AsyncSession = Depends(database.get_db),
     current_user = Depends(auth.get_current_user)
 ):
     # Only show all documents to admin users
     user_id = current_user["user_id"]
-    user = db.query(database.User).filter(database.User.id == user_id).first()
+    user = (await db.execute(
+        select(database.User).where(database.User.id == user_id)
+    )).scalars().first()
     
     # You may want to add an is_admin field to your User model
     # For now, we'll just check if this is the first user (ID 1)
     if not user or user.id != 1:
         # Regular users can only see their own documents
-        return await get_user_documents(db=db, current_user=current_user)
+        return await get_user_documents(response=response, page=page, db=db, current_user=current_user)
         
-    documents = db.query(database.Document).order_by(database.Document.created_at.desc()).all()
+    documents = (await db.execute(
+        pagination.keyset(select(database.Document), database.Document, page)
+    )).scalars().all()
+    documents, _ = pagination.page_rows(documents, page, response)
     
     return {
         "documents": [
@@ -401,11 +675,13 @@ async def get_all_documents(
 
 @app.get('/user/me')
 async def get_current_user_profile(
-    db: Session = Depends(database.get_db),
+    db: AsyncSession = Depends(database.get_db),
     current_user = Depends(auth.get_current_user)
 ):
     user_id = current_user["user_id"]
-    user = db.query(database.User).filter(database.User.id == user_id).first()
+    user = (await db.execute(
+        select(database.User).where(database.User.id == user_id)
+    )).scalars().first()
     
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -422,15 +698,19 @@ async def get_current_user_profile(
 
 @app.get('/chats')
 async def get_all_chats(
-    db: Session = Depends(database.get_db),
+    response: Response,
+    page: pagination.PageParams = Depends(pagination.page_params),
+    db: AsyncSession = Depends(database.get_db),
     current_user = Depends(auth.get_current_user)
 ):
     user_id = current_user["user_id"]
     
     # Query all chats for the current user
-    chats = db.query(database.Chat).filter(
-        database.Chat.user_id == user_id
-    ).order_by(database.Chat.created_at.desc()).all()
+    chats = (await db.execute(pagination.keyset(
+        select(database.Chat).where(database.Chat.user_id == user_id),
+        database.Chat, page
+    ))).scalars().all()
+    chats, _ = pagination.page_rows(chats, page, response)
     
     return [
         {
@@ -443,31 +723,46 @@ async def get_all_chats(
 @app.get('/chat/{chat_id}/detail')
 async def get_chat_detail(
     chat_id: str,
-    db: Session = Depends(database.get_db),
+    response: Response,
+    page: pagination.PageParams = Depends(pagination.page_params),
+    db: AsyncSession = Depends(database.get_db),
     current_user = Depends(auth.get_current_user)
 ):
     user_id = current_user["user_id"]
     
     # Get chat info
-    chat = db.query(database.Chat).filter(
+    chat = (await db.execute(select(database.Chat).where(
         database.Chat.id == chat_id,
         database.Chat.user_id == user_id
-    ).first()
+    ))).scalars().first()
     
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
     
-    # Get documents for this chat
-    documents = db.query(database.Document).filter(
-        database.Document.chat_id == chat_id,
-        database.Document.user_id == user_id
-    ).all()
-    
-    # Get messages for this chat
-    messages = db.query(database.Message).filter(
-        database.Message.group_id == chat_id,
-        database.Message.user_id == user_id
-    ).order_by(database.Message.created_at.asc()).all()
+    # The first page of this chat's documents; X-Next-Cursor belongs to the
+    # messages, so the rest continue from /chat/{chat_id}/documents?cursor=
+    documents_page = pagination.PageParams(limit=page.limit)
+    documents = (await db.execute(pagination.keyset(
+        select(database.Document).where(
+            database.Document.chat_id == chat_id,
+            database.Document.user_id == user_id
+        ),
+        database.Document, documents_page
+    ))).scalars().all()
+    documents, documents_cursor = pagination.page_rows(documents, documents_page)
+    
+    await turn_writer.wait_for_chat(chat_id)
+
+    # Get the newest page of messages for this chat, oldest first
+    messages = (await db.execute(database.with_document_ids(pagination.keyset(
+        select(database.Message).where(
+            database.Message.group_id == chat_id,
+            database.Message.user_id == user_id
+        ),
+        database.Message, page
+    )))).scalars().all()
+    messages, _ = pagination.page_rows(messages, page, response)
+    messages.reverse()
     
     return {
         "chat": {
@@ -483,13 +778,14 @@ async def get_chat_detail(
                 "created_at": doc.created_at
             } for doc in documents
         ],
+        "documents_next_cursor": documents_cursor,
         "messages": [
             {
                 "id": msg.id,
                 "content": msg.content,
                 "role": msg.role,
                 "created_at": msg.created_at,
-                "document_ids": msg.document_ids.split(",") if msg.document_ids else []
+                "document_ids": database.message_document_ids(msg)
             } for msg in messages
         ]
     }
@@ -498,16 +794,17 @@ async def get_chat_detail(
 @app.delete('/document/{document_id}')
 async def delete_document(
     document_id: str,
-    db: Session = Depends(database.get_db),
-    current_user = Depends(auth.get_current_user)
+    db: AsyncSession = Depends(database.get_db),
+    current_user = Depends(auth.get_current_user),
+    prepare_save_pdf: handleProcessDocuments = Depends(get_processor)
 ):
     user_id = current_user["user_id"]
     
     # Get document from database
-    document = db.query(database.Document).filter(
+    document = (await db.execute(select(database.Document).where(
         database.Document.id == document_id,
         database.Document.user_id == user_id
-    ).first()
+    ))).scalars().first()
     
     if not document:
         raise HTTPException(
@@ -516,17 +813,20 @@ async def delete_document(
         )
 
     # Delete associated messages
-    db.query(database.Message).filter(
-        database.Message.document_ids.contains(document_id)
-    ).delete(synchronize_session=False)
+    await database.delete_messages_for_document(db, document_id)
     
+    # Vectors shared with identical uploads are kept until the last reference goes
+    vector_id = document.vector_id or document.id
+    if document.content_hash:
+        vector_id = await database.release_indexed_content(db, document.content_hash)
+
     # Delete the document record
-    db.delete(document)
-    db.commit()
+    await db.delete(document)
+    await db.commit()
     
     # Delete from vector store
-    prepare_save_pdf = handleProcessDocuments()
-    prepare_save_pdf.delete_document(document_id)
+    if vector_id:
+        await run_in_threadpool(prepare_save_pdf.delete_document, vector_id)
     
     return {"message": "Document deleted successfully"}
 
@@ -1,5 +1,6 @@
-from sqlalchemy.orm import Session
-from database import User
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import User, Document, Chat
 from user_models import UserCreate
 import datetime
 from jose import JWTError, jwt
@@ -8,6 +9,10 @@ from fastapi.security import OAuth2PasswordBearer
 from starlette.responses import Response
 import os
 from typing import Optional
+import logs
+import tracing
+
+logger = logs.get_logger(__name__)
 
 # JWT Configuration
 SECRET_KEY = os.getenv("SECRET_KEY", "09d25e094faa6ca2556c818166b7a9563b93f7099f6f0f4caa6cf63b88e8d3e7")
@@ -18,15 +23,15 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/google")
 
 
-def get_user_by_email(db: Session, email: str):
-    return db.query(User).filter(User.email == email).first()
+async def get_user_by_email(db: AsyncSession, email: str):
+    return (await db.execute(select(User).where(User.email == email))).scalars().first()
 
 
-def get_user_by_google_id(db: Session, google_id: str):
-    return db.query(User).filter(User.google_id == google_id).first()
+async def get_user_by_google_id(db: AsyncSession, google_id: str):
+    return (await db.execute(select(User).where(User.google_id == google_id))).scalars().first()
 
 
-def create_user(db: Session, user: UserCreate):
+async def create_user(db: AsyncSession, user: UserCreate):
     db_user = User(
         email=user.email,
         name=user.name,
@@ -34,8 +39,8 @@ def create_user(db: Session, user: UserCreate):
         google_id=user.google_id
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     
     # Generate JWT token for the new user
     access_token = create_access_token(data={"sub": str(db_user.id), "email": db_user.email})
@@ -65,7 +70,7 @@ def create_access_token(data: dict, expires_delta: Optional[datetime.timedelta]
     return encoded_jwt
 
 
-def refresh_access_token(db: Session, current_token: str):
+def refresh_access_token(db: AsyncSession, current_token: str):
     try:
         payload = jwt.decode(current_token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id = payload.get("sub")
@@ -89,12 +94,12 @@ def refresh_access_token(db: Session, current_token: str):
         )
 
 
-def get_token(db: Session, user_id: int):
-    user = db.query(User).filter(User.id == user_id).first()
+async def get_token(db: AsyncSession, user_id: int):
+    user = (await db.execute(select(User).where(User.id == user_id))).scalars().first()
     if user:
         user.last_login = datetime.datetime.utcnow()
-        db.commit()
-        db.refresh(user)
+        await db.commit()
+        await db.refresh(user)
         
         # Generate new JWT token
         access_token = create_access_token(data={"sub": str(user.id), "email": user.email})
@@ -137,42 +142,43 @@ async def get_token_from_cookie_or_header(request: Request):
 
 
 async def get_current_user(request: Request):
-    print('Getting current user from token...')
-    token = await get_token_from_cookie_or_header(request)
+    with tracing.span("auth.decode"):
+        logger.debug("Authenticating request", extra={"path": request.url.path})
+        token = await get_token_from_cookie_or_header(request)
     
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+        credentials_exception = HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
     
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise credentials_exception
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            user_id: str = payload.get("sub")
+            if user_id is None:
+                raise credentials_exception
         
-        # Check token expiration time
-        exp = payload.get("exp")
-        if exp is None:
-            raise credentials_exception
+            # Check token expiration time
+            exp = payload.get("exp")
+            if exp is None:
+                raise credentials_exception
             
-        # If token is expired, raise exception
-        if datetime.datetime.fromtimestamp(exp) < datetime.datetime.utcnow():
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Token has expired",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
+            # If token is expired, raise exception
+            if datetime.datetime.fromtimestamp(exp) < datetime.datetime.utcnow():
+                raise HTTPException(
+                    status_code=status.HTTP_401_UNAUTHORIZED,
+                    detail="Token has expired",
+                    headers={"WWW-Authenticate": "Bearer"},
+                )
             
-    except JWTError:
-        raise credentials_exception
-    
+        except JWTError:
+            raise credentials_exception
+
     return {"user_id": user_id}
 
 
-def get_current_user_from_db(db: Session, user_id: int):
-    user = db.query(User).filter(User.id == user_id).first()
+async def get_current_user_from_db(db: AsyncSession, user_id: int):
+    user = (await db.execute(select(User).where(User.id == user_id))).scalars().first()
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -189,12 +195,15 @@ def decode_refresh_token(token: str):
         return None
 
     
-def get_user_documents(db: Session, user_id: int, skip: int = 0, limit: int = 100):
-    return db.query(User).filter(User.id == user_id).first().documents[skip:limit]
+async def get_user_documents(db: AsyncSession, user_id: int, skip: int = 0, limit: int = 100):
+    # Relationships can't lazy-load on an async session, so query directly
+    result = await db.execute(select(Document).where(Document.user_id == user_id).offset(skip).limit(limit))
+    return result.scalars().all()
 
 
-def get_user_chat_history(db: Session, user_id: int, skip: int = 0, limit: int = 100):
-    return db.query(User).filter(User.id == user_id).first().chat_histories[skip:limit]
+async def get_user_chat_history(db: AsyncSession, user_id: int, skip: int = 0, limit: int = 100):
+    result = await db.execute(select(Chat).where(Chat.user_id == user_id).offset(skip).limit(limit))
+    return result.scalars().all()
 
 
 def set_auth_cookies(response: Response, access_token: str, refresh_token: str, secure: bool = False):
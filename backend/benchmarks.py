@@ -0,0 +1,1272 @@
+"""Ad-hoc performance benchmarks for the backend.
+
+Run from the backend directory, e.g. ``python benchmarks.py ingestion``.
+Benchmarks use stand-ins for the OpenAI APIs so they never hit the network.
+"""
+import sys
+import os
+import time
+import asyncio
+import tempfile
+import random
+import chromadb
+from chromadb.api.types import EmbeddingFunction
+from langchain_core.messages import AIMessage
+from lexical_index import LexicalIndex
+
+
+def timed_iter(iterable, histogram):
+    """Yield from iterable, observing the seconds spent producing each item."""
+    iterator = iter(iterable)
+    while True:
+        started = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        histogram.observe(time.perf_counter() - started)
+        yield item
+
+
+async def asave_message(db, user_id, group_id, content, sender, message_id, document_ids):
+    """One message per commit, as the async endpoints used to save them."""
+    import database
+
+    db.add(database._new_message(user_id, group_id, content, sender, message_id, document_ids))
+    await db.commit()
+
+
+class StandInEmbeddingFunction(EmbeddingFunction):
+    """Fake embedding function that simulates a remote embedding API."""
+
+    def __init__(self, dimensions=256, round_trip=0.05, per_item=0.0005):
+        self.dimensions = dimensions
+        self.round_trip = round_trip
+        self.per_item = per_item
+        self.calls = 0
+
+    def __call__(self, input):
+        self.calls += 1
+        time.sleep(self.round_trip + self.per_item * len(input))
+        return [[random.random() for _ in range(self.dimensions)] for _ in input]
+
+
+class BagOfWordsEmbeddingFunction(EmbeddingFunction):
+    """Local embedding where texts sharing words get similar vectors."""
+
+    def __init__(self, dimensions=256):
+        self.dimensions = dimensions
+
+    def __call__(self, input):
+        vectors = []
+        for text in input:
+            vector = [0.0] * self.dimensions
+            for word in text.lower().split():
+                vector[hash(word) % self.dimensions] += 1.0
+            norm = sum(value * value for value in vector) ** 0.5 or 1.0
+            vectors.append([value / norm for value in vector])
+        return vectors
+
+
+class StandInLLM:
+    """Fake chat model whose completions take a fixed latency."""
+
+    def __init__(self, latency=0.5):
+        self.latency = latency
+
+    def invoke(self, messages):
+        time.sleep(self.latency)
+        return AIMessage(content="stand-in answer")
+
+    async def ainvoke(self, messages):
+        await asyncio.sleep(self.latency)
+        return AIMessage(content="stand-in answer")
+
+
+def make_sessionmaker(path):
+    """Sessions on a throwaway SQLite database so benchmarks never touch pdf_chat.db."""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    import database
+
+    engine = create_engine(f"sqlite:///{path}/bench.db", connect_args={"check_same_thread": False})
+    database.Base.metadata.create_all(bind=engine)
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def make_async_sessionmaker(path):
+    """Async sessions (WAL, pooled) on a throwaway SQLite database; returns (sessionmaker, async engine)."""
+    from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+    import database
+
+    engine, async_engine = database.create_engines(f"sqlite:///{path}/bench.db")
+    database.Base.metadata.create_all(bind=engine)
+    engine.dispose()
+    return async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False), async_engine
+
+
+def write_synthetic_pdf(path, pages=1000, lines_per_page=60):
+    """Write a plain text-only PDF with the given number of pages."""
+    words = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta"]
+    offsets = []
+    with open(path, "wb") as f:
+        def add_object(body):
+            offsets.append(f.tell())
+            f.write(f"{len(offsets)} 0 obj\n".encode() + body + b"\nendobj\n")
+
+        f.write(b"%PDF-1.4\n")
+        add_object(b"<< /Type /Catalog /Pages 2 0 R >>")
+        kids = " ".join(f"{4 + 2 * i} 0 R" for i in range(pages))
+        add_object(f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>".encode())
+        add_object(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+        for i in range(pages):
+            text_lines = [" ".join(random.choice(words) for _ in range(12)) for _ in range(lines_per_page)]
+            stream = "BT /F1 9 Tf 40 800 Td 11 TL " + " ".join(f"({line}) '" for line in text_lines) + " ET"
+            add_object(
+                f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                f"/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>".encode()
+            )
+            add_object(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream".encode())
+        xref = f.tell()
+        f.write(f"xref\n0 {len(offsets) + 1}\n0000000000 65535 f \n".encode())
+        for offset in offsets:
+            f.write(f"{offset:010d} 00000 n \n".encode())
+        f.write(f"trailer\n<< /Size {len(offsets) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+
+
+def _ingest_for_memory(pdf_path, streaming, result):
+    import resource
+    from pdf_processor import handleProcessDocuments
+
+    processor = handleProcessDocuments(
+        embedding_function=StandInEmbeddingFunction(dimensions=64, round_trip=0, per_item=0),
+        chroma_client=chromadb.EphemeralClient(),
+        llm=StandInLLM(),
+        lexical_index=LexicalIndex(":memory:"),
+    )
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if streaming:
+        chunks = processor.iter_chunks(processor.iter_pages(pdf_path))
+    else:
+        with open(pdf_path, "rb") as f:
+            upload = f.read()  # what `await document.read()` used to hold
+        chunks = processor.split_text(processor.extract_text(pdf_path))
+    processor.save_text_to_chroma(chunks, file_id="bench", file_name="bench.pdf", current_user_id="bench")
+    result.put((baseline, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def make_chunks(count, size=400):
+    words = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta"]
+    return [" ".join(random.choice(words) for _ in range(size // 6)) for _ in range(count)]
+
+
+def bench_ingestion(chunk_count=300):
+    from pdf_processor import handleProcessDocuments
+
+    chunks = make_chunks(chunk_count)
+
+    with tempfile.TemporaryDirectory() as path:
+        client = chromadb.PersistentClient(path=path)
+
+        # Baseline: one embedding call and one collection.add per chunk
+        embedding_function = StandInEmbeddingFunction()
+        collection = client.get_or_create_collection(name="per_chunk", embedding_function=embedding_function)
+        started = time.perf_counter()
+        for i, chunk in enumerate(chunks):
+            collection.add(documents=[chunk], metadatas=[{"page": i}], ids=[f"chunk_{i}"])
+        per_chunk = time.perf_counter() - started
+
+        # Batched, pipelined ingestion
+        embedding_function = StandInEmbeddingFunction()
+        processor = handleProcessDocuments(
+            embedding_function=embedding_function, chroma_client=client, llm=StandInLLM(),
+            lexical_index=LexicalIndex(":memory:")
+        )
+        processor.collection_name = "batched"
+        started = time.perf_counter()
+        processor.save_text_to_chroma(chunks, file_id="bench", file_name="bench.pdf", current_user_id="bench")
+        batched = time.perf_counter() - started
+
+    print(f"per-chunk loop: {chunk_count / per_chunk:8.1f} chunks/sec ({per_chunk:.2f}s)")
+    print(f"batched:        {chunk_count / batched:8.1f} chunks/sec ({batched:.2f}s, {embedding_function.calls} embedding calls)")
+    print(f"speedup:        {per_chunk / batched:8.1f}x")
+
+
+def bench_chat_concurrency(concurrency=10, llm_latency=0.5):
+    import httpx
+    import app
+    import auth
+    import database
+    from pdf_processor import handleProcessDocuments
+
+    with tempfile.TemporaryDirectory() as path:
+        client = chromadb.PersistentClient(path=path)
+        processor = handleProcessDocuments(
+            embedding_function=StandInEmbeddingFunction(round_trip=0.02),
+            chroma_client=client,
+            llm=StandInLLM(latency=llm_latency),
+            lexical_index=LexicalIndex(":memory:"),
+        )
+        processor.save_text_to_chroma(make_chunks(50), file_id="bench", file_name="bench.pdf", current_user_id="bench")
+
+        SessionLocal, async_engine = make_async_sessionmaker(path)
+
+        async def get_db():
+            async with SessionLocal() as db:
+                yield db
+
+        app.app.dependency_overrides[app.get_processor] = lambda: processor
+        app.app.dependency_overrides[database.get_db] = get_db
+        app.app.dependency_overrides[auth.get_current_user] = lambda: {"user_id": "bench"}
+
+        async def run():
+            transport = httpx.ASGITransport(app=app.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+                payload = {"query": "What is gamma?", "chat_id": "bench", "document_ids": ["bench"]}
+                started = time.perf_counter()
+                responses = await asyncio.gather(*[http.post("/chat", json=payload) for _ in range(concurrency)])
+                elapsed = time.perf_counter() - started
+            assert all(response.status_code == 200 for response in responses)
+            return elapsed
+
+        try:
+            elapsed = asyncio.run(run())
+        finally:
+            app.app.dependency_overrides.clear()
+            asyncio.run(async_engine.dispose())
+
+    print(f"{concurrency} concurrent chats: {elapsed:.2f}s (LLM latency {llm_latency:.2f}s, serial would be {concurrency * llm_latency:.2f}s)")
+
+
+def bench_processor_setup(requests=50):
+    import config
+    import pdf_processor
+
+    # Construction never calls the API, but the OpenAI clients insist on a key
+    config.OPENAI_API_KEY = config.OPENAI_API_KEY or "sk-benchmark"
+
+    with tempfile.TemporaryDirectory() as path:
+        config.CHROMA_DB_PATH = path
+        config.LEXICAL_INDEX_PATH = f"{path}/lexical.db"
+
+        # Old behaviour: a new processor, Chroma client and collection per request
+        started = time.perf_counter()
+        for _ in range(requests):
+            processor = pdf_processor.handleProcessDocuments()
+            processor.get_collection()
+            asyncio.run(processor.aclose())
+        per_request = (time.perf_counter() - started) / requests
+
+        # Shared service: built once, then only the cached handles are used
+        pdf_processor.get_processor().get_collection()
+        started = time.perf_counter()
+        for _ in range(requests):
+            pdf_processor.get_processor().get_collection()
+        shared = (time.perf_counter() - started) / requests
+        asyncio.run(pdf_processor.close_processor())
+
+    print(f"per-request setup: {per_request * 1000:8.2f} ms")
+    print(f"shared service:    {shared * 1000:8.2f} ms")
+
+
+def bench_ingestion_memory(pages=1000):
+    import multiprocessing
+
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as path:
+        pdf_path = f"{path}/synthetic.pdf"
+        write_synthetic_pdf(pdf_path, pages=pages)
+        print(f"synthetic PDF: {pages} pages, {os.path.getsize(pdf_path) / 1e6:.1f} MB")
+
+        # Each run gets a fresh process so peak RSS isn't shared between them
+        for label, streaming in (("buffered", False), ("streaming", True)):
+            result = context.Queue()
+            process = context.Process(target=_ingest_for_memory, args=(pdf_path, streaming, result))
+            process.start()
+            process.join()
+            if process.exitcode:
+                raise RuntimeError(f"{label} run failed with exit code {process.exitcode}")
+            baseline_kb, peak_kb = result.get()
+            print(f"{label:10} peak RSS: {peak_kb / 1024:8.1f} MB ({(peak_kb - baseline_kb) / 1024:+.1f} MB over imports)")
+
+
+def bench_extraction(pages=1000):
+    import config
+    from pdf_processor import handleProcessDocuments
+
+    processor = handleProcessDocuments(
+        embedding_function=StandInEmbeddingFunction(),
+        chroma_client=chromadb.EphemeralClient(),
+        llm=StandInLLM(),
+        lexical_index=LexicalIndex(":memory:"),
+    )
+    with tempfile.TemporaryDirectory() as path:
+        pdf_path = f"{path}/synthetic.pdf"
+        write_synthetic_pdf(pdf_path, pages=pages)
+
+        config.EXTRACT_WORKERS = 1
+        started = time.perf_counter()
+        serial = [page.page_content for page in processor.iter_pages(pdf_path)]
+        serial_time = time.perf_counter() - started
+
+        config.EXTRACT_WORKERS = max(os.cpu_count() or 1, 2)
+        processor.get_extraction_pool(config.EXTRACT_WORKERS)  # exclude one-off worker startup
+        started = time.perf_counter()
+        parallel = [page.page_content for page in processor.iter_pages(pdf_path)]
+        parallel_time = time.perf_counter() - started
+        asyncio.run(processor.aclose())
+
+    assert serial == parallel, "parallel extraction changed the page text"
+    print(f"serial:   {serial_time:6.2f}s")
+    print(f"parallel: {parallel_time:6.2f}s ({config.EXTRACT_WORKERS} processes, {serial_time / parallel_time:.1f}x)")
+
+
+def create_legacy_collection(client):
+    """The single pdf_documents collection as the pre-partitioning code created it."""
+    import config
+    from chromadb.utils.embedding_functions import OpenAIEmbeddingFunction
+
+    # Persisted as Chroma's "openai" embedding function; never called here
+    os.environ.setdefault("CHROMA_OPENAI_API_KEY", "sk-bench")
+    return client.get_or_create_collection(
+        name=config.PDF_COLLECTION_NAME,
+        embedding_function=OpenAIEmbeddingFunction(model_name=config.EMBEDDING_MODEL)
+    )
+
+
+def bench_partitions(doc_counts=(10, 100, 400), chunks_per_doc=50, queries=30):
+    from pdf_processor import handleProcessDocuments
+
+    def random_vectors(count, dimensions=256):
+        return [[random.random() for _ in range(dimensions)] for _ in range(count)]
+
+    with tempfile.TemporaryDirectory() as path:
+        # Same code path for both layouts: a document without a partition is
+        # searched in the legacy collection with a pdf_id filter. The legacy
+        # collection is created as an existing deployment's would have been.
+        create_legacy_collection(chromadb.PersistentClient(path=f"{path}/monolithic"))
+        monolithic = handleProcessDocuments(
+            embedding_function=StandInEmbeddingFunction(round_trip=0, per_item=0),
+            chroma_client=chromadb.PersistentClient(path=f"{path}/monolithic"),
+            llm=StandInLLM(),
+            lexical_index=LexicalIndex(":memory:"),
+        )
+        partitioned = handleProcessDocuments(
+            embedding_function=StandInEmbeddingFunction(round_trip=0, per_item=0),
+            chroma_client=chromadb.PersistentClient(path=f"{path}/partitioned"),
+            llm=StandInLLM(),
+            lexical_index=LexicalIndex(":memory:"),
+        )
+        legacy = monolithic.get_collection()
+
+        loaded = 0
+        print(f"{'documents':>10} {'chunks':>8} {'monolithic':>12} {'partitioned':>12}")
+        for doc_count in doc_counts:
+            for doc_index in range(loaded, doc_count):
+                pdf_id = f"doc{doc_index}"
+                ids = [f"{pdf_id}_{i}" for i in range(chunks_per_doc)]
+                documents = make_chunks(chunks_per_doc, size=100)
+                metadatas = [{"pdf_id": pdf_id, "page": i} for i in range(chunks_per_doc)]
+                embeddings = random_vectors(chunks_per_doc)
+                legacy.add(ids=ids, documents=documents, metadatas=metadatas, embeddings=embeddings)
+                partitioned.get_collection(pdf_id).add(
+                    ids=ids, documents=documents, metadatas=metadatas, embeddings=embeddings
+                )
+            loaded = doc_count
+
+            # A chat keeps asking about the same documents; the first query
+            # loads their index from disk and isn't counted
+            pdf_ids = [f"doc{doc_count - 1}", f"doc{doc_count // 2}"]
+            timings = {}
+            for label, processor in (("monolithic", monolithic), ("partitioned", partitioned)):
+                processor._search_partitions("what is gamma?", pdf_ids, n_results=5)
+                started = time.perf_counter()
+                for _ in range(queries):
+                    processor._search_partitions("what is gamma?", pdf_ids, n_results=5)
+                timings[label] = (time.perf_counter() - started) / queries
+            print(
+                f"{doc_count:>10} {doc_count * chunks_per_doc:>8}"
+                f" {timings['monolithic'] * 1000:>9.2f} ms {timings['partitioned'] * 1000:>9.2f} ms"
+            )
+        asyncio.run(monolithic.aclose())
+        asyncio.run(partitioned.aclose())
+
+
+def bench_migration(doc_count=50, chunks_per_doc=20, dimensions=3072):
+    """migrate_partitions on a legacy collection seeded the way the old code
+    wrote it: OpenAIEmbeddingFunction, one chunk per add, old metadata."""
+    import uuid
+    from pdf_processor import handleProcessDocuments
+    from migrate_partitions import migrate
+
+    with tempfile.TemporaryDirectory() as path:
+        legacy = create_legacy_collection(chromadb.PersistentClient(path=path))
+        for doc_index in range(doc_count):
+            pdf_id = f"doc{doc_index}"
+            legacy.add(
+                ids=[f"{pdf_id}_p{page}_{uuid.uuid4()}" for page in range(chunks_per_doc)],
+                documents=make_chunks(chunks_per_doc, size=100),
+                embeddings=[[random.random() for _ in range(dimensions)] for _ in range(chunks_per_doc)],
+                metadatas=[{
+                    "source": f"{pdf_id}.pdf", "pdf_id": pdf_id, "page": page,
+                    "current_user_id": "bench", "document_name": f"{pdf_id}.pdf",
+                } for page in range(chunks_per_doc)],
+            )
+
+        processor = handleProcessDocuments(
+            embedding_function=StandInEmbeddingFunction(dimensions=dimensions, round_trip=0, per_item=0),
+            chroma_client=chromadb.PersistentClient(path=path),
+            llm=StandInLLM(),
+            lexical_index=LexicalIndex(":memory:"),
+        )
+        started = time.perf_counter()
+        copied = migrate(processor)
+        elapsed = time.perf_counter() - started
+        partitions = [processor.get_collection(f"doc{i}", create=False) for i in range(doc_count)]
+        intact = all(partition is not None and partition.count() == chunks_per_doc for partition in partitions)
+        legacy_dropped = processor.get_collection(create=False) is None
+        asyncio.run(processor.aclose())
+
+    print(f"{copied} chunks from {doc_count} documents in {elapsed:.2f}s ({copied / elapsed:.0f} chunks/sec)")
+    print(f"every partition complete: {intact}, legacy collection dropped: {legacy_dropped}")
+
+
+def bench_lexical(chunk_count=2000, queries=50):
+    from pdf_processor import handleProcessDocuments
+
+    embedding_function = StandInEmbeddingFunction(round_trip=0.05)
+    processor = handleProcessDocuments(
+        embedding_function=embedding_function,
+        chroma_client=chromadb.EphemeralClient(),
+        llm=StandInLLM(),
+        lexical_index=LexicalIndex(":memory:"),
+    )
+    # Every chunk mentions one part number that appears nowhere else
+    chunks = [f"{chunk} part PN-{i:05d} rev B" for i, chunk in enumerate(make_chunks(chunk_count, size=300))]
+    processor.save_text_to_chroma(chunks, file_id="bench", file_name="bench.pdf", current_user_id="bench")
+    targets = random.sample(range(chunk_count), queries)
+
+    def run(retrieve):
+        calls = embedding_function.calls
+        found = 0
+        started = time.perf_counter()
+        for i in targets:
+            hits = retrieve(f"PN-{i:05d}")
+            found += any(f"PN-{i:05d}" in document for *_, document, _ in hits)
+        elapsed = (time.perf_counter() - started) / queries
+        return elapsed, found / queries, embedding_function.calls - calls
+
+    vector = run(lambda query: processor._search_partitions(query, ["bench"], n_results=5))
+    lexical = run(lambda query: processor._retrieve(query, ["bench"], n_results=5))
+    asyncio.run(processor.aclose())
+
+    for label, (elapsed, recall, calls) in (("vector only", vector), ("lexical fast path", lexical)):
+        print(f"{label:18} {elapsed * 1000:8.2f} ms/query, recall@5 {recall:5.0%}, {calls} embedding calls")
+
+
+def bench_embedding_backends(chunk_count=500):
+    from embedding_backends import LocalEmbeddingFunction
+    from pdf_processor import handleProcessDocuments
+
+    chunks = make_chunks(chunk_count)
+    local = LocalEmbeddingFunction()
+    local(["warm up"])  # downloads the model on first use
+    backends = (
+        ("remote (stand-in)", StandInEmbeddingFunction(dimensions=3072, round_trip=0.3, per_item=0.002)),
+        ("local onnx", local),
+    )
+    for label, embedding_function in backends:
+        processor = handleProcessDocuments(
+            embedding_function=embedding_function,
+            chroma_client=chromadb.EphemeralClient(),
+            llm=StandInLLM(),
+            lexical_index=LexicalIndex(":memory:"),
+        )
+        started = time.perf_counter()
+        processor.save_text_to_chroma(chunks, file_id=f"bench-{label[:5]}", file_name="bench.pdf", current_user_id="bench")
+        elapsed = time.perf_counter() - started
+        asyncio.run(processor.aclose())
+        print(f"{label:18} {chunk_count / elapsed:8.1f} chunks/sec ({elapsed:.2f}s)")
+    local.close()
+
+
+def bench_context(paragraphs=400, queries=50):
+    import config
+    from langchain_core.documents import Document
+    from context_builder import build_context, format_section
+    from pdf_processor import handleProcessDocuments
+
+    processor = handleProcessDocuments(
+        embedding_function=BagOfWordsEmbeddingFunction(),
+        chroma_client=chromadb.EphemeralClient(),
+        llm=StandInLLM(),
+        lexical_index=LexicalIndex(":memory:"),
+    )
+    vocabulary = [f"term{i}" for i in range(300)]
+    pages = [
+        Document(
+            page_content="\n\n".join(
+                " ".join(random.choice(vocabulary) for _ in range(random.randint(20, 90))) + "."
+                for _ in range(10)
+            ),
+            metadata={"page": page},
+        )
+        for page in range(paragraphs // 10)
+    ]
+    processor.save_text_to_chroma(
+        list(processor.iter_chunks(pages)), file_id="bench", file_name="bench.pdf", current_user_id="bench"
+    )
+
+    old_tokens = new_tokens = redundant_tokens = 0
+    for _ in range(queries):
+        page = random.choice(pages).page_content
+        start = random.randrange(len(page) // 2)
+        query = page[start:start + 200]
+        hits = processor._retrieve(query, ["bench"], n_results=config.CONTEXT_CANDIDATES)
+        # Previously: the top 5 hits concatenated as they are
+        old_tokens += processor.count_tokens("\n\n".join(
+            format_section(metadata["document_name"], metadata["page"], document)
+            for _, _, document, metadata in hits[:5]
+        ))
+        # Tokens of the old prompt that only repeated overlapping text
+        _, deduplicated = build_context(
+            [(document, metadata) for _, _, document, metadata in hits[:5]], processor.count_tokens, budget=10**9
+        )
+        redundant_tokens += deduplicated["tokens_saved"]
+        _, stats = build_context([(document, metadata) for _, _, document, metadata in hits], processor.count_tokens)
+        new_tokens += stats["context_tokens"]
+    asyncio.run(processor.aclose())
+
+    # gpt-4-turbo input pricing, $10 per million tokens
+    for label, tokens in (("top-5 concatenation", old_tokens), ("budgeted builder", new_tokens)):
+        print(f"{label:20} {tokens / queries:8.1f} prompt tokens/request, ${tokens / queries * 10 / 1e6 * 1000:.2f} per 1k requests")
+    print(f"top-5 tokens repeating overlapping text: {redundant_tokens / old_tokens:.0%}")
+    print(f"saved: {(old_tokens - new_tokens) / old_tokens:.0%} (budget {config.CONTEXT_TOKEN_BUDGET} tokens)")
+
+
+def bench_summary(pages=120, llm_latency=0.2, concurrency_levels=(1, 2, 4, 8, 16)):
+    from summarizer import summarize_pages
+
+    words = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta"]
+    texts = [" ".join(random.choice(words) for _ in range(600)) for _ in range(pages)]
+    count_tokens = lambda text: len(text) // 4 + 1
+
+    class CountingLLM(StandInLLM):
+        calls = 0
+
+        async def ainvoke(self, messages):
+            CountingLLM.calls += 1
+            return await super().ainvoke(messages)
+
+    llm = CountingLLM(latency=llm_latency)
+    for concurrency in concurrency_levels:
+        CountingLLM.calls = 0
+        started = time.perf_counter()
+        asyncio.run(summarize_pages(llm, texts, count_tokens, max_concurrency=concurrency))
+        elapsed = time.perf_counter() - started
+        print(f"concurrency {concurrency:3}: {elapsed:6.2f}s ({CountingLLM.calls} LLM calls at {llm_latency:.2f}s)")
+
+
+def bench_database(readers=20, writers=5, operations=100):
+    """Concurrent chat-history reads and message writes against SQLite.
+
+    The old setup (sync sessions, rollback journal, run in a thread pool) is
+    compared with async sessions on the WAL engine.
+    """
+    import concurrent.futures
+    from sqlalchemy import create_engine, select
+    from sqlalchemy.exc import OperationalError
+    from sqlalchemy.orm import sessionmaker
+    import database
+
+    def seed(session):
+        session.add(database.User(id="bench", email="bench@example.com"))
+        session.add(database.Chat(id="bench", user_id="bench", title="bench"))
+        for i in range(200):
+            session.add(database._new_message("bench", "bench", f"message {i}", "user", None, ""))
+        session.commit()
+
+    def history_query():
+        return select(database.Message).where(
+            database.Message.group_id == "bench"
+        ).order_by(database.Message.created_at.asc())
+
+    with tempfile.TemporaryDirectory() as path:
+        engine = create_engine(f"sqlite:///{path}/journal.db", connect_args={"check_same_thread": False})
+        database.Base.metadata.create_all(bind=engine)
+        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        with SessionLocal() as session:
+            seed(session)
+        errors = []
+
+        def sync_read():
+            with SessionLocal() as session:
+                session.execute(history_query()).scalars().all()
+
+        def sync_write():
+            with SessionLocal() as session:
+                try:
+                    database.save_to_database(session, "bench", "bench", "reply", "assistant", None, "")
+                except OperationalError:
+                    errors.append(1)
+
+        tasks = [sync_read] * (readers * operations) + [sync_write] * (writers * operations)
+        random.shuffle(tasks)
+        started = time.perf_counter()
+        # The old endpoints ran in Starlette's thread pool (40 threads)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=40) as pool:
+            list(pool.map(lambda task: task(), tasks))
+        journal_elapsed = time.perf_counter() - started
+        engine.dispose()
+
+        AsyncSessionLocal, async_engine = make_async_sessionmaker(path)
+        with make_sessionmaker(path)() as session:
+            seed(session)
+
+        async def run():
+            async def read():
+                async with AsyncSessionLocal() as session:
+                    (await session.execute(history_query())).scalars().all()
+
+            async def write():
+                async with AsyncSessionLocal() as session:
+                    await asave_message(session, "bench", "bench", "reply", "assistant", None, "")
+
+            async def worker(operation):
+                for _ in range(operations):
+                    await operation()
+
+            started = time.perf_counter()
+            await asyncio.gather(*([worker(read) for _ in range(readers)] + [worker(write) for _ in range(writers)]))
+            elapsed = time.perf_counter() - started
+            await async_engine.dispose()
+            return elapsed
+
+        wal_elapsed = asyncio.run(run())
+
+    total = (readers + writers) * operations
+    print(f"{readers} readers / {writers} writers, {total} operations")
+    print(f"sync, rollback journal: {journal_elapsed:6.2f}s ({total / journal_elapsed:7.0f} ops/s, {len(errors)} lock errors)")
+    print(f"async, WAL:             {wal_elapsed:6.2f}s ({total / wal_elapsed:7.0f} ops/s)")
+
+
+def bench_pagination(messages=1_000_000, heavy_chat_messages=20_000, messages_per_chat=100, runs=20):
+    """Chat history and chat list queries on a seeded 1M-message database,
+    unbounded loads without the composite indexes versus keyset pages with them."""
+    import datetime
+    import sqlite3
+    import uuid
+    from sqlalchemy import create_engine, select
+    from sqlalchemy.orm import sessionmaker
+    import database
+    import pagination
+
+    def timed(run):
+        started = time.perf_counter()
+        for _ in range(runs):
+            run()
+        return (time.perf_counter() - started) / runs * 1000
+
+    with tempfile.TemporaryDirectory() as path:
+        engine = create_engine(f"sqlite:///{path}/pagination.db")
+        database.Base.metadata.create_all(bind=engine)
+        composite = [
+            index for table in database.Base.metadata.sorted_tables for index in table.indexes
+            if index.name in ("ix_message_groups_user_created", "ix_messages_group_user_created",
+                              "ix_documents_user_created", "ix_documents_chat_user_created")
+        ]
+        for index in composite:
+            index.drop(bind=engine)
+
+        started = time.perf_counter()
+        connection = sqlite3.connect(f"{path}/pagination.db")
+        start_time = datetime.datetime(2024, 1, 1)
+        chat_count = (messages - heavy_chat_messages) // messages_per_chat
+        users = [f"user-{i}" for i in range(max(chat_count // 10, 1))]
+        connection.executemany("INSERT INTO users (id, email) VALUES (?, ?)", [(user, f"{user}@example.com") for user in users])
+        chats = [("heavy", users[0])] + [(f"chat-{i}", users[i % len(users)]) for i in range(chat_count)]
+        connection.executemany(
+            "INSERT INTO message_groups (id, user_id, title, created_at) VALUES (?, ?, 'chat', ?)",
+            [(chat_id, user_id, str(start_time + datetime.timedelta(minutes=i))) for i, (chat_id, user_id) in enumerate(chats)],
+        )
+
+        def rows():
+            sequence = 0
+            for chat_id, user_id in chats:
+                for _ in range(heavy_chat_messages if chat_id == "heavy" else messages_per_chat):
+                    sequence += 1
+                    yield (str(uuid.uuid4()), chat_id, user_id, "user", "message text " * 8,
+                           str(start_time + datetime.timedelta(seconds=sequence)))
+
+        connection.executemany(
+            "INSERT INTO messages (id, group_id, user_id, role, content, created_at) VALUES (?, ?, ?, ?, ?, ?)", rows()
+        )
+        connection.commit()
+        connection.close()
+        print(f"seeded {messages} messages in {len(chats)} chats in {time.perf_counter() - started:.1f}s")
+
+        SessionLocal = sessionmaker(bind=engine)
+        session = SessionLocal()
+        Message = database.Message
+        Chat = database.Chat
+
+        def unbounded_history(chat_id, user_id):
+            return session.execute(select(Message).where(
+                Message.group_id == chat_id, Message.user_id == user_id
+            ).order_by(Message.created_at.asc())).scalars().all()
+
+        def unbounded_chats():
+            return session.execute(select(Chat).where(
+                Chat.user_id == users[0]
+            ).order_by(Chat.created_at.desc())).scalars().all()
+
+        page = pagination.PageParams()
+        deep_page = pagination.PageParams()
+
+        def history_page(params, chat_id="heavy", user_id=users[0]):
+            rows = session.execute(pagination.keyset(
+                select(Message).where(Message.group_id == chat_id, Message.user_id == user_id), Message, params
+            )).scalars().all()
+            session.expunge_all()
+            return pagination.page_rows(rows, params)
+
+        def chats_page():
+            rows = session.execute(pagination.keyset(select(Chat).where(Chat.user_id == users[0]), Chat, page)).scalars().all()
+            session.expunge_all()
+            return rows
+
+        def expunged(run):
+            def wrapped():
+                run()
+                session.expunge_all()
+            return wrapped
+
+        before = {
+            "heavy chat history": timed(expunged(lambda: unbounded_history("heavy", users[0]))),
+            "normal chat history": timed(expunged(lambda: unbounded_history("chat-1", users[1 % len(users)]))),
+            "chat list": timed(expunged(unbounded_chats)),
+        }
+
+        started = time.perf_counter()
+        with engine.begin() as migration:
+            for index in composite:
+                index.create(bind=migration)
+        migration_seconds = time.perf_counter() - started
+
+        # A cursor halfway through the heavy chat
+        cursor = None
+        for _ in range(heavy_chat_messages // 2 // page.limit):
+            deep_page.cursor = cursor
+            _, next_cursor = history_page(deep_page)
+            cursor = pagination.decode_cursor(next_cursor)
+        deep_page.cursor = cursor
+
+        after = {
+            "heavy chat history": timed(lambda: history_page(page)),
+            "normal chat history": timed(lambda: history_page(page, "chat-1", users[1 % len(users)])),
+            "chat list": timed(chats_page),
+        }
+        deep = timed(lambda: history_page(deep_page))
+        session.close()
+        engine.dispose()
+
+    print(f"creating the composite indexes: {migration_seconds:.1f}s")
+    print(f"{'':22} {'unbounded, no index':>20} {'keyset page, indexed':>22}")
+    for name in before:
+        print(f"{name:22} {before[name]:17.2f} ms {after[name]:19.2f} ms")
+    print(f"heavy chat, page {heavy_chat_messages // 2 // page.limit + 1} via cursor: {deep:.2f} ms (page size {page.limit})")
+
+
+def bench_message_documents(sizes=(50_000, 200_000, 1_000_000), messages_per_document=100, deletes=20):
+    """Deleting a document's messages: LIKE scan of the legacy column versus
+    seeks through the message_documents index, as the table grows."""
+    import sqlite3
+    import uuid
+    from sqlalchemy import create_engine
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    import database
+
+    print(f"{'messages':>10} {'backfill':>10} {'LIKE scan':>12} {'indexed':>12}  (ms per deleted document)")
+    for messages in sizes:
+        with tempfile.TemporaryDirectory() as path:
+            db_path = f"{path}/links.db"
+            engine = create_engine(f"sqlite:///{db_path}")
+            database.Base.metadata.create_all(bind=engine)
+            document_ids = [str(uuid.uuid4()) for _ in range(messages // messages_per_document)]
+
+            connection = sqlite3.connect(db_path)
+            connection.execute("INSERT INTO users (id, email) VALUES ('bench', 'bench@example.com')")
+            connection.execute("INSERT INTO message_groups (id, user_id, title) VALUES ('bench', 'bench', 'bench')")
+            connection.executemany(
+                "INSERT INTO messages (id, group_id, user_id, role, content, document_ids, created_at)"
+                " VALUES (?, 'bench', 'bench', 'user', 'message text', ?, '2024-01-01 00:00:00')",
+                ((str(uuid.uuid4()), ",".join(random.sample(document_ids, random.randint(1, 3)))) for _ in range(messages)),
+            )
+            connection.commit()
+
+            started = time.perf_counter()
+            for document_id in document_ids[:deletes]:
+                connection.execute("DELETE FROM messages WHERE document_ids LIKE ?", (f"%{document_id}%",))
+                connection.commit()
+            like_ms = (time.perf_counter() - started) / deletes * 1000
+            connection.close()
+
+            started = time.perf_counter()
+            database.backfill_message_documents(bind=engine)
+            backfill_seconds = time.perf_counter() - started
+            engine.dispose()
+
+            async def run():
+                links_engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+                sessions = async_sessionmaker(links_engine)
+                started = time.perf_counter()
+                for document_id in document_ids[deletes:2 * deletes]:
+                    async with sessions() as db:
+                        await database.delete_messages_for_document(db, document_id)
+                        await db.commit()
+                elapsed = (time.perf_counter() - started) / deletes * 1000
+                await links_engine.dispose()
+                return elapsed
+
+            index_ms = asyncio.run(run())
+        print(f"{messages:>10} {backfill_seconds:9.1f}s {like_ms:12.2f} {index_ms:12.2f}")
+
+
+def bench_turn_writes(clients=50, turns_per_client=20):
+    """Saving chat turns from concurrent clients: two commits per turn (the
+    old /chat), one transaction per turn, and the write-behind queue."""
+    from sqlalchemy import func, select
+    import config
+    import database
+    from turn_writer import TurnWriter
+
+    def turn(client, index):
+        return dict(
+            user_id="bench", group_id=f"chat-{client}", query=f"question {index}",
+            response="answer " * 50, message_id=None, document_ids=["doc-a", "doc-b"],
+        )
+
+    async def two_commits(SessionLocal, client, index):
+        arguments = turn(client, index)
+        async with SessionLocal() as db:
+            await asave_message(db, "bench", arguments["group_id"], arguments["query"], "user", None, arguments["document_ids"])
+            await asave_message(db, "bench", arguments["group_id"], arguments["response"], "assistant", None, arguments["document_ids"])
+
+    async def one_transaction(SessionLocal, client, index):
+        async with SessionLocal() as db:
+            await database.asave_turn(db, **turn(client, index))
+
+    async def run(path, mode):
+        SessionLocal, async_engine = make_async_sessionmaker(path)
+        writer = None
+        if mode == "write-behind":
+            writer = TurnWriter(session_factory=SessionLocal)
+            writer.start()
+        latencies = []
+
+        async def client(number):
+            for index in range(turns_per_client):
+                started = time.perf_counter()
+                if mode == "two commits":
+                    await two_commits(SessionLocal, number, index)
+                elif mode == "one transaction":
+                    await one_transaction(SessionLocal, number, index)
+                else:
+                    writer.submit(turn(number, index))
+                    await asyncio.sleep(0)
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[client(number) for number in range(clients)])
+        if writer is not None:
+            await writer.close()
+        elapsed = time.perf_counter() - started
+        async with SessionLocal() as db:
+            stored = (await db.execute(select(func.count()).select_from(database.Message))).scalar()
+        await async_engine.dispose()
+        latencies.sort()
+        return elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)], stored
+
+    total = clients * turns_per_client
+    original = config.SQLITE_SYNCHRONOUS
+    try:
+        for synchronous in ("FULL", "NORMAL"):
+            config.SQLITE_SYNCHRONOUS = synchronous
+            print(f"synchronous={synchronous}, {clients} clients x {turns_per_client} turns")
+            for mode in ("two commits", "one transaction", "write-behind"):
+                with tempfile.TemporaryDirectory() as path:
+                    elapsed, p50, p99, stored = asyncio.run(run(path, mode))
+                assert stored == 2 * total, stored
+                print(f"  {mode:16} {total / elapsed:8.0f} turns/s   request path p50 {p50 * 1000:7.2f} ms  p99 {p99 * 1000:7.2f} ms")
+    finally:
+        config.SQLITE_SYNCHRONOUS = original
+
+
+def bench_memory(turns=200, checkpoints=(10, 50, 100, 200), llm_latency=0.0):
+    """Prompt tokens spent on history: the full transcript versus recent
+    turns plus the rolling summary, as a chat grows."""
+    import database
+    import conversation_memory
+
+    words = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta"]
+    count_tokens = lambda text: len(text) // 4 + 1
+
+    class SummarizingLLM(StandInLLM):
+        async def ainvoke(self, messages):
+            await asyncio.sleep(self.latency)
+            return AIMessage(content=" ".join(random.choice(words) for _ in range(180)))
+
+    llm = SummarizingLLM(latency=llm_latency)
+
+    async def run(path):
+        SessionLocal, async_engine = make_async_sessionmaker(path)
+        async with SessionLocal() as db:
+            db.add(database.User(id="bench", email="bench@example.com"))
+            db.add(database.Chat(id="bench", user_id="bench", title="bench"))
+            await db.commit()
+
+        transcript_tokens = 0
+        fold_seconds = 0.0
+        rows = []
+        for turn in range(1, turns + 1):
+            question = " ".join(random.choice(words) for _ in range(30))
+            answer = " ".join(random.choice(words) for _ in range(150))
+            async with SessionLocal() as db:
+                history = await conversation_memory.load_history(db, "bench", "bench", count_tokens)
+                await database.asave_turn(db, "bench", "bench", question, answer, None, [])
+            memory_tokens = sum(count_tokens(message.content) for message in history)
+            if turn in checkpoints:
+                rows.append((turn, transcript_tokens, memory_tokens))
+            transcript_tokens += count_tokens(question) + count_tokens(answer)
+            started = time.perf_counter()
+            await conversation_memory.fold_old_messages("bench", "bench", llm, count_tokens, session_factory=SessionLocal)
+            fold_seconds += time.perf_counter() - started
+        await async_engine.dispose()
+        return rows, fold_seconds
+
+    with tempfile.TemporaryDirectory() as path:
+        rows, fold_seconds = asyncio.run(run(path))
+    print(f"{'turn':>6} {'full transcript':>16} {'memory':>8}  (history tokens in the prompt)")
+    for turn, transcript_tokens, memory_tokens in rows:
+        print(f"{turn:>6} {transcript_tokens:>16} {memory_tokens:>8}")
+    print(f"background summary updates: {fold_seconds / turns * 1000:.1f} ms per turn (LLM latency {llm_latency:.2f}s)")
+
+
+def bench_logging(chunk_count=100_000):
+    """Cost of per-chunk logging in the ingestion loop: the old two prints per
+    chunk versus leveled logging through the queue handler."""
+    import logging
+    import config
+    import logs
+    import pdf_processor
+    from pdf_processor import handleProcessDocuments
+
+    processor = handleProcessDocuments(
+        embedding_function=StandInEmbeddingFunction(),
+        chroma_client=chromadb.EphemeralClient(),
+        llm=StandInLLM(),
+        lexical_index=LexicalIndex(":memory:"),
+    )
+    chunks = make_chunks(chunk_count)
+
+    def records():
+        return processor._iter_chunk_records(chunks, "bench", "bench.pdf", "bench")
+
+    def old_prints(out):
+        # What save_text_to_chroma used to do for every chunk
+        for chunk_id, document, metadata in records():
+            print(f"Saving chunk from page {metadata['page']}: {document[:50]}...", file=out)
+            print("file_name:", type(metadata["source"]), "file_id:", type(metadata["pdf_id"]),
+                  "page_num:", type(metadata["page"]), "current_user_id:", type(metadata["current_user_id"]), file=out)
+
+    def drain():
+        for _ in records():
+            pass
+
+    def best_of(run, repeats=3):
+        timings = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - started)
+        return min(timings)
+
+    results = []
+    with tempfile.TemporaryDirectory() as path:
+        # Line buffered, like a terminal or a container log pipe
+        with open(f"{path}/stdout.log", "w", buffering=1) as out:
+            logs.configure(stream=out, level="WARNING")
+            baseline = best_of(drain)
+            results.append(("print per chunk", best_of(lambda: old_prints(out))))
+            for label, level, every in (
+                ("logging, INFO", "INFO", config.LOG_CHUNK_SAMPLE_EVERY),
+                (f"logging, DEBUG 1/{config.LOG_CHUNK_SAMPLE_EVERY}", "DEBUG", config.LOG_CHUNK_SAMPLE_EVERY),
+                ("logging, DEBUG every chunk", "DEBUG", 1),
+            ):
+                logs.configure(stream=out, level=level)
+                pdf_processor._chunk_sample = logs.Sampler(every)
+                results.append((label, best_of(drain)))
+            logs.shutdown()
+
+    pdf_processor._chunk_sample = logs.Sampler(config.LOG_CHUNK_SAMPLE_EVERY)
+    logs.configure()
+    print(f"{chunk_count} chunks through the ingestion record loop")
+    print(f"  {'no logging':28} {baseline:7.3f}s")
+    for label, elapsed in results:
+        print(f"  {label:28} {elapsed:7.3f}s  (+{(elapsed - baseline) / chunk_count * 1e6:6.2f} us/chunk)")
+
+
+def bench_metrics(operations=1_000_000, threads=8, series=200):
+    """Cost of recording metrics: per-call overhead of each recording path,
+    under thread contention, and of rendering /metrics."""
+    import concurrent.futures
+    import metrics
+
+    counter = metrics.Counter("bench_total", "bench")
+    gauge = metrics.Gauge("bench_in_flight", "bench")
+    histogram = metrics.Histogram("bench_seconds", "bench")
+    family = metrics.Family(metrics.Histogram, "bench_stage_seconds", "bench", ("stage",))
+    child = family.labels(stage="embed")
+
+    def loop():
+        for _ in range(operations):
+            pass
+
+    def timed_block():
+        for _ in range(operations):
+            with child.time():
+                pass
+
+    def tracked_block():
+        for _ in range(operations):
+            with gauge.track():
+                pass
+
+    def iterate():
+        for _ in timed_iter(range(operations), child):
+            pass
+
+    def per_call(run):
+        started = time.perf_counter()
+        run()
+        return time.perf_counter() - started
+
+    baseline = per_call(loop)
+    cases = [
+        ("counter.inc()", lambda: [counter.inc() for _ in range(operations)]),
+        ("histogram.observe()", lambda: [histogram.observe(0.01) for _ in range(operations)]),
+        ("labels(...).observe()", lambda: [family.labels(stage="embed").observe(0.01) for _ in range(operations)]),
+        ("with histogram.time()", timed_block),
+        ("with gauge.track()", tracked_block),
+        ("timed_iter per item", iterate),
+    ]
+    print(f"{operations} operations, single thread")
+    for label, run in cases:
+        elapsed = per_call(run) - baseline
+        print(f"  {label:24} {elapsed / operations * 1e9:7.0f} ns/op")
+
+    per_thread = operations // threads
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        started = time.perf_counter()
+        list(executor.map(lambda _: [child.observe(0.01) for _ in range(per_thread)], range(threads)))
+        elapsed = time.perf_counter() - started
+    print(f"  {f'observe(), {threads} threads':24} {elapsed / (per_thread * threads) * 1e9:7.0f} ns/op (wall clock)")
+
+    for index in range(series):
+        family.labels(stage=f"stage{index}").observe(index / series)
+    started = time.perf_counter()
+    text = family.render()
+    elapsed = time.perf_counter() - started
+    print(f"rendering {series} histogram series ({len(text)} lines): {elapsed * 1000:.2f} ms")
+
+
+def bench_tracing(spans=100_000, pages=200):
+    """Cost of a span with tracing off, sampled out and exported to memory,
+    and the end-to-end cost on ingesting a synthetic PDF."""
+    import tracing
+    from pdf_processor import handleProcessDocuments
+
+    def per_span():
+        started = time.perf_counter()
+        for index in range(spans):
+            with tracing.span("bench", page=index):
+                pass
+        return (time.perf_counter() - started) / spans
+
+    def ingest(pdf_path, file_id):
+        processor = handleProcessDocuments(
+            embedding_function=StandInEmbeddingFunction(round_trip=0, per_item=0),
+            chroma_client=chromadb.EphemeralClient(),
+            llm=StandInLLM(),
+            lexical_index=LexicalIndex(":memory:"),
+        )
+        started = time.perf_counter()
+        processor.save_text_to_chroma(
+            processor.iter_chunks(processor.iter_pages(pdf_path)), file_id=file_id, file_name="bench.pdf", current_user_id="bench"
+        )
+        return time.perf_counter() - started
+
+    modes = (("off", "none", 1.0), ("sampled out", "memory", 0.0), ("memory exporter", "memory", 1.0))
+    with tempfile.TemporaryDirectory() as path:
+        pdf_path = f"{path}/bench.pdf"
+        write_synthetic_pdf(pdf_path, pages=pages)
+        print(f"{'tracing':18} {'per span':>10} {f'ingest {pages} pages':>18}")
+        for index, (label, exporter, ratio) in enumerate(modes):
+            tracing.configure(exporter=exporter, sample_ratio=ratio)
+            span_cost = per_span()
+            if tracing.memory_exporter:
+                tracing.memory_exporter.clear()
+            elapsed = ingest(pdf_path, f"bench-{index}")
+            exported = len(tracing.memory_exporter.get_finished_spans()) if tracing.memory_exporter else 0
+            print(f"{label:18} {span_cost * 1e6:8.2f}us {elapsed:17.3f}s  ({exported} spans kept)")
+    tracing.configure()
+
+
+def bench_splitting(megabytes=8, workers=4):
+    """Splitting one multi-MB document: RecursiveCharacterTextSplitter, the
+    old split_text_concurrently (100 raw slices on threads), and the offset
+    splitter serially and on a warm process pool."""
+    import concurrent.futures
+    import multiprocessing
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    import config
+    from text_splitter import OffsetTextSplitter
+
+    words = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta", "of", "the"]
+    paragraphs = []
+    size = 0
+    while size < megabytes * 1_000_000:
+        lines = [" ".join(random.choice(words) for _ in range(random.randint(8, 14))) for _ in range(random.randint(1, 15))]
+        paragraphs.append("\n".join(lines))
+        size += len(paragraphs[-1]) + 2
+    text = "\n\n".join(paragraphs)
+
+    def old_split_text_concurrently(num_parts=100):
+        length = len(text)
+        parts = [text[i * length // num_parts:(i + 1) * length // num_parts] for i in range(num_parts)]
+        splitter = RecursiveCharacterTextSplitter(chunk_size=config.CHUNK_SIZE, chunk_overlap=config.CHUNK_OVERLAP)
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            results = list(executor.map(splitter.split_text, parts))
+        return [chunk for sublist in results for chunk in sublist]
+
+    def timed(run):
+        started = time.perf_counter()
+        chunks = run()
+        return time.perf_counter() - started, chunks
+
+    splitter = OffsetTextSplitter(config.CHUNK_SIZE, config.CHUNK_OVERLAP)
+    baseline, expected = timed(
+        lambda: RecursiveCharacterTextSplitter(chunk_size=config.CHUNK_SIZE, chunk_overlap=config.CHUNK_OVERLAP).split_text(text)
+    )
+    results = [
+        ("old split_text_concurrently", *timed(old_split_text_concurrently)),
+        ("offsets, serial", *timed(lambda: splitter.split_text(text))),
+    ]
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        # Start the workers before timing
+        list(executor.map(abs, range(workers)))
+        results.append((f"offsets, {workers} processes", *timed(
+            lambda: [text[start:end] for start, end in splitter.split_spans_parallel(text, executor, workers * 4)]
+        )))
+
+    print(f"{len(text) / 1e6:.1f} MB, {len(expected)} chunks, {os.cpu_count()} CPUs")
+    print(f"  {'RecursiveCharacterTextSplitter':32} {baseline:7.3f}s")
+    for label, elapsed, chunks in results:
+        print(f"  {label:32} {elapsed:7.3f}s  x{baseline / elapsed:4.1f}  same chunks: {chunks == expected}")
+
+
+def bench_text_store(pages=500, reads=10_000):
+    """The text store: size on disk against the raw text and the chunk texts
+    the vector store keeps, write time, and reading one page or chunk through
+    the memory map against decompressing the whole document."""
+    import config
+    from text_splitter import OffsetTextSplitter
+    from text_store import TextStore
+
+    words = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta", "of", "the", "and", "revenue"]
+    texts = []
+    for _ in range(pages):
+        paragraphs = [
+            "\n".join(" ".join(random.choice(words) for _ in range(random.randint(8, 14))) for _ in range(random.randint(2, 8)))
+            for _ in range(random.randint(3, 8))
+        ]
+        texts.append("\n\n".join(paragraphs))
+    splitter = OffsetTextSplitter(config.CHUNK_SIZE, config.CHUNK_OVERLAP)
+    spans = [splitter.split_spans(text) for text in texts]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = TextStore(tmp)
+        started = time.perf_counter()
+        with store.writer("bench") as writer:
+            for page, (text, page_spans) in enumerate(zip(texts, spans)):
+                writer.add_page(page, text)
+                for start, end in page_spans:
+                    writer.add_chunk(page, start, end)
+        write_time = time.perf_counter() - started
+
+        raw_bytes = sum(len(text.encode("utf-8")) for text in texts)
+        chunk_bytes = sum(len(text[start:end].encode("utf-8")) for text, page_spans in zip(texts, spans) for start, end in page_spans)
+        stored_bytes = os.path.getsize(store.path("bench"))
+
+        def per_read(run, count):
+            started = time.perf_counter()
+            for _ in range(count):
+                run()
+            return (time.perf_counter() - started) / count * 1e6
+
+        page_numbers = [random.randrange(pages) for _ in range(reads)]
+        with store.open("bench") as document:
+            chunk_numbers = [random.randrange(document.chunk_count) for _ in range(reads)]
+            pages_iter = iter(page_numbers)
+            page_read = per_read(lambda: document.page_text(next(pages_iter)), reads)
+            chunks_iter = iter(chunk_numbers)
+            chunk_read = per_read(lambda: document.chunk(next(chunks_iter)), reads)
+            chunk_count = document.chunk_count
+            same = document.pages() == texts
+        pages_iter = iter(page_numbers)
+        open_and_read = per_read(lambda: store.page_text("bench", next(pages_iter)), reads)
+        whole = per_read(lambda: store.pages("bench"), 20)
+
+    print(f"{pages} pages, {chunk_count} chunks, round trip intact: {same}")
+    print(f"  raw page text        {raw_bytes / 1e6:7.2f} MB")
+    print(f"  chunk texts          {chunk_bytes / 1e6:7.2f} MB")
+    print(f"  text store file      {stored_bytes / 1e6:7.2f} MB  ({raw_bytes / stored_bytes:.1f}x smaller than raw)")
+    print(f"  write                {write_time * 1000:7.1f} ms")
+    print(f"  page, open document  {page_read:7.1f} us")
+    print(f"  chunk, open document {chunk_read:7.1f} us")
+    print(f"  page, open + close   {open_and_read:7.1f} us")
+    print(f"  whole document       {whole:7.1f} us")
+
+
+BENCHMARKS = {
+    "ingestion": bench_ingestion,
+    "chat_concurrency": bench_chat_concurrency,
+    "processor_setup": bench_processor_setup,
+    "ingestion_memory": bench_ingestion_memory,
+    "extraction": bench_extraction,
+    "partitions": bench_partitions,
+    "migration": bench_migration,
+    "lexical": bench_lexical,
+    "embedding_backends": bench_embedding_backends,
+    "context": bench_context,
+    "summary": bench_summary,
+    "database": bench_database,
+    "pagination": bench_pagination,
+    "message_documents": bench_message_documents,
+    "turn_writes": bench_turn_writes,
+    "memory": bench_memory,
+    "logging": bench_logging,
+    "metrics": bench_metrics,
+    "tracing": bench_tracing,
+    "splitting": bench_splitting,
+    "text_store": bench_text_store,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f"== {name} ==")
+        BENCHMARKS[name]()
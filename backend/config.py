@@ -7,10 +7,120 @@ load_dotenv()
 # Configuration variables
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 CHROMA_DB_PATH = "chroma_db"
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./pdf_chat.db")
 TEMP_DIR = "temp"
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 PDF_COLLECTION_NAME = "pdf_documents"
+# "openai" or "local" (all-MiniLM-L6-v2 on onnxruntime, no network needed)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "openai")
 EMBEDDING_MODEL = "text-embedding-3-large"
+EMBEDDING_DIMENSIONS = None
 LLM_MODEL = "gpt-4-turbo"
 LLM_TEMPERATURE = 0.2
 CHUNK_SIZE = 500
 CHUNK_OVERLAP = 100
+# "characters" or "tokens" (of the embedding model) for CHUNK_SIZE/CHUNK_OVERLAP
+CHUNK_LENGTH_UNIT = os.getenv("CHUNK_LENGTH_UNIT", "characters")
+# Texts at least this long are split across the process pool
+SPLIT_PARALLEL_MIN_CHARS = 2_000_000
+SPLIT_WORKERS = None  # None: one per CPU
+
+# Logging: LOG_FORMAT is "text" or "json"; per-chunk debug events are
+# sampled, one in LOG_CHUNK_SAMPLE_EVERY
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_CHUNK_SAMPLE_EVERY = 100
+
+# Tracing: TRACE_EXPORTER is "none", "console", "otlp" or "memory"; the OTLP
+# endpoint comes from the standard OTEL_EXPORTER_OTLP_ENDPOINT
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none")
+TRACE_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "chatwithpdf")
+TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", "1.0"))
+
+# Database pool and SQLite tuning
+DB_POOL_SIZE = 10
+DB_MAX_OVERFLOW = 20
+DB_POOL_TIMEOUT = 30
+DB_POOL_RECYCLE = 1800
+SQLITE_SYNCHRONOUS = "NORMAL"
+SQLITE_BUSY_TIMEOUT_MS = 5000
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+
+# Keyset pagination of the list endpoints
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+# Ingestion batching
+EMBED_BATCH_SIZE = 64
+EMBED_BATCH_MAX_TOKENS = 50000
+EMBED_MAX_IN_FLIGHT = 4
+LOCAL_EMBED_BATCH_SIZE = 32
+LOCAL_EMBED_WORKERS = 2
+
+# Background ingestion jobs
+INGESTION_MAX_WORKERS = 2
+
+# Map-reduce document summaries, run after ingestion
+SUMMARY_WORKERS = 1
+SUMMARY_MAX_CONCURRENCY = 4
+SUMMARY_GROUP_TOKENS = 3000
+SUMMARY_REDUCE_FANOUT = 5
+
+# Chat path
+VECTOR_QUERY_WORKERS = 8
+
+# Chat turn persistence. With write-behind on, finished turns are queued and
+# group-committed in the background instead of on the request path
+CHAT_WRITE_BEHIND = os.getenv("CHAT_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+WRITE_BEHIND_BATCH_SIZE = 100
+WRITE_BEHIND_MAX_DELAY_MS = 50
+
+# Conversation memory: the last MEMORY_RECENT_TURNS turns verbatim plus a
+# running summary of everything older, so history costs a bounded number of
+# prompt tokens however long the chat gets
+MEMORY_RECENT_TURNS = 3
+MEMORY_MESSAGE_TOKENS = 300
+MEMORY_SUMMARY_TOKENS = 400
+MEMORY_FOLD_BATCH = 20
+
+# Per-document vector partitions
+PARTITION_QUERY_WORKERS = 8
+PARTITION_HANDLE_CACHE_SIZE = 1024
+
+# Lexical (BM25) retrieval fused with vector search
+LEXICAL_INDEX_PATH = f"{CHROMA_DB_PATH}_lexical.db"
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60
+HYBRID_CANDIDATES = 20
+LEXICAL_FASTPATH_MAX_TERMS = 4
+
+# Extracted page text kept per document (see text_store)
+TEXT_STORE_PATH = "text_store"
+TEXT_STORE_COMPRESSION_LEVEL = 3
+
+# Prompt context assembled from retrieved chunks
+CONTEXT_CANDIDATES = 8
+CONTEXT_TOKEN_BUDGET = 500
+CONTEXT_DUPLICATE_SIMILARITY = 0.9
+
+# Pooled OpenAI HTTP connections
+OPENAI_MAX_CONNECTIONS = 20
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = 10
+OPENAI_KEEPALIVE_EXPIRY = 30.0
+OPENAI_TIMEOUT = 60.0
+
+# Local embedding cache
+EMBEDDING_CACHE_PATH = "embedding_cache.db"
+EMBEDDING_CACHE_MAX_ENTRIES = 200000
+
+# Retrieval and answer caches
+RETRIEVAL_CACHE_TTL = 3600
+RETRIEVAL_CACHE_MAX_ENTRIES = 10000
+ANSWER_CACHE_TTL = 3600
+ANSWER_CACHE_MAX_ENTRIES = 5000
+
+# Parallel page extraction; EXTRACT_WORKERS = 0 uses every CPU
+EXTRACT_WORKERS = 0
+EXTRACT_PARALLEL_MIN_PAGES = 50
+EXTRACT_PAGES_PER_TASK = 20
@@ -0,0 +1,178 @@
+"""Assemble retrieved chunks into a prompt context under a token budget.
+
+Retrieval returns more candidates than fit. Chunks that repeat text already
+taken are dropped, neighbouring chunks of the same page are stitched together
+through their shared overlap, and the result is filled into the budget in
+relevance order.
+"""
+import re
+import config
+import metrics
+
+CONTEXT_TOKENS = metrics.histogram(
+    "context_tokens", "Prompt tokens used by retrieved context",
+    buckets=(100, 250, 500, 1000, 2000, 4000, 8000),
+)
+CONTEXT_TOKENS_SAVED = metrics.counter(
+    "context_tokens_saved_total", "Prompt tokens removed from retrieved context by dedup, merging and the budget"
+)
+
+# Shortest shared edge treated as chunk overlap rather than coincidence
+MIN_OVERLAP_CHARS = 20
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def format_section(document_name, page, text):
+    return f"[Document: {document_name}, Page: {page}]\n{text}"
+
+
+def _overlap(head, tail):
+    """Length of the longest suffix of head that is a prefix of tail."""
+    longest = min(len(head), len(tail))
+    if config.CHUNK_LENGTH_UNIT == "characters":
+        longest = min(longest, config.CHUNK_OVERLAP)
+    # Otherwise CHUNK_OVERLAP counts tokens and only the chunks bound it
+    if longest < MIN_OVERLAP_CHARS:
+        return 0
+    # Only places where tail's opening recurs near the end of head can start an overlap
+    prefix = tail[:MIN_OVERLAP_CHARS]
+    start = len(head) - longest
+    while True:
+        start = head.find(prefix, start)
+        if start == -1:
+            return 0
+        if head.endswith(tail[:len(head) - start]):
+            return len(head) - start
+        start += 1
+
+
+def _absorb(text, other):
+    """Join two chunks of one page if one continues or contains the other."""
+    if other in text:
+        return text
+    if text in other:
+        return other
+    length = _overlap(text, other)
+    if length:
+        return text + other[length:]
+    length = _overlap(other, text)
+    if length:
+        return other + text[length:]
+    return None
+
+
+def join_chunks(texts):
+    """Concatenate consecutive chunks, dropping the overlap each repeats."""
+    joined = ""
+    for text in texts:
+        text = text.strip()
+        if not joined:
+            joined = text
+            continue
+        length = _overlap(joined, text)
+        joined = joined + text[length:] if length else f"{joined}\n{text}"
+    return joined
+
+
+def _shingles(text, size=3):
+    words = _WORD_RE.findall(text.lower())
+    return {tuple(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+
+def _similarity(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class _Section:
+    def __init__(self, key, document_name, page, text):
+        self.key = key
+        self.document_name = document_name
+        self.page = page
+        self.text = text
+        self.shingles = _shingles(text)
+
+    def format(self):
+        return format_section(self.document_name, self.page, self.text)
+
+
+def build_context(hits, count_tokens, budget=None, document_names=None):
+    """Build the context string from (document, metadata) hits in relevance order.
+
+    document_names maps pdf_id to the name to show for it; chunks shared by
+    identical uploads carry the name of whichever upload indexed them.
+    Returns (text, stats), where stats has the raw and final token counts and
+    how many of the hits made it in.
+    """
+    budget = budget or config.CONTEXT_TOKEN_BUDGET
+    document_names = document_names or {}
+
+    def name(metadata):
+        return document_names.get(metadata.get("pdf_id")) or metadata.get("document_name", "Unknown")
+
+    raw_tokens = count_tokens("\n\n".join(
+        format_section(name(metadata), metadata.get("page", "Unknown"), document)
+        for document, metadata in hits
+    )) if hits else 0
+
+    sections = []
+    for document, metadata in hits:
+        text = (document or "").strip()
+        if not text:
+            continue
+        key = (metadata.get("pdf_id") or metadata.get("document_name"), metadata.get("page"))
+
+        merged = None
+        for section in sections:
+            if section.key == key:
+                joined = _absorb(section.text, text)
+                if joined is not None:
+                    merged = section
+                    section.text = joined
+                    break
+        if merged is None:
+            shingles = _shingles(text)
+            if any(_similarity(shingles, section.shingles) >= config.CONTEXT_DUPLICATE_SIMILARITY for section in sections):
+                continue
+            sections.append(_Section(key, name(metadata), metadata.get("page", "Unknown"), text))
+            continue
+
+        # The grown section may now bridge to another section of the same page
+        for section in list(sections):
+            if section is not merged and section.key == key:
+                joined = _absorb(merged.text, section.text)
+                if joined is not None:
+                    merged.text = joined
+                    sections.remove(section)
+        merged.shingles = _shingles(merged.text)
+
+    # Fill the budget in relevance order; a section that doesn't fit is
+    # skipped so a shorter, less relevant one can still use the space
+    chosen = []
+    used = 0
+    for section in sections:
+        tokens = count_tokens(section.format())
+        if used + tokens <= budget:
+            chosen.append(section)
+            used += tokens
+        elif not chosen:
+            # Never return an empty context because the best hit is too long
+            while section.text and count_tokens(section.format()) > budget:
+                section.text = section.text[:int(len(section.text) * 0.9)]
+            if section.text:
+                chosen.append(section)
+                used = count_tokens(section.format())
+
+    text = "\n\n".join(section.format() for section in chosen)
+    context_tokens = count_tokens(text) if text else 0
+    CONTEXT_TOKENS.observe(context_tokens)
+    CONTEXT_TOKENS_SAVED.inc(max(raw_tokens - context_tokens, 0))
+    return text, {
+        "hits": len(hits),
+        "sections": len(chosen),
+        "raw_tokens": raw_tokens,
+        "context_tokens": context_tokens,
+        "tokens_saved": raw_tokens - context_tokens,
+    }
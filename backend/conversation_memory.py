@@ -0,0 +1,178 @@
+"""Per-chat conversation memory for the chat prompts.
+
+A prompt carries the chat's last MEMORY_RECENT_TURNS turns verbatim, each
+message clipped to MEMORY_MESSAGE_TOKENS, and a running summary of every
+older message clipped to MEMORY_SUMMARY_TOKENS, so history costs the same
+number of tokens on the tenth turn as on the thousandth. After each answer
+the summary is brought up to date in the background by folding in the
+messages that have left the recent window, MEMORY_FOLD_BATCH at a time.
+"""
+import asyncio
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from sqlalchemy import select, tuple_
+import config
+import database
+import logs
+import metrics
+import turn_writer
+
+logger = logs.get_logger(__name__)
+
+HISTORY_TOKENS = metrics.histogram(
+    "chat_history_tokens", "Prompt tokens spent on conversation history",
+    buckets=(0, 100, 250, 500, 1000, 2000, 4000, 8000),
+)
+MEMORY_UPDATES = metrics.counter("chat_memory_updates_total", "Batches of old messages folded into conversation summaries")
+
+FOLD_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an "
+    "assistant about their documents. Update the current summary with the new "
+    "messages. Keep facts, names, figures, decisions and open questions the "
+    "user may refer back to; drop small talk. Reply with the updated summary "
+    f"only, in at most {config.MEMORY_SUMMARY_TOKENS // 2} words."
+)
+
+_refreshes = {}
+_rerun = set()
+
+
+def clip_tokens(text, max_tokens, count_tokens):
+    """Cut text down to at most max_tokens."""
+    tokens = count_tokens(text)
+    while text and tokens > max_tokens:
+        text = text[:int(len(text) * max_tokens / tokens * 0.95)]
+        tokens = count_tokens(text)
+    return text
+
+
+def _chat_messages(chat_id, user_id):
+    Message = database.Message
+    return (
+        Message.group_id == chat_id,
+        Message.user_id == user_id,
+        # Ingestion leaves an empty placeholder message
+        Message.content != "",
+    )
+
+
+def _recent_statement(chat_id, user_id):
+    Message = database.Message
+    return select(Message.id, Message.role, Message.content, Message.created_at).where(
+        *_chat_messages(chat_id, user_id)
+    ).order_by(Message.created_at.desc(), Message.id.desc()).limit(2 * config.MEMORY_RECENT_TURNS)
+
+
+def history_messages(summary, messages, count_tokens):
+    """Prompt messages for a summary and (role, content) pairs, oldest first."""
+    history = []
+    if summary:
+        summary = clip_tokens(summary, config.MEMORY_SUMMARY_TOKENS, count_tokens)
+        history.append(SystemMessage(content=f"Summary of the earlier conversation:\n{summary}"))
+    for role, content in messages:
+        content = clip_tokens(content, config.MEMORY_MESSAGE_TOKENS, count_tokens)
+        history.append(HumanMessage(content=content) if role == "user" else AIMessage(content=content))
+    return history
+
+
+async def load_history(db, chat_id, user_id, count_tokens, fallback=None):
+    """History prompt messages for a chat.
+
+    fallback is the chat_history sent with the request; it is only used when
+    the chat has nothing stored, e.g. a conversation the client kept itself.
+    """
+    summary = ""
+    messages = []
+    if chat_id:
+        await turn_writer.wait_for_chat(chat_id)
+        rows = (await db.execute(_recent_statement(chat_id, user_id))).all()
+        memory = await db.get(database.ChatMemory, chat_id)
+        summary = memory.summary if memory else ""
+        messages = [(row.role, row.content) for row in reversed(rows)]
+    if not summary and not messages and fallback:
+        for item in fallback[-config.MEMORY_RECENT_TURNS:]:
+            messages.extend([("user", item.query), ("assistant", item.response)])
+
+    history = history_messages(summary, messages, count_tokens)
+    HISTORY_TOKENS.observe(sum(count_tokens(message.content) for message in history))
+    return history
+
+
+async def fold_old_messages(chat_id, user_id, llm, count_tokens, session_factory=None):
+    """Fold messages that have left the recent window into the chat's summary."""
+    Message = database.Message
+    await turn_writer.wait_for_chat(chat_id)
+    async with (session_factory or database.AsyncSessionLocal)() as db:
+        recent = (await db.execute(_recent_statement(chat_id, user_id))).all()
+        if len(recent) < 2 * config.MEMORY_RECENT_TURNS:
+            # Everything still fits verbatim
+            return
+        window_start = tuple_(recent[-1].created_at, recent[-1].id)
+        memory = await db.get(database.ChatMemory, chat_id)
+        if memory is None:
+            memory = database.ChatMemory(chat_id=chat_id, summary="")
+            db.add(memory)
+
+        while True:
+            key = tuple_(Message.created_at, Message.id)
+            statement = select(Message.id, Message.role, Message.content, Message.created_at).where(
+                *_chat_messages(chat_id, user_id), key < window_start
+            )
+            if memory.summarized_until is not None:
+                statement = statement.where(key > tuple_(memory.summarized_until, memory.summarized_message_id))
+            rows = (await db.execute(
+                statement.order_by(Message.created_at.asc(), Message.id.asc()).limit(config.MEMORY_FOLD_BATCH)
+            )).all()
+            if not rows:
+                break
+
+            transcript = "\n".join(
+                f"{'User' if row.role == 'user' else 'Assistant'}: "
+                f"{clip_tokens(row.content, config.MEMORY_MESSAGE_TOKENS, count_tokens)}"
+                for row in rows
+            )
+            response = await llm.ainvoke([
+                SystemMessage(content=FOLD_PROMPT),
+                HumanMessage(content=f"Current summary:\n{memory.summary or '(none yet)'}\n\nNew messages:\n{transcript}"),
+            ])
+            memory.summary = clip_tokens(response.content.strip(), config.MEMORY_SUMMARY_TOKENS, count_tokens)
+            memory.summarized_until = rows[-1].created_at
+            memory.summarized_message_id = rows[-1].id
+            await db.commit()
+            MEMORY_UPDATES.inc()
+
+
+async def _refresh(chat_id, user_id, llm, count_tokens):
+    try:
+        while True:
+            _rerun.discard(chat_id)
+            try:
+                await fold_old_messages(chat_id, user_id, llm, count_tokens)
+            except Exception:
+                logger.exception("Updating conversation memory failed", extra={"chat_id": chat_id})
+                break
+            if chat_id not in _rerun:
+                break
+    finally:
+        _refreshes.pop(chat_id, None)
+
+
+def schedule_refresh(chat_id, user_id, llm, count_tokens):
+    """Update the chat's summary in the background; one update per chat runs at a time."""
+    if not chat_id:
+        return
+    task = _refreshes.get(chat_id)
+    if task is not None and not task.done():
+        # The running update picks up the new turn when it finishes
+        _rerun.add(chat_id)
+        return
+    _refreshes[chat_id] = asyncio.create_task(_refresh(chat_id, user_id, llm, count_tokens))
+
+
+async def stop():
+    """Cancel pending updates; each batch is committed, so the next update resumes where they stopped."""
+    tasks = list(_refreshes.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _refreshes.clear()
+    _rerun.clear()
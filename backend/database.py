@@ -1,14 +1,69 @@
-from sqlalchemy import create_engine, Column, String, Text, DateTime, ForeignKey, Boolean, Enum
+from sqlalchemy import create_engine, Column, String, Text, DateTime, ForeignKey, Boolean, Enum, Integer, Index, inspect, text, event, select, update, delete
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, selectinload
 from uuid import uuid4
 import datetime
 import enum
+import config
+import logs
 
-DATABASE_URL = "sqlite:///./pdf_chat.db"
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+DATABASE_URL = config.DATABASE_URL
+
+logger = logs.get_logger(__name__)
+
+
+def async_database_url(url):
+    """The same database through its async driver (aiosqlite or asyncpg)."""
+    if url.startswith("sqlite:"):
+        return url.replace("sqlite:", "sqlite+aiosqlite:", 1)
+    if url.startswith("postgresql:") or url.startswith("postgres:"):
+        return "postgresql+asyncpg:" + url.split(":", 1)[1]
+    return url
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run alongside the single writer; busy_timeout makes a
+    # blocked writer wait instead of failing with "database is locked"
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA synchronous={config.SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={int(config.SQLITE_BUSY_TIMEOUT_MS)}")
+    cursor.execute(f"PRAGMA mmap_size={int(config.SQLITE_MMAP_SIZE)}")
+    cursor.close()
+
+
+def _engine_options(url):
+    options = {
+        "pool_size": config.DB_POOL_SIZE,
+        "max_overflow": config.DB_MAX_OVERFLOW,
+        "pool_timeout": config.DB_POOL_TIMEOUT,
+    }
+    if url.startswith("sqlite"):
+        options["connect_args"] = {"timeout": config.SQLITE_BUSY_TIMEOUT_MS / 1000}
+        if not url.startswith("sqlite+aiosqlite"):
+            options["connect_args"]["check_same_thread"] = False
+    else:
+        options["pool_recycle"] = config.DB_POOL_RECYCLE
+        options["pool_pre_ping"] = True
+    return options
+
+
+def create_engines(url):
+    """Build the sync engine (ingestion workers, migrations) and the async engine (endpoints)."""
+    sync_engine = create_engine(url, **_engine_options(url))
+    async_url = async_database_url(url)
+    async_engine = create_async_engine(async_url, **_engine_options(async_url))
+    if url.startswith("sqlite"):
+        event.listen(sync_engine, "connect", _set_sqlite_pragmas)
+        event.listen(async_engine.sync_engine, "connect", _set_sqlite_pragmas)
+    return sync_engine, async_engine
+
+
+engine, async_engine = create_engines(DATABASE_URL)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 def create_unique_id():
@@ -40,6 +95,10 @@ class Chat(Base):
     messages = relationship("Message", back_populates="chat", cascade="all, delete-orphan")
     documents = relationship("Document", back_populates="chat", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        Index("ix_message_groups_user_created", "user_id", "created_at", "id"),
+    )
+
 class Message(Base):
     __tablename__ = "messages"
 
@@ -49,12 +108,29 @@ class Message(Base):
     user_id = Column(String, ForeignKey("users.id"), nullable=False)
     role = Column(String, nullable=False)
     content = Column(Text, nullable=False)
+    # Legacy comma-joined ids, moved into message_documents by backfill_message_documents
     document_ids = Column(Text)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     
 
     chat = relationship("Chat", back_populates="messages")
     user = relationship("User", backref="messages")
+    document_links = relationship(
+        "MessageDocument", order_by="MessageDocument.position", cascade="all, delete-orphan"
+    )
+
+    __table_args__ = (
+        Index("ix_messages_group_user_created", "group_id", "user_id", "created_at", "id"),
+    )
+
+class MessageDocument(Base):
+    """A document a message was asked about or answered from."""
+    __tablename__ = "message_documents"
+
+    message_id = Column(String, ForeignKey("messages.id"), primary_key=True)
+    # Not a foreign key: messages may name documents that were never stored
+    document_id = Column(String, primary_key=True, index=True)
+    position = Column(Integer, nullable=False, default=0)
 
 class Document(Base):
     __tablename__ = "documents"
@@ -67,17 +143,239 @@ class Document(Base):
     file_path = Column(String, nullable=False)
     file_size = Column(String)
     title = Column(String)
+    content_hash = Column(String, index=True)
+    # pdf_id of the chunks in the vector store; shared by identical uploads
+    vector_id = Column(String)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     
     chat = relationship("Chat", back_populates="documents")
     user = relationship("User", backref="documents")
 
+    __table_args__ = (
+        Index("ix_documents_user_created", "user_id", "created_at", "id"),
+        Index("ix_documents_chat_user_created", "chat_id", "user_id", "created_at", "id"),
+    )
+
+class ChatMemory(Base):
+    """Running summary of the part of a chat older than its recent turns."""
+    __tablename__ = "chat_memories"
+
+    chat_id = Column(String, ForeignKey("message_groups.id"), primary_key=True)
+    summary = Column(Text, nullable=False, default="")
+    # (created_at, id) of the last message folded into the summary
+    summarized_until = Column(DateTime)
+    summarized_message_id = Column(String)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+class IndexedContent(Base):
+    """A PDF already in the vector store, shared by every upload with the same content."""
+    __tablename__ = "indexed_contents"
+
+    content_hash = Column(String, primary_key=True)
+    vector_id = Column(String, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class IngestionJob(Base):
+    __tablename__ = "ingestion_jobs"
+
+    id = Column(String, primary_key=True, index=True, default=create_unique_id)
+    user_id = Column(String, ForeignKey("users.id"), nullable=False)
+    chat_id = Column(String, nullable=False)
+    document_id = Column(String, nullable=False)
+    filename = Column(String, nullable=False)
+    content_type = Column(String)
+    file_path = Column(String, nullable=False)
+    file_size = Column(String)
+    content_hash = Column(String)
+    generate_summary = Column(Boolean, default=False)
+    status = Column(String, nullable=False, default="queued", index=True)
+    stage = Column(String)
+    progress = Column(Integer, default=0)
+    error = Column(Text)
+    # None when no summary was requested, else pending/running/completed/failed
+    summary_status = Column(String)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
 def create_tables():
     Base.metadata.create_all(bind=engine)
+    run_migrations()
+    backfill_message_documents()
+
+def run_migrations():
+    """Add columns and indexes introduced after an existing database was created."""
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+            existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    logger.info("Creating index", extra={"index": index.name, "table": table.name})
+                    index.create(bind=connection)
+
+def backfill_message_documents(bind=None, batch_size=5000):
+    """Move ids from the legacy Message.document_ids column into message_documents.
+
+    Converted rows have the column cleared, so this only does work once.
+    """
+    moved = 0
+    last_id = ""
+    while True:
+        with (bind or engine).begin() as connection:
+            # Walk the primary key so each batch seeks past the previous one
+            rows = connection.execute(
+                select(Message.id, Message.document_ids)
+                .where(Message.id > last_id, Message.document_ids.isnot(None))
+                .order_by(Message.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            message_ids = [message_id for message_id, _ in rows]
+            last_id = message_ids[-1]
+            # Links already written for a message win over its legacy column
+            linked = set(connection.execute(
+                select(MessageDocument.message_id).where(MessageDocument.message_id.in_(message_ids))
+            ).scalars())
+            links = [
+                {"message_id": message_id, "document_id": document_id, "position": position}
+                for message_id, document_ids in rows if message_id not in linked
+                for position, document_id in enumerate(_split_document_ids(document_ids))
+            ]
+            if links:
+                connection.execute(MessageDocument.__table__.insert(), links)
+            connection.execute(
+                update(Message).where(Message.id.in_(message_ids)).values(document_ids=None)
+            )
+            moved += len(rows)
+    if moved:
+        logger.info("Moved message document ids into message_documents", extra={"messages": moved})
+    return moved
+
+def _split_document_ids(document_ids):
+    return list(dict.fromkeys(document_id for document_id in (document_ids or "").split(",") if document_id))
+
+def acquire_indexed_content(db, content_hash, vector_id):
+    """Register a reference to indexed content, returning the vector_id to use.
+
+    If the content is already indexed its existing vector_id is returned and the
+    caller's own vectors (if any) are redundant.
+    """
+    # One upsert, so two identical uploads finishing together can't both
+    # insert the hash; whichever lands first keeps its vector_id
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    statement = insert(IndexedContent).values(
+        content_hash=content_hash, vector_id=vector_id, ref_count=1, created_at=datetime.datetime.utcnow()
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[IndexedContent.content_hash],
+        set_={"ref_count": IndexedContent.ref_count + 1},
+    ).returning(IndexedContent.vector_id)
+    return db.execute(statement).scalar_one()
+
+async def release_indexed_content(db, content_hash):
+    """Drop a reference, returning the vector_id to delete once nothing uses it."""
+    await db.execute(
+        update(IndexedContent)
+        .where(IndexedContent.content_hash == content_hash)
+        .values(ref_count=IndexedContent.ref_count - 1)
+    )
+    content = (await db.execute(
+        select(IndexedContent).where(IndexedContent.content_hash == content_hash)
+    )).scalars().first()
+    if content and content.ref_count <= 0:
+        vector_id = content.vector_id
+        await db.delete(content)
+        return vector_id
+    return None
+
+def _new_message(user_id, group_id, content, sender, message_id, document_ids):
+    return Message(
+        id=message_id if message_id else None,
+        user_id=user_id,
+        group_id=group_id,
+        role=sender,
+        content=content,
+        document_links=[
+            MessageDocument(document_id=document_id, position=position)
+            for position, document_id in enumerate(dict.fromkeys(document_ids or []))
+        ]
+    )
+
+def with_document_ids(statement):
+    """Load each message's document links alongside it (needed on async sessions)."""
+    return statement.options(selectinload(Message.document_links))
+
+def message_document_ids(message):
+    return [link.document_id for link in message.document_links]
+
+async def delete_messages_for_document(db, document_id):
+    """Delete every message that references a document, found through the document_id index."""
+    linked = select(MessageDocument.message_id).where(MessageDocument.document_id == document_id)
+    # Summaries of the affected chats may quote the deleted messages; they are rebuilt
+    await db.execute(delete(ChatMemory).where(ChatMemory.chat_id.in_(
+        select(Message.group_id).where(Message.id.in_(linked))
+    )))
+    await db.execute(delete(Message).where(Message.id.in_(linked)))
+    # Then the links of those messages, including their links to other documents
+    await db.execute(delete(MessageDocument).where(MessageDocument.message_id.in_(linked)))
+
+def save_to_database(db, user_id, group_id, content, sender, message_id, document_ids):
+    """Save a message to the database."""
+    message = _new_message(user_id, group_id, content, sender, message_id, document_ids)
+    db.add(message)
+    db.commit()
+    return message
+
+def turn_messages(user_id, group_id, query, response, message_id, document_ids, created_at=None):
+    """The user and assistant messages of one chat turn.
+
+    Both get explicit timestamps so the answer always sorts after the
+    question, however late the turn is written.
+    """
+    created_at = created_at or datetime.datetime.utcnow()
+    question = _new_message(user_id, group_id, query, "user", None, document_ids)
+    question.created_at = created_at
+    answer = _new_message(user_id, group_id, response, "assistant", message_id, document_ids)
+    answer.created_at = created_at + datetime.timedelta(microseconds=1)
+    return [question, answer]
+
+async def asave_turn(db, user_id, group_id, query, response, message_id, document_ids, created_at=None):
+    """Save a question and its answer in one transaction."""
+    db.add_all(turn_messages(user_id, group_id, query, response, message_id, document_ids, created_at))
+    await db.commit()
+
+async def resolve_vector_ids(db, user_id, document_ids):
+    """Map document ids to the pdf_ids their chunks are stored under in Chroma.
+
+    Returns (pdf_ids, {pdf_id: this user's filename}); shared chunks carry
+    the filename of whoever uploaded the content first.
+    """
+    if not document_ids:
+        return document_ids, {}
+    rows = (await db.execute(
+        select(Document.id, Document.vector_id, Document.filename).where(
+            Document.id.in_(document_ids),
+            Document.user_id == user_id
+        )
+    )).all()
+    mapping = {document_id: vector_id or document_id for document_id, vector_id, _ in rows}
+    names = {}
+    for document_id, vector_id, filename in rows:
+        names.setdefault(vector_id or document_id, filename)
+    return list(dict.fromkeys(mapping.get(document_id, document_id) for document_id in document_ids)), names
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
@@ -0,0 +1,92 @@
+"""Embedding backends selectable with config.EMBEDDING_BACKEND.
+
+"openai" calls the OpenAI embeddings API. "local" runs all-MiniLM-L6-v2 on
+the onnxruntime that chromadb ships with, so ingestion keeps working when the
+API is slow or unreachable. Vectors from different models can't be compared,
+so every collection records the model that filled it.
+"""
+import concurrent.futures
+import openai
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+from chromadb.utils.embedding_functions import ONNXMiniLM_L6_V2, OpenAIEmbeddingFunction
+import config
+from embedding_cache import CachedEmbeddingFunction
+
+LOCAL_MODEL_NAME = ONNXMiniLM_L6_V2.MODEL_NAME
+
+# Collection metadata key holding the model that produced its vectors
+MODEL_RECORD_KEY = "embedding_model"
+# Collections created before the record existed were all filled by OpenAI
+LEGACY_MODEL_ID = "openai/text-embedding-3-large"
+
+
+class EmbeddingModelMismatchError(ValueError):
+    """Raised when vectors from one model would be searched or written with another."""
+
+
+def model_id(backend=None):
+    """Identifier recorded on collections, e.g. "openai/text-embedding-3-large"."""
+    backend = backend or config.EMBEDDING_BACKEND
+    if backend == "local":
+        return f"local/{LOCAL_MODEL_NAME}"
+    if backend == "openai":
+        suffix = f"@{config.EMBEDDING_DIMENSIONS}" if config.EMBEDDING_DIMENSIONS else ""
+        return f"openai/{config.EMBEDDING_MODEL}{suffix}"
+    raise ValueError(f"Unknown embedding backend: {backend}")
+
+
+def recorded_model_id(collection):
+    return (collection.metadata or {}).get(MODEL_RECORD_KEY, LEGACY_MODEL_ID)
+
+
+class LocalEmbeddingFunction(EmbeddingFunction[Documents]):
+    """all-MiniLM-L6-v2 on onnxruntime, with batches spread over a thread pool.
+
+    onnxruntime releases the GIL while running a session, so batches run in
+    parallel on a single shared model.
+    """
+
+    def __init__(self, batch_size=None, workers=None):
+        self.onnx = ONNXMiniLM_L6_V2(preferred_providers=["CPUExecutionProvider"])
+        self.batch_size = batch_size or config.LOCAL_EMBED_BATCH_SIZE
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers or config.LOCAL_EMBED_WORKERS,
+            thread_name_prefix="local-embed",
+        )
+
+    def __call__(self, input: Documents) -> Embeddings:
+        batches = [input[start:start + self.batch_size] for start in range(0, len(input), self.batch_size)]
+        if not batches:
+            return []
+        # The first batch runs here so the model is loaded once before fanning out
+        embeddings = list(self.onnx(batches[0]))
+        for batch_embeddings in self.executor.map(self.onnx, batches[1:]):
+            embeddings.extend(batch_embeddings)
+        return embeddings
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def create_embedding_function(http_client=None, backend=None):
+    """Build the configured backend behind the on-disk embedding cache."""
+    backend = backend or config.EMBEDDING_BACKEND
+    if backend == "local":
+        return CachedEmbeddingFunction(LocalEmbeddingFunction(), model=LOCAL_MODEL_NAME)
+    if backend == "openai":
+        embedding_function = OpenAIEmbeddingFunction(
+            model_name=config.EMBEDDING_MODEL,
+            api_key=config.OPENAI_API_KEY,
+            organization_id=None,
+            dimensions=config.EMBEDDING_DIMENSIONS
+        )
+        embedding_function.client = openai.OpenAI(
+            api_key=config.OPENAI_API_KEY,
+            http_client=http_client
+        )
+        return CachedEmbeddingFunction(
+            embedding_function,
+            model=config.EMBEDDING_MODEL,
+            dimensions=config.EMBEDDING_DIMENSIONS
+        )
+    raise ValueError(f"Unknown embedding backend: {backend}")
@@ -0,0 +1,147 @@
+"""On-disk cache in front of an embedding function.
+
+Vectors are keyed by (model, dimensions, sha256(text)) and kept in a local
+SQLite file. When the cache grows past its entry limit the least recently
+used vectors are evicted.
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+import numpy as np
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+import config
+import metrics
+
+CACHE_HITS = metrics.counter("embedding_cache_hits_total", "Embeddings served from the local cache")
+CACHE_MISSES = metrics.counter("embedding_cache_misses_total", "Embeddings that had to be computed")
+
+# Evict in bulk so we don't pay for a DELETE on every insert
+EVICTION_SLACK = 0.05
+
+
+class EmbeddingStore:
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL,"
+            " dimensions INTEGER NOT NULL,"
+            " text_hash TEXT NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " last_access REAL NOT NULL,"
+            " PRIMARY KEY (model, dimensions, text_hash))"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS ix_embeddings_last_access ON embeddings (last_access)"
+        )
+        self._connection.commit()
+        self._size = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def get_many(self, model, dimensions, text_hashes):
+        """Return {text_hash: vector} for the hashes present, marking them as used."""
+        if not text_hashes:
+            return {}
+        found = {}
+        now = time.time()
+        with self._lock:
+            # Stay well under SQLite's bound-parameter limit
+            for start in range(0, len(text_hashes), 500):
+                batch = text_hashes[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._connection.execute(
+                    f"SELECT text_hash, vector FROM embeddings"
+                    f" WHERE model = ? AND dimensions = ? AND text_hash IN ({placeholders})",
+                    [model, dimensions, *batch],
+                ).fetchall()
+                for text_hash, vector in rows:
+                    found[text_hash] = np.frombuffer(vector, dtype=np.float32)
+            if found:
+                self._connection.executemany(
+                    "UPDATE embeddings SET last_access = ?"
+                    " WHERE model = ? AND dimensions = ? AND text_hash = ?",
+                    [(now, model, dimensions, text_hash) for text_hash in found],
+                )
+                self._connection.commit()
+        return found
+
+    def put_many(self, model, dimensions, items):
+        """Store (text_hash, vector) pairs, evicting the least recently used if full."""
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.executemany(
+                "INSERT OR IGNORE INTO embeddings (model, dimensions, text_hash, vector, last_access)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [
+                    (model, dimensions, text_hash, np.asarray(vector, dtype=np.float32).tobytes(), now)
+                    for text_hash, vector in items
+                ],
+            )
+            self._size += max(cursor.rowcount, 0)
+            if self._size > self.max_entries:
+                evict = self._size - int(self.max_entries * (1 - EVICTION_SLACK))
+                self._connection.execute(
+                    "DELETE FROM embeddings WHERE rowid IN"
+                    " (SELECT rowid FROM embeddings ORDER BY last_access LIMIT ?)",
+                    (evict,),
+                )
+                self._size = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class CachedEmbeddingFunction(EmbeddingFunction[Documents]):
+    """Embedding function that only calls the wrapped one for texts it hasn't seen."""
+
+    def __init__(self, embedding_function, model, dimensions=None, path=None, max_entries=None):
+        self.embedding_function = embedding_function
+        self.model = model
+        # 0 stands for the model's default dimensionality
+        self.dimensions = dimensions or 0
+        self.store = EmbeddingStore(
+            path or config.EMBEDDING_CACHE_PATH,
+            max_entries or config.EMBEDDING_CACHE_MAX_ENTRIES,
+        )
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def text_hash(text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def __call__(self, input: Documents) -> Embeddings:
+        hashes = [self.text_hash(text) for text in input]
+        vectors = self.store.get_many(self.model, self.dimensions, list(set(hashes)))
+
+        # Embed each distinct missing text once, even if repeated in the batch
+        missing = {}
+        for text_hash, text in zip(hashes, input):
+            if text_hash not in vectors and text_hash not in missing:
+                missing[text_hash] = text
+        hit_count = len(input) - sum(1 for text_hash in hashes if text_hash in missing)
+        self.hits += hit_count
+        self.misses += len(input) - hit_count
+        CACHE_HITS.inc(hit_count)
+        CACHE_MISSES.inc(len(input) - hit_count)
+
+        if missing:
+            embeddings = self.embedding_function(list(missing.values()))
+            computed = list(zip(missing.keys(), embeddings))
+            self.store.put_many(self.model, self.dimensions, computed)
+            for text_hash, vector in computed:
+                vectors[text_hash] = np.asarray(vector, dtype=np.float32)
+
+        return [vectors[text_hash] for text_hash in hashes]
+
+    def close(self):
+        self.store.close()
+        close = getattr(self.embedding_function, "close", None)
+        if close:
+            close()
@@ -0,0 +1,351 @@
+import os
+import time
+import concurrent.futures
+import threading
+import config
+import database
+import logs
+import metrics
+import tracing
+from pdf_processor import get_processor
+
+# Percent range covered by each ingestion stage. Splitting happens inside the
+# streaming embed stage, page by page. Summaries are written afterwards and
+# tracked separately in summary_status.
+STAGE_RANGES = {
+    "extract": (0, 10),
+    "embed": (10, 100),
+}
+
+logger = logs.get_logger(__name__)
+
+BACKGROUND_JOBS = metrics.gauge(
+    "background_jobs", "Ingestion and summary jobs waiting for or running on a worker", labelnames=("kind", "state")
+)
+
+ACTIVE_STATUSES = ("queued", "running")
+ACTIVE_SUMMARY_STATUSES = ("pending", "running")
+
+_executor = None
+_summary_executor = None
+_loop = None
+_executor_lock = threading.Lock()
+
+
+def start_workers(loop=None):
+    """Start the ingestion and summary pools and pick up work left over from a previous run.
+
+    Summaries run their LLM calls on loop, the app's event loop, if given.
+    """
+    global _executor, _summary_executor, _loop
+    _loop = loop
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=config.INGESTION_MAX_WORKERS,
+                thread_name_prefix="ingestion",
+            )
+        if _summary_executor is None:
+            _summary_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=config.SUMMARY_WORKERS,
+                thread_name_prefix="summary",
+            )
+    resume_jobs()
+
+
+def shutdown_workers(wait=True):
+    global _executor, _summary_executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=wait, cancel_futures=True)
+            _executor = None
+        if _summary_executor is not None:
+            _summary_executor.shutdown(wait=wait, cancel_futures=True)
+            _summary_executor = None
+
+
+async def create_job(db, user_id, chat_id, document_id, filename, content_type, file_path, file_size, content_hash, generate_summary):
+    job = database.IngestionJob(
+        user_id=user_id,
+        chat_id=chat_id,
+        document_id=document_id,
+        filename=filename,
+        content_type=content_type,
+        file_path=file_path,
+        file_size=file_size,
+        content_hash=content_hash,
+        generate_summary=generate_summary,
+        status="queued",
+        stage="extract",
+        progress=0,
+    )
+    db.add(job)
+    if generate_summary:
+        # The client opens the new chat straight away, so it exists from the
+        # start; its title and first message come from the summary
+        db.add(database.Chat(id=chat_id, user_id=user_id, title='New Chat'))
+    await db.commit()
+    await db.refresh(job)
+    return job
+
+
+def _submit(executor, kind, run, job_id):
+    """Submit run(job_id), keeping the background_jobs gauges up to date."""
+    queued = BACKGROUND_JOBS.labels(kind=kind, state="queued")
+    running = BACKGROUND_JOBS.labels(kind=kind, state="running")
+
+    def tracked():
+        queued.dec()
+        with running.track():
+            return run(job_id)
+
+    queued.inc()
+    # The job's spans continue the trace of the request that submitted it
+    future = executor.submit(tracing.wrap(tracked))
+    # Jobs cancelled by shutdown_workers never start
+    future.add_done_callback(lambda done: done.cancelled() and queued.dec())
+    return future
+
+
+def submit_job(job_id):
+    if _executor is None:
+        raise RuntimeError("Ingestion workers are not running")
+    return _submit(_executor, "ingestion", run_job, job_id)
+
+
+def submit_summary(job_id):
+    if _summary_executor is None:
+        raise RuntimeError("Summary workers are not running")
+    return _submit(_summary_executor, "summary", run_summary, job_id)
+
+
+def resume_jobs():
+    """Requeue unfinished jobs whose upload is still on disk, fail the rest."""
+    db = database.SessionLocal()
+    try:
+        jobs = db.query(database.IngestionJob).filter(
+            database.IngestionJob.status.in_(ACTIVE_STATUSES)
+        ).all()
+        for job in jobs:
+            if os.path.exists(job.file_path):
+                job.status = "queued"
+                job.stage = "extract"
+                job.progress = 0
+            else:
+                job.status = "failed"
+                job.error = "Uploaded file was lost before ingestion finished"
+        db.commit()
+        resumable = [job.id for job in jobs if job.status == "queued"]
+
+        # Summaries only need the stored chunks, so they can always be resumed
+        summaries = [job_id for (job_id,) in db.query(database.IngestionJob.id).filter(
+            database.IngestionJob.status == "completed",
+            database.IngestionJob.summary_status.in_(ACTIVE_SUMMARY_STATUSES)
+        ).all()]
+    finally:
+        db.close()
+
+    for job_id in resumable:
+        logger.info("Resuming ingestion job", extra={"job_id": job_id})
+        submit_job(job_id)
+    for job_id in summaries:
+        logger.info("Resuming summary", extra={"job_id": job_id})
+        submit_summary(job_id)
+
+
+def _set_stage(db, job, stage, fraction=0.0):
+    low, high = STAGE_RANGES[stage]
+    progress = int(low + (high - low) * min(max(fraction, 0.0), 1.0))
+    # Called per page; only a change of stage or whole percent is worth a
+    # write transaction, so a job commits at most ~100 progress updates
+    if job.stage == stage and job.progress == progress:
+        return
+    job.stage = stage
+    job.progress = progress
+    db.commit()
+
+
+def run_job(job_id):
+    with tracing.span("ingestion.job", job_id=job_id):
+        _run_job(job_id)
+
+
+def _run_job(job_id):
+    db = database.SessionLocal()
+    processor = None
+    try:
+        job = db.query(database.IngestionJob).filter(database.IngestionJob.id == job_id).first()
+        if not job or job.status not in ACTIVE_STATUSES:
+            return
+
+        job.status = "running"
+        job.error = None
+        db.commit()
+        tracing.set_attributes(document_id=job.document_id, file_size=int(job.file_size or 0))
+
+        processor = get_processor()
+        # A resumed job may have written part of its vectors before the restart
+        processor.delete_document(job.document_id)
+
+        indexed = db.query(database.IndexedContent).filter(
+            database.IndexedContent.content_hash == job.content_hash
+        ).first() if job.content_hash else None
+        content_hash = job.content_hash
+        if indexed and not processor.uses_current_embedding_model(indexed.vector_id):
+            # Indexed with another embedding model; this copy gets its own vectors
+            logger.info("Not reusing indexed content embedded with a different model", extra={"job_id": job_id, "vector_id": indexed.vector_id})
+            indexed = None
+            content_hash = None
+
+        if indexed:
+            # Same PDF was indexed before: reuse its vectors instead of re-embedding
+            logger.info("Reusing indexed content", extra={"job_id": job_id, "vector_id": indexed.vector_id})
+            tracing.set_attributes(reused_vectors=True)
+            vector_id = indexed.vector_id
+            # Nothing to extract or embed; finish on the stage the normal path ends on
+            _set_stage(db, job, "embed", 1.0)
+        else:
+            _set_stage(db, job, "extract")
+            page_count = processor.count_pages(job.file_path)
+            tracing.set_attributes(page_count=page_count)
+
+            # Pages are extracted, split and embedded as a stream, so memory is
+            # bounded by the embedding batches rather than the document size
+            def pages():
+                for page_index, page in enumerate(processor.iter_pages(job.file_path, page_count)):
+                    yield page
+                    _set_stage(db, job, "embed", (page_index + 1) / page_count)
+
+            # The page text outlives the uploaded file in the text store
+            with processor.text_store.writer(job.document_id) as store:
+                chunks = processor.iter_chunks(pages(), store=store)
+
+                processor.save_text_to_chroma(
+                    texts=chunks, file_id=job.document_id,
+                    file_name=job.filename,
+                    current_user_id=job.user_id,
+                    progress=lambda stage, fraction: _set_stage(db, job, stage, fraction)
+                )
+            vector_id = job.document_id
+
+        if content_hash:
+            acquired = database.acquire_indexed_content(db, content_hash, vector_id)
+            if acquired != vector_id:
+                # An identical upload finished indexing while this one was running
+                processor.delete_document(vector_id)
+                vector_id = acquired
+
+        # The chat created with the job gets its title and first message from the summary
+        if job.generate_summary:
+            job.summary_status = "pending"
+
+        db_document = database.Document(
+            chat_id=job.chat_id,
+            user_id=job.user_id,
+            id=job.document_id,
+            filename=job.filename,
+            content_type=job.content_type,
+            file_path=job.file_path,
+            file_size=job.file_size,
+            title=job.filename.replace(".pdf", ""),
+            content_hash=content_hash,
+            vector_id=vector_id
+        )
+        db.add(db_document)
+
+        job.status = "completed"
+        job.progress = 100
+
+        with tracing.span("ingestion.db_commit"):
+            if job.generate_summary:
+                db.commit()
+            else:
+                # save_to_database commits the document and job update with the message
+                database.save_to_database(
+                    db=db,
+                    user_id=job.user_id,
+                    group_id=job.chat_id,
+                    content='',
+                    sender="assistant",
+                    message_id=None,
+                    document_ids=[job.document_id]
+                )
+        processor.delete_pdf_file(job.file_path)
+
+        # The document can be chatted with now; the summary follows in the background
+        if job.generate_summary:
+            submit_summary(job_id)
+    except Exception as e:
+        logger.exception("Ingestion job failed", extra={"job_id": job_id})
+        tracing.record_error(e)
+        db.rollback()
+        job = db.query(database.IngestionJob).filter(database.IngestionJob.id == job_id).first()
+        if job:
+            job.status = "failed"
+            job.error = str(e)
+            if job.generate_summary:
+                # Drop the chat created for this upload unless it's been used
+                chat = db.query(database.Chat).filter(database.Chat.id == job.chat_id).first()
+                if chat and not chat.messages:
+                    db.delete(chat)
+            db.commit()
+            if processor:
+                processor.delete_document(job.document_id)
+                processor.delete_pdf_file(job.file_path)
+    finally:
+        db.close()
+
+
+def run_summary(job_id):
+    """Summarize a completed job's document and write the chat title and first message."""
+    with tracing.span("ingestion.summary_job", job_id=job_id):
+        _run_summary(job_id)
+
+
+def _run_summary(job_id):
+    db = database.SessionLocal()
+    try:
+        job = db.query(database.IngestionJob).filter(database.IngestionJob.id == job_id).first()
+        if not job or job.summary_status not in ACTIVE_SUMMARY_STATUSES:
+            return
+
+        job.summary_status = "running"
+        db.commit()
+
+        document = db.query(database.Document).filter(database.Document.id == job.document_id).first()
+        chat = db.query(database.Chat).filter(database.Chat.id == job.chat_id).first()
+        if not document or not chat:
+            # Deleted while the summary was waiting
+            job.summary_status = "failed"
+            job.error = "Document or chat was deleted before the summary was written"
+            db.commit()
+            return
+
+        started = time.perf_counter()
+        document_summary = get_processor().summarize_document(document.vector_id or document.id, loop=_loop)
+        logger.info("Summarized document", extra={"document_id": document.id, "seconds": round(time.perf_counter() - started, 3)})
+
+        chat.title = document_summary.get('title') or chat.title
+        job.summary_status = "completed"
+        # save_to_database commits the title and status with the message
+        with tracing.span("ingestion.db_commit"):
+            database.save_to_database(
+                db=db,
+                user_id=job.user_id,
+                group_id=job.chat_id,
+                content=document_summary.get('summary', ''),
+                sender="assistant",
+                message_id=None,
+                document_ids=[job.document_id]
+            )
+    except Exception as e:
+        logger.exception("Summary failed", extra={"job_id": job_id})
+        tracing.record_error(e)
+        db.rollback()
+        job = db.query(database.IngestionJob).filter(database.IngestionJob.id == job_id).first()
+        if job:
+            job.summary_status = "failed"
+            job.error = str(e)
+            db.commit()
+    finally:
+        db.close()
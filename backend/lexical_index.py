@@ -0,0 +1,190 @@
+"""Local BM25 index over stored chunks, kept per pdf_id.
+
+Postings live in a SQLite file next to the Chroma directory, so exact-term
+lookups (part numbers, clause ids, names) never need an embedding call.
+Chunks are added as they are written to Chroma and removed with their
+document.
+"""
+import math
+import re
+import sqlite3
+import threading
+from collections import Counter
+import config
+
+_TOKEN_RE = re.compile(r"\w+(?:[-./:]\w+)*")
+_PART_RE = re.compile(r"[-./:_]")
+
+STOPWORDS = frozenset("""
+a an and are as at be but by can do does for from has have how i if in into is it its
+me my no not of on or our so that the their them then there these they this to was
+we were what when where which who whom why will with you your
+""".split())
+
+
+def tokenize(text):
+    """Lowercased terms without stopwords. Compound terms such as "A-12.3"
+    are kept whole and also indexed by their parts."""
+    terms = []
+    for token in _TOKEN_RE.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        terms.append(token)
+        if not token.isalnum():
+            terms.extend(part for part in _PART_RE.split(token) if part and part not in STOPWORDS)
+    return terms
+
+
+def is_keyword_query(query):
+    """True for short lookups of identifiers, where BM25 alone is enough.
+
+    A query qualifies if it has at most LEXICAL_FASTPATH_MAX_TERMS terms and
+    is quoted or contains an identifier-like term: one with a digit, an inner
+    separator ("RFC-7231", "4.2.1") or written in capitals ("GDPR").
+    """
+    raw_terms = [token for token in _TOKEN_RE.findall(query) if token.lower() not in STOPWORDS]
+    if not raw_terms or len(raw_terms) > config.LEXICAL_FASTPATH_MAX_TERMS:
+        return False
+    if '"' in query:
+        return True
+    return any(
+        any(ch.isdigit() for ch in term)
+        or not term.isalnum()
+        or (len(term) > 1 and term.isupper())
+        for term in raw_terms
+    )
+
+
+def reciprocal_rank_fusion(rankings, k=None):
+    """Merge ranked lists of keys, scoring each key by sum(1 / (k + rank))."""
+    k = config.RRF_K if k is None else k
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class LexicalIndex:
+    def __init__(self, path=None):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path or config.LEXICAL_INDEX_PATH, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            " chunk_id TEXT PRIMARY KEY,"
+            " pdf_id TEXT NOT NULL,"
+            " collection TEXT NOT NULL,"
+            " length INTEGER NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS ix_chunks_pdf_id ON chunks (pdf_id)")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS postings ("
+            " term TEXT NOT NULL,"
+            " pdf_id TEXT NOT NULL,"
+            " chunk_id TEXT NOT NULL,"
+            " tf INTEGER NOT NULL,"
+            " PRIMARY KEY (term, pdf_id, chunk_id)) WITHOUT ROWID"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS ix_postings_chunk_id ON postings (chunk_id)")
+        self._connection.commit()
+
+    def add(self, collection_name, records):
+        """Index (chunk_id, document, metadata) records stored in a collection.
+
+        Re-adding a chunk id replaces its previous postings.
+        """
+        chunk_rows = []
+        posting_rows = []
+        for chunk_id, document, metadata in records:
+            pdf_id = metadata["pdf_id"]
+            terms = Counter(tokenize(document or ""))
+            chunk_rows.append((chunk_id, pdf_id, collection_name, sum(terms.values())))
+            posting_rows.extend((term, pdf_id, chunk_id, tf) for term, tf in terms.items())
+        if not chunk_rows:
+            return
+        with self._lock:
+            self._connection.executemany(
+                "DELETE FROM postings WHERE chunk_id = ?", [(row[0],) for row in chunk_rows]
+            )
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO chunks (chunk_id, pdf_id, collection, length) VALUES (?, ?, ?, ?)",
+                chunk_rows,
+            )
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO postings (term, pdf_id, chunk_id, tf) VALUES (?, ?, ?, ?)",
+                posting_rows,
+            )
+            self._connection.commit()
+
+    def delete_document(self, pdf_id):
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM postings WHERE chunk_id IN (SELECT chunk_id FROM chunks WHERE pdf_id = ?)",
+                (pdf_id,),
+            )
+            self._connection.execute("DELETE FROM chunks WHERE pdf_id = ?", (pdf_id,))
+            self._connection.commit()
+
+    def indexed_documents(self, pdf_ids):
+        """Return the subset of pdf_ids that have chunks in the index."""
+        pdf_ids = list(pdf_ids)
+        if not pdf_ids:
+            return set()
+        placeholders = ",".join("?" * len(pdf_ids))
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT DISTINCT pdf_id FROM chunks WHERE pdf_id IN ({placeholders})", pdf_ids
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def search(self, query, pdf_ids, n_results):
+        """Return up to n_results (collection name, chunk_id, score), best first.
+
+        Corpus statistics are taken over the requested documents only.
+        """
+        terms = set(tokenize(query))
+        pdf_ids = list(pdf_ids)
+        if not terms or not pdf_ids:
+            return []
+        pdf_placeholders = ",".join("?" * len(pdf_ids))
+        term_placeholders = ",".join("?" * len(terms))
+        with self._lock:
+            chunk_count, total_length = self._connection.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(length), 0) FROM chunks WHERE pdf_id IN ({pdf_placeholders})",
+                pdf_ids,
+            ).fetchone()
+            rows = self._connection.execute(
+                f"SELECT p.term, p.chunk_id, p.tf, c.length, c.collection"
+                f" FROM postings p JOIN chunks c ON c.chunk_id = p.chunk_id"
+                f" WHERE p.term IN ({term_placeholders}) AND p.pdf_id IN ({pdf_placeholders})",
+                [*terms, *pdf_ids],
+            ).fetchall()
+        if not rows or not chunk_count:
+            return []
+
+        average_length = total_length / chunk_count or 1.0
+        document_frequency = Counter(term for term, _, _, _, _ in rows)
+        k1, b = config.BM25_K1, config.BM25_B
+        scores = {}
+        collections = {}
+        for term, chunk_id, tf, length, collection in rows:
+            df = document_frequency[term]
+            idf = math.log(1 + (chunk_count - df + 0.5) / (df + 0.5))
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (k1 + 1) / (
+                tf + k1 * (1 - b + b * length / average_length)
+            )
+            collections[chunk_id] = collection
+        ranked = sorted(scores, key=scores.get, reverse=True)[:n_results]
+        return [(collections[chunk_id], chunk_id, scores[chunk_id]) for chunk_id in ranked]
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM postings")
+            self._connection.execute("DELETE FROM chunks")
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
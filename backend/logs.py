@@ -0,0 +1,100 @@
+"""Leveled, structured logging for the backend.
+
+Modules log through ``logs.get_logger(__name__)`` and pass fields with
+``extra={...}``; they are rendered as ``key=value`` pairs, or as one JSON
+object per line with LOG_FORMAT=json. Records are handed to a queue and
+written by a listener thread, so log I/O never runs on a request or worker
+thread. High-volume events (one per chunk) go through a Sampler.
+"""
+import atexit
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import config
+
+ROOT_LOGGER = "chatwithpdf"
+
+# Attributes every LogRecord has; anything else came in through extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+_listener = None
+
+
+def _fields(record):
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = _fields(record)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **_fields(record),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class Sampler:
+    """True for one call in every `every`; the first call always passes."""
+
+    def __init__(self, every):
+        self.every = max(int(every), 1)
+        self._calls = itertools.count()
+
+    def __call__(self):
+        return next(self._calls) % self.every == 0
+
+
+def configure(stream=None, level=None, fmt=None):
+    """Route the backend's loggers through a queue to a listener thread writing to stream."""
+    global _listener
+    shutdown()
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(JsonFormatter() if (fmt or config.LOG_FORMAT) == "json" else TextFormatter())
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger(ROOT_LOGGER)
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel((level or config.LOG_LEVEL).upper())
+    # Uvicorn configures the root logger; don't print everything twice
+    root.propagate = False
+
+
+def shutdown():
+    """Write out queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_logger(name):
+    if _listener is None:
+        configure()
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+atexit.register(shutdown)
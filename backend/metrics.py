@@ -0,0 +1,226 @@
+"""In-process metrics rendered in the Prometheus text exposition format.
+
+Metrics are cheap enough to leave on: recording is a lock and an add (plus a
+bisect for histograms). Metrics created with labelnames hand out one child
+per label combination through .labels(); hot paths should look their child
+up once and keep it.
+"""
+import bisect
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class _Timer:
+    __slots__ = ("metric", "started")
+
+    def __init__(self, metric):
+        self.metric = metric
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metric.observe(time.perf_counter() - self.started)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, label_pairs=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_pairs = tuple(label_pairs)
+        self._lock = threading.Lock()
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+            *self.samples(),
+        ]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name, documentation, label_pairs=()):
+        super().__init__(name, documentation, label_pairs)
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [f"{self.name}{_label_text(self.label_pairs)} {self.value}"]
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name, documentation, label_pairs=()):
+        super().__init__(name, documentation, label_pairs)
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+    def track(self):
+        """Context manager holding the gauge one higher while the block runs."""
+        return _Tracker(self)
+
+    def samples(self):
+        return [f"{self.name}{_label_text(self.label_pairs)} {self.value}"]
+
+
+class _Tracker:
+    __slots__ = ("gauge",)
+
+    def __init__(self, gauge):
+        self.gauge = gauge
+
+    def __enter__(self):
+        self.gauge.inc()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.gauge.dec()
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS, label_pairs=()):
+        super().__init__(name, documentation, label_pairs)
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager observing the seconds the block takes."""
+        return _Timer(self)
+
+    def samples(self):
+        lines = []
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{_label_text(self.label_pairs + (('le', bound),))} {cumulative}")
+        cumulative += counts[-1]
+        lines.append(f"{self.name}_bucket{_label_text(self.label_pairs + (('le', '+Inf'),))} {cumulative}")
+        lines.append(f"{self.name}_sum{_label_text(self.label_pairs)} {total}")
+        lines.append(f"{self.name}_count{_label_text(self.label_pairs)} {cumulative}")
+        return lines
+
+
+class Family:
+    """A metric split by labels; .labels(name=value, ...) returns the child to record on."""
+
+    def __init__(self, cls, name, documentation, labelnames, **kwargs):
+        self.cls = cls
+        self.type = cls.type
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.kwargs = kwargs
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, **values):
+        key = tuple(str(values[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.get(key)
+                if child is None:
+                    child = self.cls(
+                        self.name, self.documentation, label_pairs=tuple(zip(self.labelnames, key)), **self.kwargs
+                    )
+                    self._children[key] = child
+        return child
+
+    def render(self):
+        with self._lock:
+            children = list(self._children.values())
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for child in children:
+            lines.extend(child.samples())
+        return lines
+
+
+def _get_or_create(cls, name, documentation, labelnames=None, **kwargs):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            if labelnames:
+                metric = Family(cls, name, documentation, labelnames, **kwargs)
+            else:
+                metric = cls(name, documentation, **kwargs)
+            _registry[name] = metric
+        return metric
+
+
+def counter(name, documentation, labelnames=None):
+    return _get_or_create(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=None):
+    return _get_or_create(Gauge, name, documentation, labelnames)
+
+
+def histogram(name, documentation, buckets=DEFAULT_BUCKETS, labelnames=None):
+    return _get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+# Shared by every module that calls the chat model; label call="chat", "summary", ...
+LLM_TOKENS = counter("llm_tokens_total", "Tokens reported by the chat model", labelnames=("call", "direction"))
+
+
+def render():
+    """Render every registered metric as Prometheus text."""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,80 @@
+"""Move chunks out of the single pdf_documents collection into per-document partitions.
+
+Run from the backend directory: ``python migrate_partitions.py``. Stored
+embeddings are copied as they are, so nothing is re-embedded, and the chunks
+are added to the BM25 index. The tool can be re-run safely; the legacy
+collection is only dropped once every chunk has been copied.
+"""
+import argparse
+from pdf_processor import get_processor
+
+
+def migrate(processor, batch_size=1000, keep_source=False):
+    """Copy every chunk of the legacy collection into its document's partition."""
+    # Opened without an embedding function, so the OpenAIEmbeddingFunction
+    # it was persisted with doesn't conflict; stored vectors are copied as is
+    legacy = processor.get_collection(create=False)
+    if legacy is None:
+        print("No legacy collection found, nothing to migrate.")
+        return 0
+    # Partitions are labelled with the configured model, which must be the
+    # one that produced the legacy vectors
+    processor.check_embedding_model(legacy)
+
+    total = legacy.count()
+    print(f"Migrating {total} chunks from '{legacy.name}'...")
+    copied = 0
+    documents_seen = set()
+    # The source isn't modified until the end, so offset paging is stable
+    for offset in range(0, total, batch_size):
+        batch = legacy.get(
+            limit=batch_size,
+            offset=offset,
+            include=["embeddings", "documents", "metadatas"],
+        )
+        by_pdf = {}
+        for chunk_id, embedding, document, metadata in zip(
+            batch["ids"], batch["embeddings"], batch["documents"], batch["metadatas"]
+        ):
+            pdf_id = (metadata or {}).get("pdf_id")
+            if pdf_id is None:
+                print(f"Skipping chunk {chunk_id} without a pdf_id")
+                continue
+            group = by_pdf.setdefault(pdf_id, ([], [], [], []))
+            group[0].append(chunk_id)
+            group[1].append(embedding)
+            group[2].append(document)
+            group[3].append(metadata)
+
+        for pdf_id, (ids, embeddings, documents, metadatas) in by_pdf.items():
+            partition = processor.get_collection(pdf_id)
+            partition.upsert(
+                ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas
+            )
+            processor.lexical_index.add(partition.name, list(zip(ids, documents, metadatas)))
+            copied += len(ids)
+            documents_seen.add(pdf_id)
+        print(f"  {min(offset + batch_size, total)}/{total}")
+
+    for pdf_id in documents_seen:
+        processor.query_cache.invalidate(pdf_id)
+
+    if keep_source:
+        print(f"Copied {copied} chunks into {len(documents_seen)} partitions, kept '{legacy.name}'.")
+    else:
+        processor.chroma_client.delete_collection(name=legacy.name)
+        processor._forget_collection(legacy.name)
+        print(f"Copied {copied} chunks into {len(documents_seen)} partitions, dropped '{legacy.name}'.")
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--keep-source", action="store_true", help="don't drop the legacy collection afterwards")
+    args = parser.parse_args()
+    migrate(get_processor(), batch_size=args.batch_size, keep_source=args.keep_source)
+
+
+if __name__ == "__main__":
+    main()
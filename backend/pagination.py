@@ -0,0 +1,78 @@
+"""Keyset pagination on (created_at, id) for the list endpoints.
+
+A page is requested with ``?limit=`` and the opaque ``?cursor=`` returned in
+the X-Next-Cursor header of the previous page. Each page continues from the
+last row of the previous one, so the database seeks straight to it through
+the (…, created_at, id) indexes instead of counting past an OFFSET.
+"""
+import base64
+import datetime
+from typing import Optional
+from fastapi import HTTPException, Query, status
+from sqlalchemy import tuple_
+import config
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(row):
+    raw = f"{row.created_at.isoformat()}|{row.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Return the (created_at, id) a cursor points at; ValueError if it is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, row_id = raw.split("|", 1)
+        return datetime.datetime.fromisoformat(created_at), row_id
+    except (ValueError, UnicodeDecodeError) as exc:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from exc
+
+
+class PageParams:
+    def __init__(self, cursor=None, limit=None):
+        self.cursor = decode_cursor(cursor) if cursor else None
+        self.limit = limit or config.PAGE_SIZE
+
+
+def page_params(
+    cursor: Optional[str] = None,
+    limit: int = Query(None, ge=1, le=config.MAX_PAGE_SIZE),
+):
+    """FastAPI dependency reading ?cursor= and ?limit=."""
+    try:
+        return PageParams(cursor, limit)
+    except ValueError as exc:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc))
+
+
+def keyset(statement, model, page, descending=True):
+    """Order statement by (created_at, id) and start after page.cursor.
+
+    One row more than the page is selected so page_rows can tell whether
+    another page follows.
+    """
+    key = tuple_(model.created_at, model.id)
+    if page.cursor is not None:
+        statement = statement.where(key < tuple_(*page.cursor) if descending else key > tuple_(*page.cursor))
+    if descending:
+        statement = statement.order_by(model.created_at.desc(), model.id.desc())
+    else:
+        statement = statement.order_by(model.created_at.asc(), model.id.asc())
+    return statement.limit(page.limit + 1)
+
+
+def page_rows(rows, page, response=None):
+    """Trim the extra row keyset selected; returns (rows, next cursor or None).
+
+    When a response is given the cursor is also set as its X-Next-Cursor header.
+    """
+    rows = list(rows)
+    next_cursor = None
+    if len(rows) > page.limit:
+        rows = rows[:page.limit]
+        next_cursor = encode_cursor(rows[-1])
+    if response is not None and next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return rows, next_cursor
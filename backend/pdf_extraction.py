@@ -0,0 +1,17 @@
+"""Page text extraction, shared by the serial path and worker processes.
+
+Kept free of heavy imports so spawned workers start quickly.
+"""
+from pypdf import PdfReader
+
+
+def iter_page_range(file_path, start, end):
+    """Yield (page, text) for pages [start, end) of a PDF."""
+    reader = PdfReader(file_path)
+    for page_number in range(start, end):
+        text = reader.pages[page_number].extract_text(extraction_mode="plain")
+        yield page_number, text.strip()
+
+
+def extract_page_range(file_path, start, end):
+    return list(iter_page_range(file_path, start, end))
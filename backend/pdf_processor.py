@@ -1,82 +1,436 @@
 import os
+import re
+import logging
+import time
+import hashlib
+import asyncio
+import threading
+import multiprocessing
 import chromadb
 import concurrent.futures
+import httpx
 import config
+import logs
+import metrics
+import tracing
+import text_splitter
+from cachetools import LRUCache
+from chromadb.errors import NotFoundError
+from collections import deque
+import embedding_backends
+from embedding_cache import CachedEmbeddingFunction
+from embedding_backends import EmbeddingModelMismatchError
+from lexical_index import LexicalIndex, is_keyword_query, reciprocal_rank_fusion
+from text_store import TextStore
+from query_cache import QueryCache
+from context_builder import build_context, join_chunks
+from summarizer import summarize_pages
 from uuid import uuid4
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from chromadb.utils.embedding_functions import OpenAIEmbeddingFunction
+from langchain_core.documents import Document
 from langchain_core.messages import SystemMessage, HumanMessage
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_openai import ChatOpenAI
-import ast
+from pypdf import PdfReader
+from pdf_extraction import extract_page_range, iter_page_range
+
+# Chroma collection names: 3-512 characters from this set, alphanumeric at both ends
+_COLLECTION_NAME_RE = re.compile(r"^[a-zA-Z0-9][a-zA-Z0-9._-]{1,510}[a-zA-Z0-9]$")
+
+LEXICAL_FAST_PATH = metrics.counter(
+    "lexical_fast_path_total", "Retrievals answered by the BM25 index without an embedding call"
+)
+
+# Ingestion streams pages through extraction, splitting, embedding and
+# storage, so each stage is timed per unit of work (page or batch) and the
+# _sum of a stage is the time ingestion spent in it
+INGESTION_STAGE = metrics.histogram(
+    "ingestion_stage_seconds", "Seconds spent in each ingestion stage per page or batch",
+    labelnames=("stage",),
+)
+EXTRACT_SECONDS = INGESTION_STAGE.labels(stage="extract")
+SPLIT_SECONDS = INGESTION_STAGE.labels(stage="split")
+EMBED_SECONDS = INGESTION_STAGE.labels(stage="embed")
+STORE_SECONDS = INGESTION_STAGE.labels(stage="store")
+LEXICAL_SECONDS = INGESTION_STAGE.labels(stage="lexical_index")
+SUMMARIZE_SECONDS = INGESTION_STAGE.labels(stage="summarize")
+PAGES_EXTRACTED = metrics.counter("ingested_pages_total", "Pages extracted from uploaded PDFs")
+CHUNKS_STORED = metrics.counter("ingested_chunks_total", "Chunks embedded and stored")
+EMBEDDED_TOKENS = metrics.counter("embedded_tokens_total", "Tokens sent to the embedding model")
+CHAT_PROMPT_TOKENS = metrics.LLM_TOKENS.labels(call="chat", direction="prompt")
+CHAT_COMPLETION_TOKENS = metrics.LLM_TOKENS.labels(call="chat", direction="completion")
+
+logger = logs.get_logger(__name__)
+# One per-chunk debug event in LOG_CHUNK_SAMPLE_EVERY is logged
+_chunk_sample = logs.Sampler(config.LOG_CHUNK_SAMPLE_EVERY)
+
+_shared_processor = None
+_shared_processor_lock = threading.Lock()
+
+
+def get_processor():
+    """Return the process-wide handleProcessDocuments, creating it on first use."""
+    global _shared_processor
+    if _shared_processor is None:
+        with _shared_processor_lock:
+            if _shared_processor is None:
+                _shared_processor = handleProcessDocuments()
+    return _shared_processor
+
+
+async def close_processor():
+    global _shared_processor
+    with _shared_processor_lock:
+        processor = _shared_processor
+        _shared_processor = None
+    if processor is not None:
+        await processor.aclose()
+
+
+def _connection_limits():
+    return httpx.Limits(
+        max_connections=config.OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=config.OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=config.OPENAI_KEEPALIVE_EXPIRY,
+    )
 
 
 class handleProcessDocuments:
-    def __init__(self):
-        self.embedding_function = OpenAIEmbeddingFunction(
-                model_name=config.EMBEDDING_MODEL,
-                api_key=config.OPENAI_API_KEY,
-                organization_id=None
-            )
+    def __init__(self, embedding_function=None, chroma_client=None, llm=None, lexical_index=None, text_store=None):
+        # Keep-alive connection pools shared by every OpenAI call this object makes
+        self.http_client = httpx.Client(limits=_connection_limits(), timeout=config.OPENAI_TIMEOUT)
+        self.async_http_client = httpx.AsyncClient(limits=_connection_limits(), timeout=config.OPENAI_TIMEOUT)
+
+        if embedding_function is None:
+            # Shared by ingestion and retrieval so no text is embedded twice
+            embedding_function = embedding_backends.create_embedding_function(http_client=self.http_client)
+        self.embedding_function = embedding_function
+        self.embedding_model_id = embedding_backends.model_id()
         
         self.collection_name = config.PDF_COLLECTION_NAME
         self.messages = []
-        self.chroma_client = chromadb.PersistentClient(path=config.CHROMA_DB_PATH)
+        self.chroma_client = chroma_client or chromadb.PersistentClient(path=config.CHROMA_DB_PATH)
+        self.llm = llm or ChatOpenAI(
+            model=config.LLM_MODEL,
+            temperature=config.LLM_TEMPERATURE,
+            api_key=config.OPENAI_API_KEY,
+            http_client=self.http_client,
+            http_async_client=self.async_http_client,
+            # Report token usage on streamed completions too
+            stream_usage=True,
+        )
+        # Dedicated pool for blocking Chroma queries so they never run on the
+        # event loop or compete with FastAPI's default threadpool.
+        self.vector_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=config.VECTOR_QUERY_WORKERS,
+            thread_name_prefix="vector-query",
+        )
+        # Fan-out of one query over several partitions. Kept apart from
+        # vector_executor because query_chroma itself runs there.
+        self.partition_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=config.PARTITION_QUERY_WORKERS,
+            thread_name_prefix="vector-partition",
+        )
+        self._collections = LRUCache(maxsize=config.PARTITION_HANDLE_CACHE_SIZE)
+        self._collection_lock = threading.Lock()
+        self._extraction_pool = None
+        self._extraction_pool_lock = threading.Lock()
+        self.query_cache = QueryCache()
+        self.lexical_index = lexical_index or LexicalIndex()
+        self.text_store = text_store or TextStore()
+
+    def partition_name(self, pdf_id):
+        """Name of the collection holding one document's chunks."""
+        name = f"{self.collection_name}_{pdf_id}"
+        if not _COLLECTION_NAME_RE.match(name):
+            name = f"{self.collection_name}_{hashlib.sha256(str(pdf_id).encode('utf-8')).hexdigest()[:32]}"
+        return name
+
+    def get_collection(self, pdf_id=None, create=True):
+        """Return a cached handle to a document's partition.
+
+        Without a pdf_id this is the legacy collection that held every
+        document before partitioning. With create=False, returns None if the
+        collection doesn't exist.
+        """
+        name = self.partition_name(pdf_id) if pdf_id is not None else self.collection_name
+        return self._get_named_collection(name, create)
+
+    def _get_named_collection(self, name, create):
+        with self._collection_lock:
+            collection = self._collections.get(name)
+        if collection is not None:
+            return collection
+        # Collections are opened without an embedding function: every write
+        # and query passes its vectors explicitly, and Chroma refuses to open
+        # a collection persisted with a different one (such as the legacy
+        # collection's OpenAIEmbeddingFunction)
+        try:
+            if create:
+                collection = self.chroma_client.get_or_create_collection(
+                    name=name,
+                    embedding_function=None,
+                    metadata={embedding_backends.MODEL_RECORD_KEY: self.embedding_model_id}
+                )
+            else:
+                collection = self.chroma_client.get_collection(name=name, embedding_function=None)
+        except NotFoundError:
+            return None
+        with self._collection_lock:
+            self._collections[name] = collection
+        return collection
+
+    def check_embedding_model(self, collection):
+        """Refuse to mix vectors from a different embedding model into a search or write."""
+        recorded = embedding_backends.recorded_model_id(collection)
+        if recorded != self.embedding_model_id:
+            raise EmbeddingModelMismatchError(
+                f"Collection '{collection.name}' was embedded with {recorded}, "
+                f"but the configured embedding model is {self.embedding_model_id}"
+            )
+
+    def uses_current_embedding_model(self, pdf_id):
+        """Whether a document's stored vectors came from the configured model."""
+        collection = self.get_collection(pdf_id, create=False) or self.get_collection(create=False)
+        return collection is None or embedding_backends.recorded_model_id(collection) == self.embedding_model_id
+
+    def _forget_collection(self, name):
+        with self._collection_lock:
+            self._collections.pop(name, None)
+
+    async def aclose(self):
+        """Release pooled connections and worker threads."""
+        self.vector_executor.shutdown(wait=False, cancel_futures=True)
+        self.partition_executor.shutdown(wait=False, cancel_futures=True)
+        if self._extraction_pool is not None:
+            self._extraction_pool.shutdown(wait=False, cancel_futures=True)
+        if isinstance(self.embedding_function, CachedEmbeddingFunction):
+            self.embedding_function.close()
+        self.lexical_index.close()
+        self.http_client.close()
+        await self.async_http_client.aclose()
 
     def extract_text(self, file_path):
-        print('extracting text from pdf....')
+        logger.info("Extracting text", extra={"file": file_path})
         loader = PyPDFLoader(file_path)
-        self.text = loader.load()
-        return self.text
+        return loader.load()
+
+    def iter_pages(self, file_path, page_count=None):
+        """Yield pages in order one at a time instead of loading the whole PDF.
+
+        Large PDFs are extracted in parallel across worker processes.
+        """
+        page_count = page_count or self.count_pages(file_path)
+        workers = config.EXTRACT_WORKERS or os.cpu_count() or 1
+        if workers <= 1 or page_count < config.EXTRACT_PARALLEL_MIN_PAGES:
+            # Not worth starting processes for
+            pages = iter_page_range(file_path, 0, page_count)
+            while True:
+                with EXTRACT_SECONDS.time(), tracing.span("ingestion.extract", parallel=False) as span:
+                    page = next(pages, None)
+                    if page is not None:
+                        span.set_attribute("page", page[0])
+                if page is None:
+                    return
+                PAGES_EXTRACTED.inc()
+                yield self._page_document(file_path, page_count, *page)
+
+        logger.info("Extracting pages in parallel", extra={"pages": page_count, "workers": workers})
+        executor = self.get_extraction_pool(workers)
+        # Each task reopens the PDF, so don't make them too small
+        pages_per_task = max(config.EXTRACT_PAGES_PER_TASK, -(-page_count // (workers * 4)))
+        ranges = [
+            (start, min(start + pages_per_task, page_count))
+            for start in range(0, page_count, pages_per_task)
+        ]
+        # Keep a bounded window of ranges in flight so extracted text doesn't
+        # pile up faster than it is embedded
+        pending = deque()
+        next_range = 0
+        while next_range < len(ranges) or pending:
+            while next_range < len(ranges) and len(pending) < workers * 2:
+                start, end = ranges[next_range]
+                pending.append(executor.submit(extract_page_range, file_path, start, end))
+                next_range += 1
+            # Only the time spent waiting on the workers holds ingestion up
+            with EXTRACT_SECONDS.time(), tracing.span("ingestion.extract", parallel=True) as span:
+                pages = pending.popleft().result()
+                span.set_attribute("page_count", len(pages))
+            PAGES_EXTRACTED.inc(len(pages))
+            for page_number, text in pages:
+                yield self._page_document(file_path, page_count, page_number, text)
+
+    def _page_document(self, file_path, page_count, page_number, text):
+        return Document(
+            page_content=text,
+            metadata={
+                "source": file_path,
+                "total_pages": page_count,
+                "page": page_number,
+            }
+        )
+
+    def get_extraction_pool(self, workers):
+        if self._extraction_pool is None:
+            with self._extraction_pool_lock:
+                if self._extraction_pool is None:
+                    # Spawn rather than fork: the server process runs many threads
+                    self._extraction_pool = concurrent.futures.ProcessPoolExecutor(
+                        max_workers=workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+        return self._extraction_pool
+
+    def count_pages(self, file_path):
+        return len(PdfReader(file_path).pages)
 
     def split_text(self, documents):
-        print('splitting documents into chunks...')
-        splitter = RecursiveCharacterTextSplitter(
+        logger.info("Splitting documents into chunks")
+        return list(self.iter_chunks(documents))
+
+    def get_splitter(self):
+        """Chunk splitter for the configured CHUNK_SIZE, CHUNK_OVERLAP and CHUNK_LENGTH_UNIT."""
+        return text_splitter.OffsetTextSplitter(
             chunk_size=config.CHUNK_SIZE,
             chunk_overlap=config.CHUNK_OVERLAP,
+            length_function=text_splitter.count_tokens if config.CHUNK_LENGTH_UNIT == "tokens" else None,
         )
+
+    def iter_chunks(self, documents, store=None):
+        """Split pages into chunks as they arrive, keeping each page's metadata.
+
+        If store (a text_store.DocumentTextWriter) is given, each page's text
+        and its chunks' offsets are recorded in it.
+        """
+        splitter = self.get_splitter()
         
-        chunked_documents = []
         for doc in documents:
             page_num = doc.metadata.get('page', 0)
-            chunks = splitter.split_text(doc.page_content)
+            with SPLIT_SECONDS.time(), tracing.span("ingestion.split", page=page_num) as span:
+                spans = splitter.split_spans(doc.page_content)
+                span.set_attribute("chunk_count", len(spans))
+            if store is not None:
+                store.add_page(page_num, doc.page_content)
             
             # Preserve page metadata for each chunk
-            for chunk in chunks:
+            for start, end in spans:
+                if store is not None:
+                    store.add_chunk(page_num, start, end)
                 # Create a document-like object with page metadata
-                chunked_documents.append({
-                    'page_content': chunk,
+                yield {
+                    'page_content': doc.page_content[start:end],
                     'metadata': {'page': page_num, **doc.metadata}
-                })
-                
-        return chunked_documents
+                }
 
-    def save_text_to_chroma(self, texts, file_id, file_name, current_user_id, generate_summary=False):
-        print('saving text to chroma....')
-        
-        chroma_client = chromadb.PersistentClient(path=config.CHROMA_DB_PATH)
-        collection = chroma_client.get_or_create_collection(
-            name=self.collection_name,
-            embedding_function=self.embedding_function
-        )
+    def count_tokens(self, text):
+        return text_splitter.count_tokens(text)
 
+    def _iter_chunk_records(self, texts, file_id, file_name, current_user_id):
+        """Yield (id, document, metadata) tuples ready for collection.add."""
+        chunk_debug = logger.isEnabledFor(logging.DEBUG)
         for i, doc in enumerate(texts):
-            page_num = doc.metadata.get('page', i+1) if hasattr(doc, 'metadata') else i+1
-            doc_content = doc.page_content if hasattr(doc, 'page_content') else doc
-            print(f"Saving chunk from page {page_num}: {doc_content[:50]}...")
-            print("file_name:", type(file_name), "file_id:", type(file_id), "page_num:", type(page_num), "current_user_id:", type(current_user_id))
-            collection.add(
-                documents=[doc_content],
-                metadatas=[{
+            if isinstance(doc, dict):
+                # Chunks produced by split_text
+                page_num = doc['metadata'].get('page', i+1)
+                doc_content = doc['page_content']
+            else:
+                page_num = doc.metadata.get('page', i+1) if hasattr(doc, 'metadata') else i+1
+                doc_content = doc.page_content if hasattr(doc, 'page_content') else doc
+            if chunk_debug and _chunk_sample():
+                logger.debug("Chunk prepared", extra={
+                    "pdf_id": file_id, "chunk": i, "page": page_num, "chars": len(doc_content)
+                })
+            yield (
+                f"{file_id}_p{page_num}_{str(uuid4())}",
+                doc_content,
+                {
                     "source": file_name,
                     "pdf_id": file_id,
                     "page": page_num,
                     "current_user_id": current_user_id,
                     "document_name": file_name,
+                    "chunk": i,
+                },
+            )
+
+    def _batch_chunks(self, records):
+        """Group chunk records into batches bounded by count and token size."""
+        batch = []
+        batch_tokens = 0
+        for record in records:
+            tokens = self.count_tokens(record[1])
+            if batch and (
+                len(batch) >= config.EMBED_BATCH_SIZE
+                or batch_tokens + tokens > config.EMBED_BATCH_MAX_TOKENS
+            ):
+                EMBEDDED_TOKENS.inc(batch_tokens)
+                yield batch
+                batch = []
+                batch_tokens = 0
+            batch.append(record)
+            batch_tokens += tokens
+        if batch:
+            EMBEDDED_TOKENS.inc(batch_tokens)
+            yield batch
+
+    def _embed_batch(self, batch):
+        with EMBED_SECONDS.time(), tracing.span("ingestion.embed_batch", chunk_count=len(batch)):
+            embeddings = self.embedding_function([document for _, document, _ in batch])
+        return batch, embeddings
 
-                }],
-                ids=[f"{file_id}_p{page_num}_{str(uuid4())}"]
+    def _write_batch(self, collection, embedded_batch):
+        batch, embeddings = embedded_batch
+        with STORE_SECONDS.time(), tracing.span("ingestion.vector_write", collection=collection.name, chunk_count=len(batch)):
+            collection.add(
+                ids=[chunk_id for chunk_id, _, _ in batch],
+                documents=[document for _, document, _ in batch],
+                metadatas=[metadata for _, _, metadata in batch],
+                embeddings=embeddings,
             )
+        with LEXICAL_SECONDS.time(), tracing.span("ingestion.lexical_index", chunk_count=len(batch)):
+            self.lexical_index.add(collection.name, batch)
+        CHUNKS_STORED.inc(len(batch))
+        return len(batch)
+
+    def save_text_to_chroma(self, texts, file_id, file_name, current_user_id, generate_summary=False, progress=None):
+        """Embed and store chunks, optionally summarizing the document.
+
+        `progress`, if given, is called as progress(stage, fraction) with stage
+        "embed" or "summarize" and fraction in [0, 1].
+        """
+        logger.info("Saving chunks", extra={"pdf_id": file_id})
+        
+        collection = self.get_collection(file_id)
+        self.check_embedding_model(collection)
+
+        # Embed up to EMBED_MAX_IN_FLIGHT batches concurrently while earlier
+        # batches are written, keeping the writes in submission order.
+        started = time.perf_counter()
+        saved = 0
+        total = len(texts) if hasattr(texts, '__len__') else None
+        records = self._iter_chunk_records(texts, file_id, file_name, current_user_id)
+        # Extraction and splitting are pulled through this loop, so their
+        # spans nest under this one
+        with tracing.span("ingestion.embed_and_store", pdf_id=file_id) as span, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=config.EMBED_MAX_IN_FLIGHT) as executor:
+            pending = deque()
+            for batch in self._batch_chunks(records):
+                pending.append(executor.submit(tracing.wrap(self._embed_batch), batch))
+                if len(pending) >= config.EMBED_MAX_IN_FLIGHT:
+                    saved += self._write_batch(collection, pending.popleft().result())
+                    if progress and total:
+                        progress("embed", saved / total)
+            while pending:
+                saved += self._write_batch(collection, pending.popleft().result())
+                if progress and total:
+                    progress("embed", saved / total)
+            span.set_attribute("chunk_count", saved)
+
+        elapsed = time.perf_counter() - started
+        rate = saved / elapsed if elapsed > 0 else 0.0
+        logger.info("Saved chunks", extra={
+            "pdf_id": file_id, "chunks": saved, "seconds": round(elapsed, 3), "chunks_per_second": round(rate, 1)
+        })
+
         if not generate_summary:
             return{
                 'summary': '',
@@ -84,69 +438,199 @@ class handleProcessDocuments:
             }
         
         if generate_summary:
-            query = "What is the summary of this document?"
-            result = self.query_chroma(
-                query=query,
-                pdf_ids=[file_id]
-            )
+            if progress:
+                progress("summarize", 0.0)
+            return self.summarize_document(file_id)
 
-            system_prompt_modification = (
-                "Return the response strictly as a valid Python dictionary. "
-                "The dictionary must contain exactly two keys: 'summary' and 'title'. "
-                "'summary' must contain the actual summary of the document. "
-                "'title' must be a concise title (less than 10 words) derived from the summary. "
-                "IMPORTANT: The response must contain ONLY these two keys. "
-                "Any text returned must belong strictly to either the 'summary' value or the 'title' value. "
-                "Do not return any explanations, notes, or formatting outside the dictionary. "
-                "don't return it inform of a string return it as a python dictionary strictly. "
-                "Final output format: { 'summary': <summary>, 'title': <title> }"
-            )
-            
-            raw_response = self.generate_tailored_response(query, context=result + system_prompt_modification)
-            return ast.literal_eval(raw_response)
+    def summarize_document(self, file_id, loop=None):
+        """Ask the LLM for a summary and title of an already indexed document.
 
-    def query_chroma(self, query: str, pdf_ids: str | list[str]) -> str:
-        print("Querying ChromaDB...")
-        print(f"Query: {query}")
+        Worker threads pass the app's event loop: the async HTTP client's
+        pooled connections belong to the loop that opened them, so the
+        summary runs there. Without a loop (scripts) it gets its own.
+        """
+        if loop is not None:
+            return asyncio.run_coroutine_threadsafe(self.asummarize_document(file_id), loop).result()
+        return asyncio.run(self.asummarize_document(file_id))
 
-        collection = self.chroma_client.get_collection(
-            name=self.collection_name,
-            embedding_function=self.embedding_function,
-        )
+    async def asummarize_document(self, file_id):
+        """Map-reduce summary of the whole document rebuilt from its chunks."""
+        with SUMMARIZE_SECONDS.time(), tracing.span("ingestion.summarize", pdf_id=file_id) as span:
+            loop = asyncio.get_running_loop()
+            pages = await loop.run_in_executor(self.vector_executor, tracing.wrap(self.document_pages), file_id)
+            span.set_attribute("page_count", len(pages))
+            return await summarize_pages(self.get_llm(), pages, self.count_tokens)
 
-        if isinstance(pdf_ids, list):
-            where_filter = {"pdf_id": pdf_ids[0]} if len(pdf_ids) == 1 else {"pdf_id": {"$in": pdf_ids}}
-        else:
-            where_filter = {"pdf_id": pdf_ids}
+    def document_pages(self, file_id):
+        """Return a document's text page by page, from the text store or else
+        stitched back from its stored chunks."""
+        pages = self.text_store.pages(file_id)
+        if pages is not None:
+            return pages
+        collection = self.get_collection(file_id, create=False)
+        where_filter = None
+        if collection is None:
+            collection = self.get_collection(create=False)
+            where_filter = {"pdf_id": file_id}
+        if collection is None:
+            return []
+        results = collection.get(where=where_filter, include=["documents", "metadatas"])
+        pages = {}
+        for position, (document, metadata) in enumerate(zip(results["documents"], results["metadatas"])):
+            # Chunks stored before "chunk" was recorded keep their stored order
+            order = metadata.get("chunk", position)
+            pages.setdefault(metadata.get("page", 0), []).append((order, document))
+        return [
+            join_chunks(document for _, document in sorted(pages[page], key=lambda item: item[0]))
+            for page in sorted(pages)
+        ]
 
-        results = collection.query(
-            query_texts=[query],
-            n_results=5,
-            where=where_filter,
-        )
+    def query_chroma(self, query: str, pdf_ids: str | list[str], document_names=None) -> str:
+        """Context for query from the given documents' chunks; document_names
+        ({pdf_id: name}) are the names the asking user gave them."""
+        logger.debug("Querying", extra={"query": query})
+
+        pdf_ids = [pdf_ids] if isinstance(pdf_ids, str) else list(dict.fromkeys(pdf_ids))
 
-        documents = results.get("documents", [[]])[0]
-        metadatas = results.get("metadatas", [[]])[0]
+        documents, metadatas = self._cached_retrieval(query, pdf_ids)
+        if documents is None:
+            hits = self._retrieve(query, pdf_ids, n_results=config.CONTEXT_CANDIDATES)
+            documents = [document for _, _, document, _ in hits]
+            metadatas = [metadata for _, _, _, metadata in hits]
+            self.query_cache.set_retrieval(query, pdf_ids, [(name, chunk_id) for name, chunk_id, _, _ in hits])
 
         if not documents:
             return "No results found."
 
-        formatted_results = []
-        for doc, metadata in zip(documents, metadatas):
-            doc_name = metadata.get("document_name", "Unknown")
-            page_num = metadata.get("page", "Unknown")
-            formatted_results.append(f"[Document: {doc_name}, Page: {page_num}]\n{doc}")
-
-        text = "\n\n".join(formatted_results)
-        print(text)
+        text, stats = build_context(list(zip(documents, metadatas)), self.count_tokens, document_names=document_names)
+        logger.info("Built context", extra=stats)
+        # Lands on the caller's retrieval span
+        tracing.set_attributes(document_count=len(pdf_ids), **{f"context.{key}": value for key, value in stats.items()})
         return text
-   
-    def generate_tailored_response(self, query, context=None):
-        llm = ChatOpenAI(
-            model=config.LLM_MODEL,
-            temperature=config.LLM_TEMPERATURE,
-            api_key=config.OPENAI_API_KEY
+
+    def _retrieve(self, query, pdf_ids, n_results):
+        """Return the n_results best (collection name, chunk id, document, metadata) hits.
+
+        Vector and BM25 results are merged with reciprocal rank fusion.
+        Keyword lookups on fully indexed documents are answered from BM25
+        alone, skipping the embedding call.
+        """
+        if is_keyword_query(query) and self.lexical_index.indexed_documents(pdf_ids) == set(pdf_ids):
+            lexical = self.lexical_index.search(query, pdf_ids, n_results)
+            if lexical:
+                LEXICAL_FAST_PATH.inc()
+                keys = [(name, chunk_id) for name, chunk_id, _ in lexical]
+                found = self._fetch_chunks(keys)
+                return [(*key, *found[key]) for key in keys if key in found]
+
+        lexical = self.lexical_index.search(query, pdf_ids, config.HYBRID_CANDIDATES)
+        vector = self._search_partitions(
+            query, pdf_ids, config.HYBRID_CANDIDATES if lexical else n_results
+        )
+        found = {(name, chunk_id): (document, metadata) for _, name, chunk_id, document, metadata in vector}
+        if not lexical:
+            return [(*key, *found[key]) for key in list(found)[:n_results]]
+
+        fused = reciprocal_rank_fusion([
+            list(found),
+            [(name, chunk_id) for name, chunk_id, _ in lexical],
+        ])[:n_results]
+        missing = [key for key in fused if key not in found]
+        if missing:
+            found.update(self._fetch_chunks(missing))
+        return [(*key, *found[key]) for key in fused if key in found]
+
+    def _search_partitions(self, query, pdf_ids, n_results):
+        """Query only the partitions of the requested documents, in parallel.
+
+        Documents that haven't been migrated out of the legacy collection are
+        searched there with a pdf_id filter. Returns the n_results closest
+        (distance, collection name, chunk id, document, metadata) hits.
+        """
+        targets = []
+        legacy_ids = []
+        for pdf_id in pdf_ids:
+            collection = self.get_collection(pdf_id, create=False)
+            if collection is not None:
+                targets.append((collection, None))
+            else:
+                legacy_ids.append(pdf_id)
+        if legacy_ids:
+            collection = self.get_collection(create=False)
+            if collection is not None:
+                where_filter = {"pdf_id": legacy_ids[0]} if len(legacy_ids) == 1 else {"pdf_id": {"$in": legacy_ids}}
+                targets.append((collection, where_filter))
+        if not targets:
+            return []
+        for collection, _ in targets:
+            self.check_embedding_model(collection)
+
+        # Embed once and reuse the vector for every partition
+        query_embeddings = self.embedding_function([query])
+
+        def search(target):
+            collection, where_filter = target
+            results = collection.query(
+                query_embeddings=query_embeddings,
+                n_results=n_results,
+                where=where_filter,
+                include=["documents", "metadatas", "distances"],
+            )
+            return [
+                (distance, collection.name, chunk_id, document, metadata)
+                for chunk_id, document, metadata, distance in zip(
+                    results["ids"][0], results["documents"][0],
+                    results["metadatas"][0], results["distances"][0],
+                )
+            ]
+
+        if len(targets) == 1:
+            hits = search(targets[0])
+        else:
+            hits = [hit for partial in self.partition_executor.map(search, targets) for hit in partial]
+        hits.sort(key=lambda hit: hit[0])
+        return hits[:n_results]
+
+    def _cached_retrieval(self, query, pdf_ids):
+        """Fetch the chunks a previous identical query retrieved, skipping the embedding call."""
+        cached = self.query_cache.get_retrieval(query, pdf_ids)
+        if cached is None:
+            return None, None
+        if not cached:
+            return [], []
+
+        found = self._fetch_chunks(cached)
+        if len(found) != len(cached):
+            return None, None
+        documents = [found[key][0] for key in cached]
+        metadatas = [found[key][1] for key in cached]
+        return documents, metadatas
+
+    def _fetch_chunks(self, keys):
+        """Look up {(collection name, chunk id): (document, metadata)} for stored chunks."""
+        chunk_ids_by_name = {}
+        for name, chunk_id in keys:
+            chunk_ids_by_name.setdefault(name, []).append(chunk_id)
+        found = {}
+        for name, chunk_ids in chunk_ids_by_name.items():
+            collection = self._get_named_collection(name, create=False)
+            if collection is None:
+                continue
+            results = collection.get(ids=chunk_ids, include=["documents", "metadatas"])
+            for chunk_id, document, metadata in zip(results["ids"], results["documents"], results["metadatas"]):
+                found[(name, chunk_id)] = (document, metadata)
+        return found
+
+    async def aquery_chroma(self, query: str, pdf_ids: str | list[str], document_names=None) -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.vector_executor, tracing.wrap(self.query_chroma), query, pdf_ids, document_names
         )
+
+    def get_llm(self):
+        return self.llm
+
+    def build_messages(self, query, context=None, history=None):
         system_message = f"""You are a helpful assistant. Take this document as context to answer the user's question accurately. 
         Format your responses using Markdown syntax for better readability:
         - Use **bold** for emphasis
@@ -160,31 +644,110 @@ class handleProcessDocuments:
         
         Below is the context: {context}"""
         
-        messages = [
+        # history holds the conversation so far (see conversation_memory)
+        return [
             SystemMessage(content=system_message),
+            *(history or []),
             HumanMessage(content=query)
         ]
-        response = llm.invoke(messages)
-        return response.content
-    
-    def split_text_concurrently(self, text: str, num_parts: int = 100):
-        print(f'splitting text into {num_parts} parts and processing concurrently...')
-        length = len(text)
-        # Split text into num_parts parts
-        parts = [text[i*length//num_parts:(i+1)*length//num_parts] for i in range(num_parts)]
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=config.CHUNK_SIZE,
-            chunk_overlap=config.CHUNK_OVERLAP,
-        )
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            results = list(executor.map(splitter.split_text, parts))
 
-        return [chunk for sublist in results for chunk in sublist]
+    def answer_cache_messages(self, query, context=None):
+        """The prompt the answer cache is keyed on: build_messages without the history.
+
+        Asking the same question of the same context again is the repeat the
+        cache is for, and by then the first answer is part of the history.
+        """
+        return self.build_messages(query, context)
+
+    def generate_tailored_response(self, query, context=None, pdf_ids=None, history=None):
+        with tracing.span("chat.llm", **{"gen_ai.request.model": config.LLM_MODEL}) as span:
+            messages = self.build_messages(query, context, history)
+            cache_messages = self.answer_cache_messages(query, context)
+            cached = self.query_cache.get_answer(cache_messages, config.LLM_MODEL, config.LLM_TEMPERATURE)
+            span.set_attribute("cache_hit", cached is not None)
+            if cached is not None:
+                return cached
+            response = self.get_llm().invoke(messages)
+            tracing.record_llm_usage(response, CHAT_PROMPT_TOKENS, CHAT_COMPLETION_TOKENS)
+            self.query_cache.set_answer(cache_messages, config.LLM_MODEL, config.LLM_TEMPERATURE, response.content, pdf_ids)
+            return response.content
+
+    async def agenerate_tailored_response(self, query, context=None, pdf_ids=None, history=None):
+        with tracing.span("chat.llm", **{"gen_ai.request.model": config.LLM_MODEL}) as span:
+            messages = self.build_messages(query, context, history)
+            cache_messages = self.answer_cache_messages(query, context)
+            cached = self.query_cache.get_answer(cache_messages, config.LLM_MODEL, config.LLM_TEMPERATURE)
+            span.set_attribute("cache_hit", cached is not None)
+            if cached is not None:
+                return cached
+            response = await self.get_llm().ainvoke(messages)
+            tracing.record_llm_usage(response, CHAT_PROMPT_TOKENS, CHAT_COMPLETION_TOKENS)
+            self.query_cache.set_answer(cache_messages, config.LLM_MODEL, config.LLM_TEMPERATURE, response.content, pdf_ids)
+            return response.content
+
+    async def astream_tailored_response(self, query, context=None, pdf_ids=None, history=None):
+        """Yield the completion text piece by piece as the model produces it."""
+        # Not made current: the caller runs between the yields
+        span = tracing.start_span("chat.llm", streamed=True, **{"gen_ai.request.model": config.LLM_MODEL})
+        try:
+            messages = self.build_messages(query, context, history)
+            cache_messages = self.answer_cache_messages(query, context)
+            cached = self.query_cache.get_answer(cache_messages, config.LLM_MODEL, config.LLM_TEMPERATURE)
+            span.set_attribute("cache_hit", cached is not None)
+            if cached is not None:
+                yield cached
+                return
+            parts = []
+            async for chunk in self.get_llm().astream(messages):
+                # The usage arrives on the last, empty chunk
+                tracing.record_llm_usage(chunk, CHAT_PROMPT_TOKENS, CHAT_COMPLETION_TOKENS, span)
+                if chunk.content:
+                    if not parts:
+                        span.add_event("first_token")
+                    parts.append(chunk.content)
+                    yield chunk.content
+            self.query_cache.set_answer(cache_messages, config.LLM_MODEL, config.LLM_TEMPERATURE, "".join(parts), pdf_ids)
+        finally:
+            span.end()
     
+    def split_text_concurrently(self, text: str, num_parts: int | None = None):
+        """Split one long text into the same chunks as a single split_text call,
+        across the process pool when it is long enough to pay for it."""
+        splitter = self.get_splitter()
+        workers = config.SPLIT_WORKERS or os.cpu_count() or 1
+        if workers <= 1 or len(text) < config.SPLIT_PARALLEL_MIN_CHARS:
+            return splitter.split_text(text)
+        num_parts = num_parts or workers * 4
+        logger.info("Splitting text in parallel", extra={"chars": len(text), "parts": num_parts})
+        # The extraction pool doubles as the splitting pool
+        spans = splitter.split_spans_parallel(text, self.get_extraction_pool(workers), num_parts)
+        return [text[start:end] for start, end in spans]
+    
+    def delete_document(self, file_id):
+        """Remove every chunk stored for a document from the vector store."""
+        name = self.partition_name(file_id)
+        self._forget_collection(name)
+        try:
+            self.chroma_client.delete_collection(name=name)
+        except NotFoundError:
+            pass
+        # Chunks written before partitioning, if not migrated yet
+        legacy = self.get_collection(create=False)
+        if legacy is not None:
+            legacy.delete(where={"pdf_id": file_id})
+        self.lexical_index.delete_document(file_id)
+        self.text_store.delete(file_id)
+        self.query_cache.invalidate(file_id)
+
     def clear_collection(self):
         collections = self.chroma_client.list_collections()
         for collection in collections:
             self.chroma_client.delete_collection(name=collection.name)
+        with self._collection_lock:
+            self._collections.clear()
+        self.lexical_index.clear()
+        self.text_store.clear()
+        self.query_cache.clear()
         return "All collections cleared."
         
     def delete_pdf_file(self, file_path):
@@ -194,7 +757,7 @@ class handleProcessDocuments:
                 os.remove(file_path)
                 return True
             except Exception as e:
-                print(f"Error deleting file {file_path}: {str(e)}")
+                logger.error("Error deleting file", extra={"file": file_path, "error": str(e)})
                 return False
         return False
 
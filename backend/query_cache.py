@@ -0,0 +1,124 @@
+"""Two-tier cache for repeated chat questions.
+
+Tier one maps (normalized query, sorted pdf_ids) to the (collection name,
+chunk id) pairs retrieval returned. Tier two maps (prompt hash, model, temperature) to the
+completion. Entries expire after a TTL and every entry is tagged with the
+pdf_ids it depends on, so deleting a document drops them.
+"""
+import hashlib
+import re
+import threading
+from cachetools import TTLCache
+import config
+import metrics
+
+RETRIEVAL_HITS = metrics.counter("retrieval_cache_hits_total", "Chroma queries answered from the retrieval cache")
+RETRIEVAL_MISSES = metrics.counter("retrieval_cache_misses_total", "Chroma queries that missed the retrieval cache")
+ANSWER_HITS = metrics.counter("answer_cache_hits_total", "LLM completions answered from the answer cache")
+ANSWER_MISSES = metrics.counter("answer_cache_misses_total", "LLM completions that missed the answer cache")
+
+
+def normalize_query(query):
+    query = re.sub(r"\s+", " ", query or "").strip().lower()
+    return query.rstrip("?.! ")
+
+
+def normalize_pdf_ids(pdf_ids):
+    if pdf_ids is None:
+        return ()
+    if isinstance(pdf_ids, str):
+        return (pdf_ids,)
+    return tuple(sorted(set(pdf_ids)))
+
+
+def prompt_hash(messages):
+    digest = hashlib.sha256()
+    for message in messages:
+        digest.update(message.type.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(str(message.content).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class QueryCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._retrievals = TTLCache(maxsize=config.RETRIEVAL_CACHE_MAX_ENTRIES, ttl=config.RETRIEVAL_CACHE_TTL)
+        self._answers = TTLCache(maxsize=config.ANSWER_CACHE_MAX_ENTRIES, ttl=config.ANSWER_CACHE_TTL)
+        # pdf_id -> keys in either tier that were built from it
+        self._keys_by_pdf = {}
+        # (pdf_id, key) pairs in the index, which decides when to prune it
+        self._tag_count = 0
+        self._prune_at = 2 * (self._retrievals.maxsize + self._answers.maxsize)
+
+    def _tag(self, key, pdf_ids):
+        for pdf_id in pdf_ids:
+            keys = self._keys_by_pdf.setdefault(pdf_id, set())
+            if key not in keys:
+                keys.add(key)
+                self._tag_count += 1
+        # Expired and evicted keys linger in the tag index; prune it once it
+        # holds twice what could still be live, so it stays proportional to
+        # the caches and pruning costs O(1) amortized per tag
+        if self._tag_count > self._prune_at:
+            self._prune()
+
+    def _prune(self):
+        live = {}
+        for pdf_id, keys in self._keys_by_pdf.items():
+            keys = {k for k in keys if k in self._retrievals or k in self._answers}
+            if keys:
+                live[pdf_id] = keys
+        self._keys_by_pdf = live
+        self._tag_count = sum(len(keys) for keys in live.values())
+        # A key used by many documents is tagged once per document
+        self._prune_at = max(2 * (self._retrievals.maxsize + self._answers.maxsize), 2 * self._tag_count)
+
+    @staticmethod
+    def retrieval_key(query, pdf_ids):
+        return ("retrieval", normalize_query(query), normalize_pdf_ids(pdf_ids))
+
+    @staticmethod
+    def answer_key(messages, model, temperature):
+        return ("answer", prompt_hash(messages), model, temperature)
+
+    def get_retrieval(self, query, pdf_ids):
+        with self._lock:
+            chunk_ids = self._retrievals.get(self.retrieval_key(query, pdf_ids))
+        (RETRIEVAL_HITS if chunk_ids is not None else RETRIEVAL_MISSES).inc()
+        return chunk_ids
+
+    def set_retrieval(self, query, pdf_ids, chunk_ids):
+        key = self.retrieval_key(query, pdf_ids)
+        with self._lock:
+            self._retrievals[key] = list(chunk_ids)
+            self._tag(key, normalize_pdf_ids(pdf_ids))
+
+    def get_answer(self, messages, model, temperature):
+        with self._lock:
+            answer = self._answers.get(self.answer_key(messages, model, temperature))
+        (ANSWER_HITS if answer is not None else ANSWER_MISSES).inc()
+        return answer
+
+    def set_answer(self, messages, model, temperature, answer, pdf_ids):
+        key = self.answer_key(messages, model, temperature)
+        with self._lock:
+            self._answers[key] = answer
+            self._tag(key, normalize_pdf_ids(pdf_ids))
+
+    def invalidate(self, pdf_id):
+        """Drop every cached retrieval and answer that used this document."""
+        with self._lock:
+            keys = self._keys_by_pdf.pop(pdf_id, ())
+            self._tag_count -= len(keys)
+            for key in keys:
+                self._retrievals.pop(key, None)
+                self._answers.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._retrievals.clear()
+            self._answers.clear()
+            self._keys_by_pdf.clear()
+            self._tag_count = 0
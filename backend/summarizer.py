@@ -0,0 +1,104 @@
+"""Map-reduce summarization of a whole document.
+
+Page groups are summarized concurrently, with at most
+SUMMARY_MAX_CONCURRENCY LLM calls in flight. The partial summaries are then
+combined SUMMARY_REDUCE_FANOUT at a time, level by level, until a final call
+produces the summary and title.
+"""
+import ast
+import asyncio
+from langchain_core.messages import SystemMessage, HumanMessage
+import config
+import metrics
+import tracing
+
+LLM_CALL_SECONDS = metrics.histogram("summary_llm_call_seconds", "Seconds per map, reduce or final summary LLM call")
+SUMMARY_PROMPT_TOKENS = metrics.LLM_TOKENS.labels(call="summary", direction="prompt")
+SUMMARY_COMPLETION_TOKENS = metrics.LLM_TOKENS.labels(call="summary", direction="completion")
+
+MAP_PROMPT = (
+    "Summarize the following part of a document. Keep the key facts, names, "
+    "figures and conclusions. Reply with the summary only."
+)
+REDUCE_PROMPT = (
+    "The following are summaries of consecutive parts of one document. "
+    "Combine them into a single summary that keeps the key facts, names, "
+    "figures and conclusions. Reply with the summary only."
+)
+FINAL_PROMPT = (
+    "The following text is either a document or summaries of its parts. "
+    "Return the response strictly as a valid Python dictionary. "
+    "The dictionary must contain exactly two keys: 'summary' and 'title'. "
+    "'summary' must contain the actual summary of the document. "
+    "'title' must be a concise title (less than 10 words) derived from the summary. "
+    "IMPORTANT: The response must contain ONLY these two keys. "
+    "Do not return any explanations, notes, or formatting outside the dictionary. "
+    "Final output format: { 'summary': <summary>, 'title': <title> }"
+)
+
+
+def group_texts(texts, count_tokens, max_tokens):
+    """Join consecutive texts into groups of at most max_tokens (a longer text stands alone)."""
+    groups = []
+    current = []
+    current_tokens = 0
+    for text in texts:
+        tokens = count_tokens(text)
+        if current and current_tokens + tokens > max_tokens:
+            groups.append("\n\n".join(current))
+            current = []
+            current_tokens = 0
+        current.append(text)
+        current_tokens += tokens
+    if current:
+        groups.append("\n\n".join(current))
+    return groups
+
+
+def parse_summary(raw):
+    """Read the {'summary', 'title'} dictionary the final call was asked for."""
+    text = raw.strip()
+    if text.startswith("```"):
+        text = text.strip("`")
+        text = text[text.index("\n") + 1:] if "\n" in text else text
+    try:
+        parsed = ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        parsed = None
+    if isinstance(parsed, dict) and "summary" in parsed:
+        return {"summary": str(parsed["summary"]), "title": str(parsed.get("title") or "New Chat")}
+    # The model ignored the format; keep what it wrote as the summary
+    return {"summary": raw.strip(), "title": "New Chat"}
+
+
+async def _complete(llm, semaphore, instructions, text):
+    async with semaphore:
+        with LLM_CALL_SECONDS.time(), tracing.span("summary.llm", **{"gen_ai.request.model": config.LLM_MODEL}) as span:
+            response = await llm.ainvoke([SystemMessage(content=instructions), HumanMessage(content=text)])
+            tracing.record_llm_usage(response, SUMMARY_PROMPT_TOKENS, SUMMARY_COMPLETION_TOKENS, span)
+    return response.content
+
+
+async def summarize_pages(llm, pages, count_tokens, max_concurrency=None, group_tokens=None, fanout=None):
+    """Summarize a document given as page texts in order; returns {'summary', 'title'}."""
+    semaphore = asyncio.Semaphore(max_concurrency or config.SUMMARY_MAX_CONCURRENCY)
+    fanout = max(fanout or config.SUMMARY_REDUCE_FANOUT, 2)
+    # Counting every page's tokens is CPU work; keep it off the event loop
+    groups = await asyncio.to_thread(
+        group_texts, [page for page in pages if page.strip()], count_tokens, group_tokens or config.SUMMARY_GROUP_TOKENS
+    )
+    if not groups:
+        return {"summary": "", "title": "New Chat"}
+    if len(groups) == 1:
+        # Short document: one call is enough
+        return parse_summary(await _complete(llm, semaphore, FINAL_PROMPT, groups[0]))
+
+    summaries = await asyncio.gather(*[
+        _complete(llm, semaphore, MAP_PROMPT, group) for group in groups
+    ])
+    while len(summaries) > fanout:
+        summaries = await asyncio.gather(*[
+            _complete(llm, semaphore, REDUCE_PROMPT, "\n\n".join(summaries[start:start + fanout]))
+            for start in range(0, len(summaries), fanout)
+        ])
+    return parse_summary(await _complete(llm, semaphore, FINAL_PROMPT, "\n\n".join(summaries)))
@@ -0,0 +1,241 @@
+"""Chunk boundaries as (start, end) offsets into the text.
+
+OffsetTextSplitter produces exactly the chunks of langchain's
+RecursiveCharacterTextSplitter with its default separators, but works on
+offsets instead of substrings: pieces, merged windows and stripped chunks
+are all index pairs, and measuring a piece in characters is a subtraction.
+Only the final chunks are sliced out. Lengths can be counted in tokens
+instead (CHUNK_LENGTH_UNIT="tokens"), which does measure substrings.
+
+The text is first cut into independent tasks (runs of short pieces to merge
+and long pieces to split further); results never cross a task, so long
+texts can be split in a process pool and still give the same chunks.
+"""
+import bisect
+import logging
+import re
+from collections import deque
+import tiktoken
+import config
+
+# A plain logger: worker processes importing this module shouldn't start
+# the log queue listener
+logger = logging.getLogger(f"chatwithpdf.{__name__}")
+
+SEPARATORS = ("\n\n", "\n", " ", "")
+
+_patterns = {}
+
+_encoding = None
+
+
+def count_tokens(text):
+    """Tokens of text in the embedding model's encoding; estimated when it can't be loaded."""
+    global _encoding
+    if _encoding is None:
+        try:
+            _encoding = tiktoken.encoding_for_model(config.EMBEDDING_MODEL)
+        except KeyError:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            # The BPE files are downloaded on first use; estimate when offline
+            logger.warning("Could not load tiktoken encoding, estimating token counts", extra={"error": str(e)})
+            _encoding = False
+    if not _encoding:
+        return len(text) // 4 + 1
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+def _bounds(text, start, end, separator):
+    """Piece boundaries of text[start:end] cut before each separator, which
+    starts the next piece: [start, ..., end], strictly increasing."""
+    if not separator:
+        return list(range(start, end + 1))
+    pattern = _patterns.get(separator)
+    if pattern is None:
+        pattern = _patterns[separator] = re.compile(re.escape(separator))
+    bounds = [match.start() for match in pattern.finditer(text, start, end)]
+    if not bounds or bounds[0] != start:
+        bounds.insert(0, start)
+    bounds.append(end)
+    return bounds
+
+
+class OffsetTextSplitter:
+    def __init__(self, chunk_size=None, chunk_overlap=None, length_function=None, separators=SEPARATORS):
+        """length_function measures a string; None counts characters without slicing."""
+        self.chunk_size = chunk_size or config.CHUNK_SIZE
+        self.chunk_overlap = config.CHUNK_OVERLAP if chunk_overlap is None else chunk_overlap
+        self.length_function = length_function
+        self.separators = tuple(separators)
+        # Pieces keep their separators, so they are merged with "" between them
+        self._separator_length = length_function("") if length_function else 0
+
+    def _tasks(self, text, start, end, separators):
+        """Yield the independent steps splitting text[start:end] takes, in order:
+        ("merge", bounds, lengths) for a run of short pieces, ("split", start,
+        end, separators) for a long piece or ("chunk", start, end)."""
+        separator = separators[-1]
+        remaining = ()
+        for index, candidate in enumerate(separators):
+            if candidate == "":
+                separator = candidate
+                break
+            if text.find(candidate, start, end) != -1:
+                separator = candidate
+                remaining = separators[index + 1:]
+                break
+
+        bounds = _bounds(text, start, end, separator)
+        size = self.chunk_size
+        if self.length_function is None:
+            lengths = None
+            long_pieces = [index for index in range(len(bounds) - 1) if bounds[index + 1] - bounds[index] >= size]
+        else:
+            lengths = [self.length_function(text[a:b]) for a, b in zip(bounds, bounds[1:])]
+            long_pieces = [index for index, length in enumerate(lengths) if length >= size]
+
+        run_start = 0
+        for index in long_pieces:
+            if index > run_start:
+                yield ("merge", bounds[run_start:index + 1], lengths and lengths[run_start:index])
+            if remaining:
+                yield ("split", bounds[index], bounds[index + 1], remaining)
+            else:
+                # Nothing left to split on; kept as is, unstripped
+                yield ("chunk", bounds[index], bounds[index + 1])
+            run_start = index + 1
+        if run_start < len(bounds) - 1:
+            yield ("merge", bounds[run_start:], lengths and lengths[run_start:])
+
+    def _run(self, text, task, spans):
+        kind = task[0]
+        if kind == "merge":
+            if task[2] is None:
+                self._merge_characters(text, task[1], spans)
+            else:
+                self._merge_lengths(text, task[1], task[2], spans)
+        elif kind == "split":
+            for subtask in self._tasks(text, task[1], task[2], task[3]):
+                self._run(text, subtask, spans)
+        else:
+            spans.append((task[1], task[2]))
+
+    def _merge_characters(self, text, bounds, spans):
+        """Join consecutive pieces into windows of at most chunk_size characters,
+        overlapping by chunk_overlap.
+
+        The pieces are contiguous, so their boundaries are the running total
+        of their lengths: each window edge is found by bisection rather than
+        by adding pieces one at a time.
+        """
+        size = self.chunk_size
+        last = len(bounds) - 1
+        first = 0
+        while True:
+            # The piece that would overflow the window starting at `first`
+            overflow = bisect.bisect_right(bounds, bounds[first] + size, first + 2, last + 1)
+            if overflow > last:
+                self._emit(text, bounds[first], bounds[last], spans)
+                return
+            piece = overflow - 1
+            self._emit(text, bounds[first], bounds[piece], spans)
+            # Drop pieces from the front until what's left fits the overlap
+            # and leaves room for that piece
+            threshold = max(bounds[piece] - self.chunk_overlap, bounds[overflow] - size)
+            first = bisect.bisect_left(bounds, threshold, first, piece)
+
+    def _merge_lengths(self, text, bounds, lengths, spans):
+        """_merge_characters for lengths measured by length_function, one piece at a time."""
+        separator_length = self._separator_length
+        window = deque()
+        total = 0
+        for index, length in enumerate(lengths):
+            if total + length + (separator_length if window else 0) > self.chunk_size:
+                if window:
+                    self._emit(text, bounds[window[0]], bounds[window[-1] + 1], spans)
+                    while total > self.chunk_overlap or (
+                        total + length + (separator_length if window else 0) > self.chunk_size and total > 0
+                    ):
+                        total -= lengths[window[0]] + (separator_length if len(window) > 1 else 0)
+                        window.popleft()
+            window.append(index)
+            total += length + (separator_length if len(window) > 1 else 0)
+        if window:
+            self._emit(text, bounds[window[0]], bounds[window[-1] + 1], spans)
+
+    @staticmethod
+    def _emit(text, start, end, spans):
+        # Same as str.strip() on the joined window; empty windows are dropped
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        if end > start:
+            spans.append((start, end))
+
+    def split_spans(self, text, start=0, end=None):
+        """(start, end) offsets of the chunks of text[start:end]."""
+        spans = []
+        for task in self._tasks(text, start, len(text) if end is None else end, self.separators):
+            self._run(text, task, spans)
+        return spans
+
+    def split_text(self, text):
+        return [text[start:end] for start, end in self.split_spans(text)]
+
+    def split_spans_parallel(self, text, executor, parts):
+        """split_spans run as up to `parts` contiguous groups of tasks on executor (a process pool)."""
+        tasks = list(self._tasks(text, 0, len(text), self.separators))
+        groups = []
+        target = len(text) / max(parts, 1)
+        group = []
+        group_chars = 0
+        for task in tasks:
+            group.append(task)
+            group_chars += _task_end(task) - _task_start(task)
+            if group_chars >= target:
+                groups.append(group)
+                group = []
+                group_chars = 0
+        if group:
+            groups.append(group)
+        if len(groups) <= 1:
+            spans = []
+            for task in tasks:
+                self._run(text, task, spans)
+            return spans
+
+        futures = []
+        for group in groups:
+            offset = _task_start(group[0])
+            # Each worker gets only its slice of the text, with the tasks rebased onto it
+            segment = text[offset:_task_end(group[-1])]
+            futures.append(executor.submit(
+                _split_group, segment, offset, [_rebase(task, -offset) for task in group],
+                self.chunk_size, self.chunk_overlap, self.length_function, self.separators,
+            ))
+        return [span for future in futures for span in future.result()]
+
+
+def _task_start(task):
+    return task[1][0] if task[0] == "merge" else task[1]
+
+
+def _task_end(task):
+    return task[1][-1] if task[0] == "merge" else task[2]
+
+
+def _rebase(task, shift):
+    if task[0] == "merge":
+        return ("merge", [bound + shift for bound in task[1]], task[2])
+    return (task[0], task[1] + shift, task[2] + shift, *task[3:])
+
+
+def _split_group(segment, offset, tasks, chunk_size, chunk_overlap, length_function, separators):
+    """Process-pool entry point: run a group of tasks on its text segment."""
+    splitter = OffsetTextSplitter(chunk_size, chunk_overlap, length_function, separators)
+    spans = []
+    for task in tasks:
+        splitter._run(segment, task, spans)
+    return [(start + offset, end + offset) for start, end in spans]
@@ -0,0 +1,211 @@
+"""Extracted page text kept per document, zstd-compressed, with a chunk index.
+
+The uploaded PDF is deleted after ingestion, so this store is what's left to
+re-chunk, re-embed or cite from. Each document is one file:
+
+    [zstd frame per page] [page numbers: uint32 x P]
+    [frame offsets: uint64 x P+1] [chunk pages, starts, ends: uint32 x C each]
+    [footer]
+
+Every page is compressed separately, so reading one page decompresses one
+frame. The arrays are written in native byte order and read in place by
+casting the memory-mapped file, so opening a document reads only the footer.
+Chunk starts and ends are character offsets into their page's text, as
+produced by text_splitter.
+"""
+import array
+import bisect
+import mmap
+import os
+import struct
+import sys
+import uuid
+import zstandard
+import config
+
+MAGIC = b"CWPT"
+VERSION = 1
+# magic, version, little-endian flag, page count, chunk count, index offset
+_FOOTER = struct.Struct("<4sHHIIQ")
+_BYTE_ORDER = 1 if sys.byteorder == "little" else 0
+
+
+class DocumentTextWriter:
+    """Streams one document's pages and chunk offsets to a temporary file;
+    commit() moves it into place, so readers never see a partial document."""
+
+    def __init__(self, path, level=None):
+        self.path = path
+        self._temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        self._file = open(self._temp_path, "wb")
+        self._compressor = zstandard.ZstdCompressor(level=level or config.TEXT_STORE_COMPRESSION_LEVEL)
+        self._page_numbers = array.array("I")
+        self._frame_offsets = array.array("Q", [0])
+        self._chunk_pages = array.array("I")
+        self._chunk_starts = array.array("I")
+        self._chunk_ends = array.array("I")
+
+    def add_page(self, page_number, text):
+        if self._page_numbers and page_number <= self._page_numbers[-1]:
+            raise ValueError(f"Pages must be added in order; got {page_number} after {self._page_numbers[-1]}")
+        self._file.write(self._compressor.compress(text.encode("utf-8")))
+        self._page_numbers.append(page_number)
+        self._frame_offsets.append(self._file.tell())
+
+    def add_chunk(self, page_number, start, end):
+        """Record the next chunk as text[start:end] of a page."""
+        self._chunk_pages.append(page_number)
+        self._chunk_starts.append(start)
+        self._chunk_ends.append(end)
+
+    def commit(self):
+        # uint64 offsets are read in place, so align the index
+        self._file.write(b"\0" * (-self._file.tell() % 8))
+        index_offset = self._file.tell()
+        for values in (
+            self._page_numbers, self._frame_offsets, self._chunk_pages, self._chunk_starts, self._chunk_ends
+        ):
+            values.tofile(self._file)
+        self._file.write(_FOOTER.pack(
+            MAGIC, VERSION, _BYTE_ORDER, len(self._page_numbers), len(self._chunk_pages), index_offset
+        ))
+        self._file.close()
+        os.replace(self._temp_path, self.path)
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.remove(self._temp_path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+
+class DocumentText:
+    """Random access to one stored document through a memory map."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        magic, version, byte_order, page_count, chunk_count, index_offset = _FOOTER.unpack_from(
+            view, len(view) - _FOOTER.size
+        )
+        if magic != MAGIC or version != VERSION or byte_order != _BYTE_ORDER:
+            view.release()
+            self._mmap.close()
+            raise ValueError(f"Not a text store file this build can read: {path}")
+        self.page_count = page_count
+        self.chunk_count = chunk_count
+
+        def take(offset, count, typecode):
+            size = count * struct.calcsize(typecode)
+            return view[offset:offset + size].cast(typecode), offset + size
+
+        self._view = view
+        self.page_numbers, offset = take(index_offset, page_count, "I")
+        self._frame_offsets, offset = take(offset, page_count + 1, "Q")
+        self.chunk_pages, offset = take(offset, chunk_count, "I")
+        self.chunk_starts, offset = take(offset, chunk_count, "I")
+        self.chunk_ends, offset = take(offset, chunk_count, "I")
+        self._decompressor = zstandard.ZstdDecompressor()
+        self._cached_page = (None, None)
+
+    def _page_index(self, page_number):
+        # Pages are usually numbered 0..n-1, but any increasing numbers work
+        if page_number < self.page_count and self.page_numbers[page_number] == page_number:
+            return page_number
+        index = bisect.bisect_left(self.page_numbers, page_number)
+        if index < self.page_count and self.page_numbers[index] == page_number:
+            return index
+        raise KeyError(page_number)
+
+    def page_text(self, page_number):
+        """Text of a page by its page number; KeyError if it wasn't stored."""
+        if self._cached_page[0] == page_number:
+            return self._cached_page[1]
+        index = self._page_index(page_number)
+        frame = self._view[self._frame_offsets[index]:self._frame_offsets[index + 1]]
+        text = self._decompressor.decompress(frame).decode("utf-8")
+        # Consecutive chunks usually share a page
+        self._cached_page = (page_number, text)
+        return text
+
+    def pages(self):
+        """Every page's text, in page order."""
+        return [self.page_text(page_number) for page_number in self.page_numbers]
+
+    def chunk(self, index):
+        """(page number, text) of the index-th chunk."""
+        page_number = self.chunk_pages[index]
+        return page_number, self.page_text(page_number)[self.chunk_starts[index]:self.chunk_ends[index]]
+
+    def close(self):
+        for view in (self.page_numbers, self._frame_offsets, self.chunk_pages, self.chunk_starts, self.chunk_ends, self._view):
+            view.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TextStore:
+    """A directory of DocumentText files, one per vector id."""
+
+    def __init__(self, path=None):
+        self.directory = path or config.TEXT_STORE_PATH
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, document_id):
+        return os.path.join(self.directory, f"{document_id}.pages")
+
+    def writer(self, document_id):
+        return DocumentTextWriter(self.path(document_id))
+
+    def open(self, document_id):
+        """DocumentText for a document, or None if it has nothing stored."""
+        try:
+            return DocumentText(self.path(document_id))
+        except FileNotFoundError:
+            return None
+
+    def page_text(self, document_id, page_number):
+        """A page's text, or None if the document or page isn't stored."""
+        document = self.open(document_id)
+        if document is None:
+            return None
+        with document:
+            try:
+                return document.page_text(page_number)
+            except KeyError:
+                return None
+
+    def pages(self, document_id):
+        """Every page's text in order, or None if the document isn't stored."""
+        document = self.open(document_id)
+        if document is None:
+            return None
+        with document:
+            return document.pages()
+
+    def delete(self, document_id):
+        try:
+            os.remove(self.path(document_id))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(".pages"):
+                os.remove(os.path.join(self.directory, name))
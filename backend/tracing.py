@@ -0,0 +1,136 @@
+"""OpenTelemetry tracing of the upload, ingestion and chat paths.
+
+Modules open spans with ``tracing.span(name, **attributes)``. TRACE_EXPORTER
+picks where finished spans go: "none" (the default; spans cost next to
+nothing), "console", "otlp" (configured through the standard
+OTEL_EXPORTER_OTLP_* variables) or "memory", which keeps them in
+``tracing.memory_exporter`` for tests. Work handed to a thread pool keeps its
+parent span through ``tracing.wrap``, so an ingestion job shows up under the
+upload request that queued it.
+"""
+import atexit
+import contextvars
+from opentelemetry import propagate, trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SimpleSpanProcessor
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.trace import Status, StatusCode
+import config
+
+_provider = None
+_tracer = trace.NoOpTracer()
+memory_exporter = None
+
+
+def _span_exporter(name):
+    if name == "console":
+        from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+        return ConsoleSpanExporter()
+    if name == "otlp":
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+        return OTLPSpanExporter()
+    raise ValueError(f"Unknown trace exporter: {name!r}")
+
+
+def configure(exporter=None, sample_ratio=None):
+    """Start exporting spans; returns the InMemorySpanExporter for exporter="memory"."""
+    global _provider, _tracer, memory_exporter
+    shutdown()
+    memory_exporter = None
+    exporter = exporter or config.TRACE_EXPORTER
+    if exporter == "none":
+        return None
+
+    ratio = config.TRACE_SAMPLE_RATIO if sample_ratio is None else sample_ratio
+    _provider = TracerProvider(
+        resource=Resource.create({"service.name": config.TRACE_SERVICE_NAME}),
+        # Child spans follow the decision made for the root, so traces stay whole
+        sampler=ParentBased(TraceIdRatioBased(ratio)),
+    )
+    if exporter == "memory":
+        memory_exporter = InMemorySpanExporter()
+        _provider.add_span_processor(SimpleSpanProcessor(memory_exporter))
+    else:
+        # Exported from a background thread, in batches
+        _provider.add_span_processor(BatchSpanProcessor(_span_exporter(exporter)))
+    _tracer = _provider.get_tracer(__name__)
+    return memory_exporter
+
+
+def flush():
+    """Export spans still buffered, e.g. before the server stops."""
+    if _provider is not None:
+        _provider.force_flush()
+
+
+def shutdown():
+    """Export spans still buffered and stop tracing."""
+    global _provider, _tracer
+    if _provider is not None:
+        _provider.shutdown()
+        _provider = None
+    _tracer = trace.NoOpTracer()
+
+
+def span(name, kind=trace.SpanKind.INTERNAL, context=None, **attributes):
+    """Context manager for a span that is current while the block runs.
+
+    Don't hold one open across a yield: the generator's caller would run
+    inside it. Use start_span there instead.
+    """
+    return _tracer.start_as_current_span(name, context=context, kind=kind, attributes=attributes or None)
+
+
+def start_span(name, **attributes):
+    """Start a child of the current span without making it current; call .end() on it."""
+    return _tracer.start_span(name, attributes=attributes or None)
+
+
+def incoming_context(headers):
+    """Trace context propagated by the caller (traceparent), from ASGI headers."""
+    return propagate.extract({key.decode("latin-1"): value.decode("latin-1") for key, value in headers})
+
+
+def current_span():
+    return trace.get_current_span()
+
+
+def set_attributes(**attributes):
+    """Add attributes to the current span, e.g. counts known only at the end."""
+    current_span().set_attributes(attributes)
+
+
+def record_error(exc):
+    """Mark the current span failed, for errors that are handled rather than raised out of it."""
+    span = current_span()
+    span.record_exception(exc)
+    span.set_status(Status(StatusCode.ERROR, str(exc)))
+
+
+def record_llm_usage(message, prompt_tokens, completion_tokens, span=None):
+    """Add the tokens a model response reports, if any, to the two counters
+    and note them on span (by default the current one)."""
+    usage = getattr(message, "usage_metadata", None)
+    if usage:
+        prompt_tokens.inc(usage.get("input_tokens", 0))
+        completion_tokens.inc(usage.get("output_tokens", 0))
+        (span or current_span()).set_attributes({
+            "gen_ai.usage.input_tokens": usage.get("input_tokens", 0),
+            "gen_ai.usage.output_tokens": usage.get("output_tokens", 0),
+        })
+
+
+def wrap(function):
+    """Bind function to the current context so it runs under the current span on another thread."""
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # A context can't be entered by two threads at once
+        return context.copy().run(function, *args, **kwargs)
+    return run
+
+
+configure()
+atexit.register(shutdown)
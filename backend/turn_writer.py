@@ -0,0 +1,156 @@
+"""Persistence of chat turns, optionally write-behind.
+
+Each turn (question and answer) is written in one transaction. With
+CHAT_WRITE_BEHIND on, /chat and /chat/stream only queue the turn; a single
+background task writes queued turns in batches of up to
+WRITE_BEHIND_BATCH_SIZE, one commit per batch, waiting at most
+WRITE_BEHIND_MAX_DELAY_MS for a batch to fill. Reading a chat waits for its
+queued turns, and shutdown writes everything still queued before the
+database engine is disposed.
+"""
+import asyncio
+import datetime
+from collections import Counter
+import config
+import database
+import logs
+import metrics
+
+logger = logs.get_logger(__name__)
+
+TURNS_WRITTEN = metrics.counter("chat_turns_written_total", "Chat turns committed by the write-behind queue")
+TURNS_DROPPED = metrics.counter("chat_turns_dropped_total", "Queued chat turns that could not be written")
+BATCH_SIZE = metrics.histogram(
+    "chat_turn_batch_size", "Chat turns committed together by the write-behind queue",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200),
+)
+
+_writer = None
+
+
+class TurnWriter:
+    def __init__(self, session_factory=None, batch_size=None, max_delay=None):
+        self.session_factory = session_factory or database.AsyncSessionLocal
+        self.batch_size = batch_size or config.WRITE_BEHIND_BATCH_SIZE
+        self.max_delay = config.WRITE_BEHIND_MAX_DELAY_MS / 1000 if max_delay is None else max_delay
+        self._queue = asyncio.Queue()
+        self._pending = Counter()
+        self._written = asyncio.Condition()
+        self._flush_requested = asyncio.Event()
+        self._task = None
+        self._closed = False
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def submit(self, turn):
+        """Queue the keyword arguments of database.turn_messages for writing."""
+        if self._closed:
+            raise RuntimeError("Turn writer is closed")
+        turn.setdefault("created_at", datetime.datetime.utcnow())
+        self._pending[turn["group_id"]] += 1
+        self._queue.put_nowait(turn)
+
+    async def wait_for_chat(self, group_id):
+        """Return once every turn queued for this chat has been written."""
+        if not self._pending[group_id]:
+            return
+        self._flush_requested.set()
+        async with self._written:
+            await self._written.wait_for(lambda: not self._pending[group_id])
+
+    async def close(self):
+        """Write everything still queued, then stop the background task."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put_nowait(None)
+        self._flush_requested.set()
+        if self._task is not None:
+            await self._task
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            turn = await self._queue.get()
+            if turn is None:
+                break
+            batch = [turn]
+            # Give other requests a moment to join the batch unless it is
+            # already full or someone is waiting on it
+            if self._queue.qsize() < self.batch_size - 1 and not self._flush_requested.is_set():
+                try:
+                    await asyncio.wait_for(self._flush_requested.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            self._flush_requested.clear()
+            while len(batch) < self.batch_size and not self._queue.empty():
+                turn = self._queue.get_nowait()
+                if turn is None:
+                    stopping = True
+                    break
+                batch.append(turn)
+            await self._write(batch)
+        # Turns queued behind the stop marker
+        while not self._queue.empty():
+            turn = self._queue.get_nowait()
+            if turn is not None:
+                await self._write([turn])
+
+    async def _commit(self, batch):
+        async with self.session_factory() as db:
+            for turn in batch:
+                db.add_all(database.turn_messages(**turn))
+            await db.commit()
+        TURNS_WRITTEN.inc(len(batch))
+        BATCH_SIZE.observe(len(batch))
+
+    async def _write(self, batch):
+        try:
+            await self._commit(batch)
+        except Exception as e:
+            logger.warning("Writing queued chat turns failed, retrying one by one", extra={"turns": len(batch), "error": str(e)})
+            # Retry one by one so a single bad turn doesn't lose the batch
+            for turn in batch:
+                try:
+                    await self._commit([turn])
+                except Exception as e:
+                    TURNS_DROPPED.inc()
+                    logger.error("Dropped chat turn", extra={"chat_id": turn["group_id"], "error": str(e)})
+        async with self._written:
+            for turn in batch:
+                self._pending[turn["group_id"]] -= 1
+                if self._pending[turn["group_id"]] <= 0:
+                    del self._pending[turn["group_id"]]
+            self._written.notify_all()
+
+
+async def start():
+    global _writer
+    if config.CHAT_WRITE_BEHIND and _writer is None:
+        _writer = TurnWriter()
+        _writer.start()
+
+
+async def stop():
+    """Flush queued turns; must finish before the database engine is disposed."""
+    global _writer
+    if _writer is not None:
+        await _writer.close()
+        _writer = None
+
+
+async def save_turn(db, user_id, group_id, query, response, message_id, document_ids):
+    turn = dict(
+        user_id=user_id, group_id=group_id, query=query, response=response,
+        message_id=message_id, document_ids=document_ids
+    )
+    if _writer is not None:
+        _writer.submit(turn)
+    else:
+        await database.asave_turn(db, **turn)
+
+
+async def wait_for_chat(group_id):
+    if _writer is not None:
+        await _writer.wait_for_chat(group_id)
@@ -12,6 +12,10 @@ const UploadDocument: React.FC<UploadDocumentProps> = ({
 }) => {
   const [file, setFile] = useState<File | null>(null);
   const [isUploading, setIsUploading] = useState<boolean>(false);
+  // Progress of the background processing, once the upload itself is done
+  const [processingProgress, setProcessingProgress] = useState<number | null>(
+    null
+  );
   const [documents, setDocuments] = useState<DocumentList>([]);
   const [isLoading, setIsLoading] = useState<boolean>(true);
   const location = useLocation();
@@ -66,19 +70,31 @@ const UploadDocument: React.FC<UploadDocumentProps> = ({
     try {
       setIsUploading(true);
       const response = await documentService.uploadPdf(formData);
+      setProcessingProgress(0);
+      // The document can't be chatted with until it has been processed
+      const job = await documentService.waitForJob(response.job_id, (update) =>
+        setProcessingProgress(update.progress)
+      );
+      setFile(null);
+      if (job.status === "failed") {
+        toast.error(
+          `Failed to process ${file.name}${job.error ? `: ${job.error}` : ""}`
+        );
+        return;
+      }
+
       if (isNewChat) {
         navigate(`/chat/${response.chat_id}`);
       } else {
         setDocuments((prevDocs) => [response.document, ...prevDocs]);
       }
-
-      setFile(null);
-      toast.success("File uploaded successfully!");
+      toast.success("File uploaded and ready for chat!");
     } catch (err) {
       console.error("Upload error:", err);
       toast.error("Failed to upload file");
     } finally {
       setIsUploading(false);
+      setProcessingProgress(null);
     }
   };
 
@@ -146,7 +162,11 @@ const UploadDocument: React.FC<UploadDocumentProps> = ({
             {isUploading ? (
               <>
                 <div className="w-4 h-4 border-2 border-white border-t-transparent rounded-full animate-spin"></div>
-                <span>Uploading...</span>
+                <span>
+                  {processingProgress === null
+                    ? "Uploading..."
+                    : `Processing... ${processingProgress}%`}
+                </span>
               </>
             ) : (
               <>
@@ -1,6 +1,11 @@
 import axios from "axios";
 import type { AxiosError, InternalAxiosRequestConfig } from "axios";
-import type { ChatResponse, DocumentList, TailwindDocs } from "../types";
+import type {
+  ChatResponse,
+  DocumentList,
+  IngestionJob,
+  TailwindDocs,
+} from "../types";
 import { toast } from "sonner";
 
 const API_BASE_URL = "http://localhost:8000";
@@ -97,11 +102,26 @@ apiClient.interceptors.response.use(
   }
 );
 
+// List endpoints return one page at a time, with the cursor for the next
+// page in the X-Next-Cursor header; fetch every page in order
+const getAllPages = async <T>(url: string): Promise<T[]> => {
+  const pages: T[] = [];
+  let cursor: string | undefined;
+  do {
+    const response = await apiClient.get<T>(url, {
+      params: cursor ? { cursor } : undefined,
+    });
+    pages.push(response.data);
+    cursor = response.headers["x-next-cursor"];
+  } while (cursor);
+  return pages;
+};
+
 export const documentService = {
   getUserDocuments: async (): Promise<DocumentList> => {
     try {
-      const response = await apiClient.get<DocumentList>("/user/documents");
-      return response.data;
+      const pages = await getAllPages<DocumentList>("/user/documents");
+      return pages.flat();
     } catch (error) {
       console.error("Error fetching user documents:", error);
       throw error;
@@ -110,8 +130,8 @@ export const documentService = {
 
   getDocuments: async (): Promise<DocumentList> => {
     try {
-      const response = await apiClient.get<DocumentList>("/user/documents");
-      return response.data;
+      const pages = await getAllPages<DocumentList>("/user/documents");
+      return pages.flat();
     } catch (error) {
       console.error("Error fetching documents:", error);
       throw error;
@@ -120,10 +140,10 @@ export const documentService = {
 
   getChatDocuments: async (chatId: string): Promise<DocumentList> => {
     try {
-      const response = await apiClient.get<DocumentList>(
+      const pages = await getAllPages<DocumentList>(
         `/chat/${chatId}/documents`
       );
-      return response.data;
+      return pages.flat();
     } catch (error) {
       console.error(`Error fetching documents for chat ${chatId}:`, error);
       throw error;
@@ -155,6 +175,27 @@ export const documentService = {
       throw error;
     }
   },
+
+  getJob: async (jobId: string): Promise<IngestionJob> => {
+    const response = await apiClient.get<IngestionJob>(`/jobs/${jobId}`);
+    return response.data;
+  },
+
+  // Uploads are processed in the background; poll until the job is done
+  waitForJob: async (
+    jobId: string,
+    onProgress?: (job: IngestionJob) => void,
+    intervalMs = 1000
+  ): Promise<IngestionJob> => {
+    for (;;) {
+      const job = await documentService.getJob(jobId);
+      onProgress?.(job);
+      if (job.status === "completed" || job.status === "failed") {
+        return job;
+      }
+      await new Promise((resolve) => setTimeout(resolve, intervalMs));
+    }
+  },
 };
 
 export const chatService = {
@@ -190,8 +231,8 @@ export const chatService = {
 
   getChatHistory: async (): Promise<TailwindDocs> => {
     try {
-      const response = await apiClient.get<TailwindDocs>("/chats");
-      return response.data;
+      const pages = await getAllPages<TailwindDocs>("/chats");
+      return pages.flat();
     } catch (error) {
       console.error("Error fetching chat history:", error);
       throw error;
@@ -200,8 +241,12 @@ export const chatService = {
 
   getChatById: async (chatId: string): Promise<any> => {
     try {
-      const response = await apiClient.get<any>(`/chat/${chatId}`);
-      return response.data;
+      // Pages run from the newest messages back, each one oldest first
+      const pages = await getAllPages<any>(`/chat/${chatId}`);
+      return {
+        ...pages[0],
+        messages: pages.reverse().flatMap((page) => page.messages),
+      };
     } catch (error) {
       console.error(`Error fetching chat ${chatId}:`, error);
       throw error;
@@ -22,6 +22,20 @@ export type DocumentItem = {
 
 export type DocumentList = DocumentItem[];
 
+/**
+ * Background extraction and embedding of an uploaded PDF (/jobs/{id})
+ */
+export type IngestionJob = {
+  id: string;
+  status: "queued" | "running" | "completed" | "failed";
+  stage: string;
+  progress: number; // 0-100
+  error: string | null;
+  summary_status: string | null;
+  chat_id: string;
+  document_id: string;
+};
+
 export interface UploadDocumentProps {
   setSelectedFileIds: (fileIds: string[]) => void;
   selectedFileIds: string[];